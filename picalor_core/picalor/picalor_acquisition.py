@@ -0,0 +1,448 @@
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from pipyadc import ADS1256
+from pipyadc import ADS1256_definitions as adc_def
+from picalor.util_lib.pt1000_sensor import ptRTD_temperature, wheatstone
+
+logger = logging.getLogger("acquisition")
+
+
+class SharedBusADS1256(ADS1256):
+    """ADS1256 sharing its SPI bus with other ADS1256 instances which
+    are operated concurrently from different threads.
+
+    All SPI transfers between chip select and chip release are
+    serialized using one lock per SPI bus.
+
+    The ADC conversion time, i.e. waiting for the DRDY signal, is spent
+    without occupying the bus. Thus, conversions on different chips
+    do run in parallel. This requires a configured DRDY_PIN.
+    """
+    # One lock for each SPI bus number
+    _bus_locks = {}
+    _bus_locks_lock = threading.Lock()
+
+    def __init__(self, conf, pi):
+        # Chip select is already used by the base class constructor
+        with self._bus_locks_lock:
+            self._bus_lock = self._bus_locks.setdefault(conf.SPI_BUS,
+                                                        threading.Lock())
+        super().__init__(conf, pi)
+
+    def read_and_next_is(self, diff_channel):
+        # Wait for conversion result before occupying the bus.
+        # Waiting again in the base class method then returns immediately.
+        # Without DRDY pin, waiting is a fixed sleep, which must not be
+        # done twice.
+        if self._DRDY_PIN is not None:
+            self._wait_DRDY()
+        return super().read_and_next_is(diff_channel)
+
+    def _chip_select(self):
+        self._bus_lock.acquire()
+        super()._chip_select()
+
+    def _chip_release(self):
+        try:
+            super()._chip_release()
+        finally:
+            self._bus_lock.release()
+
+
+class AdcAcquisitionPlan():
+    """Acquisition of all measurement channels configured for one ADC device
+
+    All ADC inputs needed by the measurements are combined into one
+    deduplicated input multiplexer sequence. The resistance reference is
+    thus sampled only once per cycle and sensors shared between measurements
+    (e.g. one channel's downstream sensor being another channel's upstream
+    sensor) are not sampled twice. All channel resistances are then derived
+    from the shared table of averaged samples (see BatchConverter).
+
+    Temperature channels which are used only as flow sensor temperature
+    channel are sampled against the resistance reference and evaluated
+    with the nominal Pt1000 base resistance and no wiring offset.
+
+    If a RawCapture is given, all single ADC samples are recorded.
+
+    If an adc_lock is given, it is held while scanning. When it is already
+    held by another thread (i.e. the Calibrator), the scan is skipped and
+    all values of this ADC are NaN. In continuous acquisition mode, the lock
+    is held by the ContinuousSampler while reading the ADC instead.
+    """
+    def __init__(self,
+                 state,
+                 adc_key,
+                 adc_obj,
+                 measurements,
+                 continuous=False,
+                 raw_capture=None,
+                 adc_lock=None,
+                 ):
+        self.adc_obj = adc_obj
+        self.adc_lock = adc_lock
+        # Average this number of measurements
+        conf = state.conf.snapshot()
+        self.FILTER_SIZE = conf["measurements"]["FILTER_SIZE"]
+        adc_conf = conf["adcs"][adc_key]
+        self.mux_seq = []
+        adc_offsets = []
+        def add_input(mux_code, adc_offset):
+            if mux_code not in self.mux_seq:
+                self.mux_seq.append(mux_code)
+                adc_offsets.append(adc_offset)
+            return self.mux_seq.index(mux_code)
+        for measurement in measurements:
+            measurement.plan_idxs = [add_input(*adc_input)
+                                     for adc_input in measurement.adc_inputs]
+        # Flow sensor temperature channels not measured by any measurement
+        flow_only_chs = (
+              {m.flow_sensor_temp_ch for m in measurements}
+            - {m.temp_ch_up for m in measurements}
+            - {m.temp_ch_dn for m in measurements}
+        )
+        r_ref_mux = getattr(adc_def, adc_conf["r_ref"]["mux"])
+        self.r_ref_idx = add_input(
+            r_ref_mux << 4 | getattr(adc_def, adc_conf["aincom"]["mux"]),
+            adc_conf["r_ref"]["adc_offset"]
+        )
+        # Reference channel resistance ratio
+        self.N_REF = adc_conf["r_ref"]["r_s"] / adc_conf["r_ref"]["r_ref"]
+        self.flow_temp_chs = []
+        for ch in sorted(flow_only_chs):
+            ch_conf = adc_conf["temp_chs"][ch]
+            idx = add_input(getattr(adc_def, ch_conf["mux"]) << 4 | r_ref_mux,
+                            ch_conf["adc_offset"])
+            self.flow_temp_chs.append((ch, idx, ch_conf["r_s"], ch_conf["r_offset"],
+                                       ch_conf.get("r_quad", 0.0)))
+        self.adc_offsets = np.array(adc_offsets)
+        # Buffer for raw input samples, one column for each multiplexer input
+        self.adc_buf = np.zeros((self.FILTER_SIZE, len(self.mux_seq)), dtype=int)
+        # Averaged samples without offset, shared by all measurements
+        self.adc_unscaled = np.zeros(len(self.mux_seq))
+        self.recorder = None
+        if raw_capture is not None:
+            self.recorder = raw_capture.adc_recorder(adc_key, self.mux_seq)
+        # Start time and end time of each burst acquisition cycle
+        self._t_bounds = np.zeros(self.FILTER_SIZE + 1)
+        self.results_adc_temp_chs = state.results["adcs"][adc_key]["temp_chs"]
+        logger.info(f"{adc_key}: {len(self.mux_seq)} ADC inputs for "
+                    f"{len(measurements)} measurements")
+        # In continuous acquisition mode, samples are acquired all the time
+        # in the background and each scan only evaluates the filter output.
+        self.sampler = None
+        if continuous:
+            meas_conf = conf["measurements"]
+            self.sampler = ContinuousSampler(
+                adc_obj,
+                self.mux_seq,
+                filter_weights(
+                    str(meas_conf.get("filter_type", "boxcar")),
+                    int(meas_conf.get("filter_window", self.FILTER_SIZE)),
+                    float(meas_conf.get("filter_alpha", 0.2)),
+                    meas_conf.get("fir_coefficients", []),
+                ),
+                name=f"{adc_key} Sampler",
+                recorder=self.recorder,
+                adc_lock=adc_lock,
+            )
+
+    # Acquire new samples. Temperatures are only calculated for flow sensor
+    # temperature channels, measurement channels are converted in batch.
+    def scan(self):
+        if self.sampler is not None:
+            if self.sampler.blocked:
+                self._scan_skipped()
+            else:
+                self._scan()
+        elif self.adc_lock is None:
+            self._scan()
+        elif self.adc_lock.acquire(blocking=False):
+            try:
+                self._scan()
+            finally:
+                self.adc_lock.release()
+        else:
+            self._scan_skipped()
+
+    # All values of this ADC are NaN while it is held by another thread
+    def _scan_skipped(self):
+        self.adc_unscaled = np.full(len(self.mux_seq), np.nan)
+        for ch, *_ in self.flow_temp_chs:
+            results = self.results_adc_temp_chs[ch]
+            results["adc_unscaled"] = None
+            results["resistance"] = None
+            results["temperature"] = None
+
+    def _scan(self):
+        if self.sampler is not None:
+            adc_avg = self.sampler.filtered()
+        else:
+            self._t_bounds[0] = time.time()
+            self.adc_obj.read_sequence(self.mux_seq, self.adc_buf[0])
+            self._t_bounds[1] = time.time()
+            for j in range(1, self.FILTER_SIZE):
+                # Do the data acquisition of the multiplexed input channels
+                self.adc_obj.read_continue(self.mux_seq, self.adc_buf[j])
+                self._t_bounds[j+1] = time.time()
+            if self.recorder is not None:
+                self.recorder.record(self._t_bounds, self.adc_buf)
+            adc_avg = np.average(self.adc_buf, axis=0)
+        # Elementwise offset correction
+        self.adc_unscaled = adc_avg - self.adc_offsets
+        u_ref = self.adc_unscaled[self.r_ref_idx]
+        for ch, idx, r_s, r_offset, r_quad in self.flow_temp_chs:
+            u_ch = self.adc_unscaled[idx]
+            r = wheatstone(u_ch, u_ref, self.N_REF, r_s)
+            r += r_quad * (r / r_s)**2 - r_offset
+            results = self.results_adc_temp_chs[ch]
+            results["adc_unscaled"] = u_ch
+            results["resistance"] = r
+            results["temperature"] = ptRTD_temperature(r)
+
+
+class AcquisitionScheduler():
+    """Runs the ADC acquisition of all measurement channels, grouped by
+    ADC device into one AdcAcquisitionPlan each. Each ADC device is scanned
+    concurrently on its own worker thread, so that the scan time is set by
+    the busiest ADC instead of the sum of all channels.
+
+    Falls back to serial acquisition in the calling thread if parallel
+    acquisition is disabled, if there is only one ADC, or if the ADC
+    devices do not have individual chip select pins.
+
+    In continuous acquisition mode, all ADCs sample all the time on
+    background threads and scans only evaluate the filtered samples.
+
+    If a RawCapture is given, all single ADC samples are recorded.
+
+    adc_locks optionally maps ADC keys to locks for exclusive ADC access,
+    see AdcAcquisitionPlan.
+    """
+    def __init__(self,
+                 state,
+                 measurements,
+                 adc_objs,
+                 parallel=True,
+                 continuous=False,
+                 raw_capture=None,
+                 adc_locks=None,
+                 ):
+        groups = {}
+        for measurement in measurements:
+            groups.setdefault(measurement.adc_key, []).append(measurement)
+        adc_locks = {} if adc_locks is None else adc_locks
+        self.plans = {
+            key: AdcAcquisitionPlan(state, key, adc_objs[key], group,
+                                    continuous, raw_capture, adc_locks.get(key))
+            for key, group in groups.items()
+        }
+        self.continuous = continuous
+        if continuous:
+            logger.info("Continuous acquisition on all ADCs")
+            for plan in self.plans.values():
+                plan.sampler.start()
+            # Evaluating filter outputs does not block, no workers needed
+            parallel = False
+        cs_pins = [state.conf.snapshot()["adcs"][key]["ads1256_config"].get("CS_PIN")
+                   for key in self.plans]
+        if parallel and (None in cs_pins or len(set(cs_pins)) < len(cs_pins)):
+            logger.warning("ADCs without individual chip select pins. "
+                           "Using serial acquisition.")
+            parallel = False
+        self.parallel = parallel and len(self.plans) > 1
+        self._executor = None
+        if self.parallel:
+            logger.info(f"Parallel acquisition on {len(self.plans)} ADCs")
+            self._executor = ThreadPoolExecutor(
+                max_workers=len(self.plans),
+                thread_name_prefix="ADC Worker",
+            )
+
+    # Blocks until all measurements have acquired new samples.
+    # Exceptions from the worker threads are re-raised here.
+    def scan_all(self):
+        if not self.parallel:
+            for plan in self.plans.values():
+                plan.scan()
+            return
+        futures = [self._executor.submit(plan.scan)
+                   for plan in self.plans.values()]
+        for future in futures:
+            future.result()
+
+    # Averaged and offset-corrected samples of the resistance reference,
+    # upstream and downstream sensor inputs, shape: (len(measurements), 3)
+    def adc_unscaled_table(self, measurements):
+        table = np.empty((len(measurements), 3))
+        for i, measurement in enumerate(measurements):
+            plan = self.plans[measurement.adc_key]
+            table[i] = plan.adc_unscaled[measurement.plan_idxs]
+        return table
+
+    # Stop background sampling, e.g. for exclusive ADC access by the Calibrator.
+    # Blocks until the samplers have completed any running ADC access.
+    # If adc_key is given, only the sampler of that ADC is paused.
+    def pause(self, adc_key=None):
+        for key, plan in self.plans.items():
+            if plan.sampler is not None and adc_key in (None, key):
+                plan.sampler.pause()
+
+    def resume(self, adc_key=None):
+        for key, plan in self.plans.items():
+            if plan.sampler is not None and adc_key in (None, key):
+                plan.sampler.resume()
+
+    def shutdown(self):
+        for plan in self.plans.values():
+            if plan.sampler is not None:
+                plan.sampler.stop()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+class ContinuousSampler():
+    """Continuous background acquisition of a cyclic ADC input sequence
+
+    A worker thread reads the input multiplexer sequence round-robin all
+    the time. Each completed sequence is stored as one row of a ring buffer
+    holding the latest len(weights) rows.
+
+    The filtered() method returns the weighted average of the latest rows,
+    i.e. the output of a moving-average (FIR) filter, for each input.
+
+    Each row is also passed to the RawAdcRecorder, if given.
+
+    If an adc_lock is given, it is held while reading the ADC. While it is
+    held by another thread (i.e. the Calibrator), the ADC is not read and
+    blocked is True. This also applies to samplers started after the lock
+    was acquired, e.g. when acquisition is set up new.
+    """
+    # Interval for retrying to acquire the adc_lock
+    RETRY_INTERVAL_S = 0.01
+
+    def __init__(self, adc_obj, mux_seq, weights, name="ADC Sampler", recorder=None,
+                 adc_lock=None):
+        self.adc_obj = adc_obj
+        self.recorder = recorder
+        self.adc_lock = adc_lock
+        # Set while paused or while the ADC is held by another thread,
+        # cleared when the next row is acquired
+        self.blocked = False
+        self.mux_seq = list(mux_seq)
+        # Filter weights, newest sample first
+        self.weights = np.asarray(weights, dtype=float)
+        self.window = len(self.weights)
+        self._buf = np.zeros((self.window, len(self.mux_seq)), dtype=int)
+        # Ring buffer index of the next row and number of rows acquired
+        self._idx = 0
+        self.n_samples = 0
+        self._buf_lock = threading.Lock()
+        self._first_sample = threading.Event()
+        # Held while reading one cycle of the sequence
+        self._cycle_lock = threading.Lock()
+        self._running = threading.Event()
+        self._stop_requested = threading.Event()
+        self._thread_obj = threading.Thread(
+            target=self._sampler_thread, name=name, daemon=True)
+
+    def start(self):
+        self._running.set()
+        self._thread_obj.start()
+
+    def stop(self):
+        self._stop_requested.set()
+        self.pause()
+        self._thread_obj.join(10)
+
+    def pause(self):
+        self._running.clear()
+        # Wait for the sampler thread to complete any running ADC access
+        with self._cycle_lock:
+            pass
+
+    def resume(self):
+        self._running.set()
+
+    # Weighted average of the latest samples for each ADC input.
+    # Until the filter window is filled, weights are re-normalized
+    # for the number of rows available.
+    def filtered(self, timeout=10.0):
+        if not self._first_sample.wait(timeout):
+            logger.error("No samples from continuous ADC acquisition!")
+            return np.full(len(self.mux_seq), np.nan)
+        with self._buf_lock:
+            # No samples yet if the sampler was blocked from the start
+            if self.n_samples == 0:
+                return np.full(len(self.mux_seq), np.nan)
+            n = min(self.n_samples, self.window)
+            # Row indices, newest first
+            rows = (self._idx - 1 - np.arange(n)) % self.window
+            samples = self._buf[rows]
+        weights = self.weights[:n]
+        return weights @ samples / np.sum(weights)
+
+    def _sampler_thread(self):
+        row = np.zeros(len(self.mux_seq), dtype=int)
+        restart = True
+        while not self._stop_requested.is_set():
+            with self._cycle_lock:
+                paused = not self._running.is_set()
+                running = not paused
+                if running and self.adc_lock is not None:
+                    running = self.adc_lock.acquire(blocking=False)
+                t_start = time.time()
+                if running:
+                    try:
+                        # After a pause, the ADC cycle must be re-synchronized
+                        if restart:
+                            self.adc_obj.read_sequence(self.mux_seq, row)
+                            restart = False
+                        else:
+                            self.adc_obj.read_continue(self.mux_seq, row)
+                    finally:
+                        if self.adc_lock is not None:
+                            self.adc_lock.release()
+            if not running:
+                restart = True
+                self.blocked = True
+                # filtered() does not wait for samples while blocked
+                self._first_sample.set()
+                if paused:
+                    self._running.wait(0.1)
+                else:
+                    self._stop_requested.wait(self.RETRY_INTERVAL_S)
+                continue
+            t_end = time.time()
+            with self._buf_lock:
+                self._buf[self._idx] = row
+                self._idx = (self._idx + 1) % self.window
+                self.n_samples += 1
+            self.blocked = False
+            self._first_sample.set()
+            if self.recorder is not None:
+                self.recorder.record((t_start, t_end), row)
+
+
+# Moving-average filter weights for ContinuousSampler, newest sample first.
+#   "boxcar":       Equal weights for window samples
+#   "exponential":  Weights alpha * (1 - alpha)^k, truncated to window samples
+#   "fir":          Custom FIR filter coefficients, newest sample first
+def filter_weights(filter_type, window, alpha=0.2, fir_coefficients=()):
+    if filter_type == "boxcar":
+        weights = np.ones(window)
+    elif filter_type == "exponential":
+        if not 0.0 < alpha <= 1.0:
+            raise ValueError("Exponential filter alpha must be in (0, 1]")
+        weights = alpha * (1.0 - alpha) ** np.arange(window)
+    elif filter_type == "fir":
+        weights = np.array(fir_coefficients, dtype=float)
+    else:
+        raise ValueError(f"Invalid filter type: {filter_type}")
+    if len(weights) < 1 or np.sum(weights) == 0.0:
+        raise ValueError("Filter weights must have a non-zero sum")
+    return weights
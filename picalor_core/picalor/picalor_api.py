@@ -2,10 +2,43 @@ import logging
 import json
 from typing import Callable
 from picalor.picalor_mqtt import PicalorMqtt
+from picalor.picalor_publisher import PicalorPublisher
+from picalor.picalor_dispatcher import PicalorDispatcher, INLINE
+from picalor.picalor_state import merge_live_snapshots, results_to_json
 
 logger = logging.getLogger("picalor_api")
 
 class PicalorActions():
+    # Dispatch lane of each action, see PicalorDispatcher. Fast actions are
+    # run inline, config changes are serialized. Default lane is "pool".
+    DISPATCH_LANES = {
+        "get__config": INLINE,
+        "get__diagnostics": INLINE,
+        "get__calibration_jobs": INLINE,
+        "set__datalog_enabled": INLINE,
+        "clear__datalog": INLINE,
+        "cancel__calibration": INLINE,
+        # Stops all threads including the dispatcher
+        "poweroff": INLINE,
+        "upload_norestart__config": "config",
+        "upload__config": "config",
+        "upload_save__config": "config",
+        "upload_patch__config": "config",
+        "set__power_offset": "config",
+        "set__power_gain": "config",
+        "tare__power": "config",
+        "calibrate__temp_channel": "calibration",
+        "start__calibration": "calibration",
+        "start__batch_calibration": "calibration",
+        "get__results": "results",
+        "get__datalog_slice": "results",
+        "get__datalog_range": "results",
+        "save__results": "save",
+        "export__datalog": "save",
+    }
+    # Maximum number of concurrently running actions for each lane
+    LANE_LIMITS = {"config": 1, "calibration": 1, "results": 2, "save": 1}
+
     def __init__(self, api, core, state):
         self.api = api
         self.core = core
@@ -29,6 +62,14 @@ class PicalorActions():
     def get__config(self, _):
         return self.state.conf.as_json()
 
+    # Full results snapshot including the complete data log
+    def get__results(self, _):
+        return self.state.results.as_json()
+
+    # Timing statistics of the measurement loop
+    def get__diagnostics(self, _):
+        return self.core.measurement_daemon.diagnostics_json()
+
     # API response with new config will be sent from measurement thread
     def upload_norestart__config(self, config):
         self.state.conf.set_norestart__config(config)
@@ -40,6 +81,11 @@ class PicalorActions():
     # API response with new config will be sent from measurement thread
     def upload_save__config(self, config):
         self.state.conf.set_save__config(config)
+
+    # Same as upload__config, but the API response sent from measurement
+    # thread is a JSON patch (RFC 6902) of the changed configuration items.
+    def upload_patch__config(self, config):
+        self.state.conf.set_patch__config(config)
     
     def set__power_offset(self, values_list):
         for ch_idx, power in values_list:
@@ -63,19 +109,61 @@ class PicalorActions():
         self.core.measurement_daemon.tare_power(ch_idx)
         return json.dumps(ch_idx)
     
+    # Runs in the background. API response with the new ADC configuration
+    # is sent when the calibration job is finished.
     def calibrate__temp_channel(self, cal_args):
-        self.core.measurement_daemon.calibrator.calibrate_channel(
-            cal_args["adc_key"],
-            cal_args["temp_ch_idx"],
-            cal_args["value_key"],
-            cal_args["cal_resistance"]
-        )
-        return json.dumps(self.state.conf.adcs)
+        self.core.measurement_daemon.calibrator.start_job(
+            cal_args, response_cmd="calibrate__temp_channel")
+
+    # Same as calibrate__temp_channel, but responds immediately with the job
+    # status including the job ID. Progress is published on the
+    # "calibration" data key.
+    def start__calibration(self, cal_args):
+        return json.dumps(self.core.measurement_daemon.calibrator.start_job(cal_args))
+
+    # Acquires calibration points for many temperature channels at once and
+    # fits the channel calibration values, see Calibrator.start_batch_job.
+    # Responds immediately with the job status, results are in the status.
+    def start__batch_calibration(self, cal_args):
+        return json.dumps(
+            self.core.measurement_daemon.calibrator.start_batch_job(cal_args))
+
+    def cancel__calibration(self, job_id):
+        return json.dumps(self.core.measurement_daemon.calibrator.cancel_job(job_id))
+
+    # Status of queued, running and recently finished calibration jobs
+    def get__calibration_jobs(self, _):
+        return self.core.measurement_daemon.calibrator.jobs_json()
     
-    # Saves and responds immediately as save__results is a blocking call
-    # (waits only very briefly for spinlock)
+    # Data log rows of a time range. Argument is an object with optional
+    # keys "t_start" and "t_stop" (time_s values, t_start <= time_s < t_stop).
+    def get__datalog_slice(self, args):
+        args = {} if args is None else args
+        return results_to_json(self.state.results.datalog_slice(
+            args.get("t_start"), args.get("t_stop")))
+
+    # Decimated data log for plotting long time ranges. Argument is an object
+    # with optional keys "t_start", "t_stop" and "n_points" (default 1000).
+    # Each point has the minimum, maximum and mean values of a bucket of rows,
+    # see DataLogRef.decimate().
+    def get__datalog_range(self, args):
+        args = {} if args is None else args
+        return results_to_json(self.state.results.datalog_range(
+            args.get("t_start"), args.get("t_stop"), args.get("n_points", 1000)))
+
+    # Responds when the results file is written
     def save__results(self, _):
         return json.dumps(self.state.results.save_to_file())
+
+    # Streams the data log into a JSON Lines or CSV file in the savedata
+    # folder. Argument is an object with optional keys "format" ("jsonl" or
+    # "csv"), "compress" (gzip), "t_start" and "t_stop".
+    # Responds with a summary including the file name when the file is written.
+    def export__datalog(self, args):
+        args = {} if args is None else args
+        return json.dumps(self.state.results.export_datalog(
+            args.get("format", "jsonl"), bool(args.get("compress", False)),
+            args.get("t_start"), args.get("t_stop")))
     
     def poweroff(self, value):
         if value is True:
@@ -99,9 +187,27 @@ class PicalorApi():
             # PicalorXlsxExporter(self, state),
             # PicalorCsvExporter(self, state),
         ]
+        # Live data and diagnostics are published from the publisher thread
+        self.publisher = PicalorPublisher(
+            self.frontends, state.conf["mqtt"].get("PUBLISH_QUEUE_SIZE", 8))
+        # Commands are run on worker threads, see PicalorActions.DISPATCH_LANES
+        self.dispatcher = PicalorDispatcher(
+            state.conf["mqtt"].get("COMMAND_WORKERS", 4), PicalorActions.LANE_LIMITS)
 
-    # Called from frontend
+    # Called from frontend. Returns immediately unless the action is
+    # dispatched inline, the response is sent when the action is done.
     def dispatch_cmd(self, cmd, value):
+        if cmd not in self.actions.actions:
+            self._run_action(cmd, value)
+            return
+        lane = PicalorActions.DISPATCH_LANES.get(cmd, "pool")
+        try:
+            self.dispatcher.submit(lane, lambda: self._run_action(cmd, value))
+        except RuntimeError as e:
+            logger.error(f"Command not dispatched: {cmd}\nError: {e}")
+            self.send_response(cmd, json.dumps(f"Core: {e}"), success=False)
+
+    def _run_action(self, cmd, value):
         try:
             action = self.actions[cmd]
             response_json = action(value)
@@ -113,11 +219,30 @@ class PicalorApi():
             # String returned is valid JSON
             self.send_response(cmd, f'"Core: {msg}"', success=False)
 
-    # "push" means publishing on the data topic channel
+    # "push" means publishing on the data topic channel.
+    # Called from measurement thread only. Results are queued without copying
+    # the data log, which is copied when encoded on the publisher thread.
+    # In "delta" live data mode, only instantaneous values and new data log
+    # rows are published on the "live" data key. Full snapshot is available
+    # via the get__results action.
     def push_live_data(self):
-        json_str = self.state.results.as_json()
-        for frontend in self.frontends:
-            frontend.push_data_json("results", json_str)
+        live_data_mode = self.state.conf.snapshot()["measurements"].get(
+            "live_data_mode", "full")
+        if live_data_mode == "delta":
+            self.publisher.publish("live",
+                                   self.state.results.measurement_thread_snapshot_live(),
+                                   merge_live_snapshots)
+        else:
+            self.publisher.publish("results",
+                                   self.state.results.published())
+
+    # Published on the "diagnostics" data key
+    def push_diagnostics(self, json_str):
+        self.publisher.publish("diagnostics", json_str)
+
+    # Published on the "calibration" data key
+    def push_calibration_status(self, json_str):
+        self.publisher.publish("calibration", json_str)
 
     # "push" means publishing on the data topic channel
     def push_error_str(self, message):
@@ -130,6 +255,7 @@ class PicalorApi():
             frontend.send_response(cmd_name, response_json, success)
 
     def start_frontends(self):
+        self.dispatcher.start()
         for frontend in self.frontends:
             try:
                 frontend.launch_client_thread()
@@ -137,8 +263,11 @@ class PicalorApi():
                 msg = f"Failed to launch frontend: {str(frontend)}\nError: {e}"
                 logger.exception(msg)
                 raise
+        self.publisher.start()
 
     def stop_frontends(self):
+        self.dispatcher.shutdown()
+        self.publisher.stop()
         for frontend in self.frontends:
             try:
                 # This is supposed to be a blocking call with a timeout
@@ -0,0 +1,187 @@
+import json
+import math
+import logging
+
+logger = logging.getLogger("picalor_config_diff")
+
+# Measurement settings which are read when used and need no further action
+MEASUREMENTS_LIVE_KEYS = {
+    "default_ch",
+    "datalog_enabled",
+    "datalog_export_chunk_rows",
+    "datalog_slice_max_rows",
+    "calibration_samples",
+    "calibration_fit_quadratic",
+    "diagnostics_interval_s",
+    "diagnostics_window",
+    "live_data_mode",
+}
+# Measurement settings determining the data log time axis
+MEASUREMENTS_DATALOG_INTERVAL_KEYS = {"scan_interval_s", "publish_every_n_scans"}
+
+
+# Plain Python copy of a configuration item, e.g. a tomlkit container
+def plain_config(item):
+    return json.loads(json.dumps(item))
+
+
+# Returns a JSON patch (RFC 6902) which transforms the old into the new
+# configuration. Both must be plain Python objects, see plain_config().
+# Lists of different length are replaced as a whole.
+def config_patch(old, new, path=""):
+    if isinstance(old, dict) and isinstance(new, dict):
+        patch = []
+        for key in old.keys() - new.keys():
+            patch.append({"op": "remove", "path": f"{path}/{_escape(key)}"})
+        for key, value in new.items():
+            key_path = f"{path}/{_escape(key)}"
+            if key not in old:
+                patch.append({"op": "add", "path": key_path, "value": value})
+            else:
+                patch += config_patch(old[key], value, key_path)
+        return patch
+    if (isinstance(old, list) and isinstance(new, list)
+        and len(old) == len(new)
+        ):
+        patch = []
+        for i, (old_value, new_value) in enumerate(zip(old, new)):
+            patch += config_patch(old_value, new_value, f"{path}/{i}")
+        return patch
+    if _equal(old, new):
+        return []
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+# Path parts of a JSON pointer
+def patch_path_parts(path):
+    return [part.replace("~1", "/").replace("~0", "~")
+            for part in path.split("/")[1:]]
+
+
+def _escape(key):
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+# NaN values compare equal, booleans are not equal to numbers
+def _equal(old, new):
+    if type(old) is not type(new):
+        return False
+    if isinstance(old, float) and math.isnan(old) and math.isnan(new):
+        return True
+    return old == new
+
+
+class ConfigChanges():
+    """Changes committed to the configuration, see
+    PicalorConfig.measurement_thread_commit_pending_updates()
+
+    The JSON patch is classified by the measurement daemon components which
+    are affected by the changed configuration items:
+
+        restart_adcs:           Keys of ADC devices to be re-initialized,
+                                i.e. changed hardware settings
+        restart_flow_sensors:   Indices of flow sensors to be restarted
+        restart_all_sensors:    All ADCs and flow sensors must be restarted
+        reinit_results:         Structure of the results has changed, i.e.
+                                number of channels, ADC devices or sensors
+        rebuild_measurements:   Measurement objects, conversion and
+                                acquisition plans must be set up new, e.g.
+                                for changed channel calibration values
+        clear_datalog:          Data log settings or time axis have changed
+        update_scan_interval:   Scan interval has changed
+
+    changed_adcs contains the keys of all ADC devices with any changes.
+    """
+    def __init__(self, patch, saved=False, patch_response=False):
+        self.patch = patch
+        # True if the configuration was also saved to file
+        self.saved = saved
+        # True if the JSON patch is requested as the API response
+        self.patch_response = patch_response
+        self.restart_adcs = set()
+        self.restart_flow_sensors = set()
+        self.restart_all_sensors = False
+        self.restart_all_flow_sensors = False
+        self.reinit_results = False
+        self.rebuild_measurements = False
+        self.clear_datalog = False
+        self.update_scan_interval = False
+        self.changed_adcs = set()
+        for op in patch:
+            self._classify(patch_path_parts(op["path"]))
+
+    def patch_json(self):
+        return json.dumps(self.patch).replace("NaN", "null")
+
+    def summary(self):
+        return {
+            "n_changes": len(self.patch),
+            "restart_adcs": sorted(self.restart_adcs),
+            "restart_flow_sensors": sorted(self.restart_flow_sensors),
+            "restart_all_sensors": self.restart_all_sensors,
+            "restart_all_flow_sensors": self.restart_all_flow_sensors,
+            "reinit_results": self.reinit_results,
+            "rebuild_measurements": self.rebuild_measurements,
+            "clear_datalog": self.clear_datalog,
+        }
+
+    def _classify(self, parts):
+        section = parts[0]
+        if section == "adcs":
+            self._classify_adcs(parts)
+        elif section == "flow_sensors":
+            self.rebuild_measurements = True
+            if len(parts) == 1:
+                # Number of flow sensors has changed
+                self.restart_all_flow_sensors = True
+                self.reinit_results = True
+            else:
+                self.restart_flow_sensors.add(int(parts[1]))
+        elif section == "fluids":
+            self.rebuild_measurements = True
+        elif section == "measurements":
+            self._classify_measurements(parts)
+        elif section == "simulation":
+            self.restart_all_sensors = True
+        # Other sections, e.g. "mqtt" or "display_settings", are not used
+        # by the measurement daemon.
+
+    def _classify_adcs(self, parts):
+        self.rebuild_measurements = True
+        if len(parts) == 1:
+            self.restart_all_sensors = True
+            self.reinit_results = True
+            return
+        adc_key = parts[1]
+        self.changed_adcs.add(adc_key)
+        if len(parts) == 2:
+            # ADC device added, removed or replaced
+            self.restart_adcs.add(adc_key)
+            self.reinit_results = True
+        elif parts[2] == "ads1256_config":
+            self.restart_adcs.add(adc_key)
+        elif parts[2] == "temp_chs" and len(parts) == 3:
+            # Number of temperature channels has changed
+            self.reinit_results = True
+
+    def _classify_measurements(self, parts):
+        if len(parts) == 1:
+            self.rebuild_measurements = True
+            self.reinit_results = True
+            self.update_scan_interval = True
+            return
+        key = parts[1]
+        if key in MEASUREMENTS_LIVE_KEYS:
+            return
+        if key in MEASUREMENTS_DATALOG_INTERVAL_KEYS:
+            self.update_scan_interval = True
+            self.clear_datalog = True
+        elif key.startswith("datalog_"):
+            self.clear_datalog = True
+        elif key == "chs":
+            self.rebuild_measurements = True
+            # Number of channels or channel names of the data log have changed
+            if len(parts) == 2 or (len(parts) > 3 and parts[3] == "info"):
+                self.reinit_results = True
+        else:
+            self.rebuild_measurements = True
@@ -0,0 +1,121 @@
+import os
+import time
+import shutil
+import threading
+import logging
+
+logger = logging.getLogger("picalor_config_writer")
+
+
+class ConfigFileWriter():
+    """Writes the configuration file from a background thread
+
+    save() only requests writing the file. The file content is rendered by
+    calling render() from the writer thread, so it is always the latest
+    state. Requests arriving while a write is pending, or within delay_s
+    after the first request, are coalesced into one write.
+
+    Writing is atomic: The content is written to a temporary file in the
+    same directory, which is fsynced and then renamed over the config file.
+    Before that, the previous config file is kept as backup number one and
+    older backups are rotated, up to n_backups files named e.g.
+    "picalor_config.toml.1" (newest) to "picalor_config.toml.3" (oldest).
+    """
+    def __init__(self, file_obj, render, n_backups=3, delay_s=0.5):
+        self.file_obj = file_obj
+        self.render = render
+        self.n_backups = max(int(n_backups), 0)
+        self.delay_s = float(delay_s)
+        self.n_requested = 0
+        self.n_written = 0
+        self.last_error = None
+        self._cond = threading.Condition()
+        self._stop_requested = False
+        self._thread_obj = None
+
+    # Backup files, newest first
+    def backup_files(self):
+        return [self.file_obj.with_name(f"{self.file_obj.name}.{i}")
+                for i in range(1, self.n_backups + 1)]
+
+    # Thread-safe. Returns the request number, see wait().
+    def save(self):
+        with self._cond:
+            self.n_requested += 1
+            if self._thread_obj is None:
+                self._stop_requested = False
+                self._thread_obj = threading.Thread(
+                    target=self._writer_thread, name="Config Writer", daemon=True)
+                self._thread_obj.start()
+            self._cond.notify_all()
+            return self.n_requested
+
+    # Thread-safe. Waits until the request number n_request is written.
+    # Returns False on timeout.
+    def wait(self, n_request, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.n_written >= n_request, timeout)
+
+    # Writes pending requests and stops the writer thread
+    def stop(self, timeout=10):
+        with self._cond:
+            self._stop_requested = True
+            self._cond.notify_all()
+            thread_obj = self._thread_obj
+            self._thread_obj = None
+        if thread_obj is not None:
+            thread_obj.join(timeout)
+
+    def _writer_thread(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self.n_requested > self.n_written or self._stop_requested)
+                if self.n_requested == self.n_written:
+                    return
+                # Further requests within the delay are written at once
+                t_deadline = time.monotonic() + self.delay_s
+                while not self._stop_requested:
+                    t_remaining = t_deadline - time.monotonic()
+                    if t_remaining <= 0.0:
+                        break
+                    self._cond.wait(t_remaining)
+                n_request = self.n_requested
+            t_start = time.perf_counter()
+            try:
+                self._write_atomic(self.render())
+                self.last_error = None
+                logger.info(f"Saved config to file: {str(self.file_obj)} in "
+                            f"{time.perf_counter() - t_start:.3f} s")
+            except Exception as e:
+                self.last_error = str(e)
+                logger.exception(f"Could not write config file! Error: {e}")
+            with self._cond:
+                # Failed requests are not retried until the next request
+                self.n_written = n_request
+                self._cond.notify_all()
+
+    def _write_atomic(self, text):
+        tmp_file = self.file_obj.with_name(f".{self.file_obj.name}.tmp")
+        with open(tmp_file, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        if self.file_obj.exists() and self.n_backups > 0:
+            backups = self.backup_files()
+            for older, newer in zip(backups[:0:-1], backups[-2::-1]):
+                if newer.exists():
+                    os.replace(newer, older)
+            backups[0].unlink(missing_ok=True)
+            # Hard link keeps the config file in place until it is replaced
+            try:
+                os.link(self.file_obj, backups[0])
+            except OSError:
+                shutil.copy2(self.file_obj, backups[0])
+        os.replace(tmp_file, self.file_obj)
+        # Directory entry of the renamed file must also be persisted
+        dir_fd = os.open(self.file_obj.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
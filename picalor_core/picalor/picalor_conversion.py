@@ -0,0 +1,150 @@
+import logging
+import numpy as np
+from picalor.picalor_measurement import Fluid
+from picalor.util_lib.pt1000_sensor import ptRTD_temperature, wheatstone
+
+logger = logging.getLogger("conversion")
+
+
+class BatchConverter():
+    """Vectorized conversion of averaged ADC samples into resistances,
+    temperatures, mass flows and thermal power for all measurement channels
+
+    Calibration values of all measurement channels configured in
+    conf["measurements"]["chs"] are stored in arrays, one element per channel.
+    All conversions are elementwise numpy operations, the input arrays can
+    have arbitrary leading dimensions, e.g. for offline reprocessing of a
+    whole data log:
+
+        adc_unscaled:   (..., n_channels, 3) array of offset-corrected ADC
+                        samples for resistance reference, upstream sensor and
+                        downstream sensor input of each channel.
+                        See Measurement for the bridge circuit.
+        flow_liter_sec: (..., n_channels) volume flow for each channel
+
+    conf can be the PicalorConfig or any mapping of the same structure.
+    """
+    def __init__(self, conf, fluids=None):
+        chs = conf["measurements"]["chs"]
+        self.n_chs = len(chs)
+        adc_confs = [conf["adcs"][ch["adc_device"]] for ch in chs]
+        def ch_values(get_value):
+            return np.array([get_value(ch, adc_conf)
+                             for ch, adc_conf in zip(chs, adc_confs)], dtype=float)
+        def temp_ch_value(key, temp_ch_key):
+            return ch_values(lambda ch, adc_conf:
+                             adc_conf["temp_chs"][ch[temp_ch_key]][key])
+        # Reference channel resistance ratio
+        self.N_REF = ch_values(lambda _, adc_conf:
+                               adc_conf["r_ref"]["r_s"] / adc_conf["r_ref"]["r_ref"])
+        # Measurement channel series (bridge high-side) resistance value
+        self.r_s_up = temp_ch_value("r_s", "temp_ch_up")
+        self.r_s_dn = temp_ch_value("r_s", "temp_ch_dn")
+        # Resistance offset from instrument calibration
+        self.r_offset_up = temp_ch_value("r_offset", "temp_ch_up")
+        self.r_offset_dn = temp_ch_value("r_offset", "temp_ch_dn")
+        # Optional quadratic term from the batch calibration fit
+        self.r_quad_up = ch_values(lambda ch, adc_conf:
+                                   adc_conf["temp_chs"][ch["temp_ch_up"]].get("r_quad", 0.0))
+        self.r_quad_dn = ch_values(lambda ch, adc_conf:
+                                   adc_conf["temp_chs"][ch["temp_ch_dn"]].get("r_quad", 0.0))
+        # Platinum RTD base (0°C) resistance calibration values
+        self.r_0_up = ch_values(lambda ch, _: ch["r_0_up"])
+        self.r_0_dn = ch_values(lambda ch, _: ch["r_0_dn"])
+        # Resistance offset for wiring resistance
+        self.r_wires_up = ch_values(lambda ch, _: ch["r_wires_up"])
+        self.r_wires_dn = ch_values(lambda ch, _: ch["r_wires_dn"])
+        self.update_power_calibration(conf)
+        # Index of each channel's flow sensor
+        self.flow_sensor_idx = np.array([ch["flow_sensor"] for ch in chs], dtype=int)
+        # Flow sensor temperature might be on another channel. For each
+        # channel, this is the index into the concatenated upstream and
+        # downstream temperatures of all channels, or -1 if not available.
+        temp_srcs = (  [(ch["adc_device"], ch["temp_ch_up"]) for ch in chs]
+                     + [(ch["adc_device"], ch["temp_ch_dn"]) for ch in chs])
+        self.t_flow_src = np.array([
+            temp_srcs.index(src) if src in temp_srcs else -1
+            for src in [(ch["adc_device"], ch["flow_sensor_temp_ch"]) for ch in chs]
+        ], dtype=int)
+        # Channels grouped by fluid for vectorized fluid property evaluation
+        if fluids is None:
+            fluids = {key: Fluid(conf["fluids"][key])
+                      for key in {ch["fluid"] for ch in chs}}
+        self.fluid_groups = []
+        for key in sorted({ch["fluid"] for ch in chs}):
+            idxs = np.array([i for i, ch in enumerate(chs) if ch["fluid"] == key])
+            self.fluid_groups.append((fluids[key], idxs))
+
+    # Power calibration values can change while the measurement is running
+    def update_power_calibration(self, conf):
+        chs = conf["measurements"]["chs"]
+        self.power_gain = np.array([ch["power_gain"] for ch in chs], dtype=float)
+        self.power_offset = np.array([ch["power_offset"] for ch in chs], dtype=float)
+
+    # Returns resistances and temperatures of the upstream and downstream
+    # sensors: r_upstream, r_downstream, t_upstream, t_downstream
+    def temperatures(self, adc_unscaled):
+        adc_unscaled = np.asarray(adc_unscaled, dtype=float)
+        u_ref = adc_unscaled[..., 0]
+        u_up = adc_unscaled[..., 1]
+        u_dn = adc_unscaled[..., 2]
+        # Calculate resistances for multi-leg wheatstone bridge setup
+        # starting with upstream (cold inlet) sensor resistance value
+        r_upstream_w_offset = wheatstone(u_up, u_ref, self.N_REF, self.r_s_up)
+        r_upstream = (r_upstream_w_offset
+                      + self.r_quad_up * (r_upstream_w_offset / self.r_s_up)**2
+                      - self.r_offset_up - self.r_wires_up)
+        # Downstream sensor uses the upstream sensor as reference bridge leg
+        # Differential measurement must be added to absolute measurement
+        # to calculate the reference voltage for the second bridge setup.
+        r_downstream_w_offset = wheatstone(
+            u_dn,
+            u_up + u_ref,
+            self.r_s_up / r_upstream_w_offset,
+            self.r_s_dn
+        )
+        r_downstream = (r_downstream_w_offset
+                        + self.r_quad_dn * (r_downstream_w_offset / self.r_s_dn)**2
+                        - self.r_offset_dn - self.r_wires_dn)
+        # Inverted H.L.Callendar equation for Pt1000 temperatures
+        t_upstream = ptRTD_temperature(r_upstream, r_0=self.r_0_up)
+        t_downstream = ptRTD_temperature(r_downstream, r_0=self.r_0_dn)
+        return r_upstream, r_downstream, t_upstream, t_downstream
+
+    # Flow sensor temperatures from the channel temperatures,
+    # NaN where the flow sensor temperature channel is not measured.
+    def flow_temperatures(self, t_upstream, t_downstream):
+        t_all = np.concatenate([t_upstream, t_downstream], axis=-1)
+        t_flow = t_all[..., self.t_flow_src]
+        t_flow[..., self.t_flow_src < 0] = np.nan
+        return t_flow
+
+    # Returns mass flow and thermal power: flow_kg_sec, power_w
+    def powers(self, t_upstream, t_downstream, t_flow, flow_liter_sec):
+        t_avg = 0.5 * (t_upstream + t_downstream)
+        t_diff = t_downstream - t_upstream
+        c_th = np.empty_like(t_avg)
+        density = np.empty_like(t_avg)
+        for fluid, idxs in self.fluid_groups:
+            c_th[..., idxs] = fluid.get_c_th(t_avg[..., idxs])
+            density[..., idxs] = fluid.get_density(t_flow[..., idxs])
+        flow_kg_sec = np.asarray(flow_liter_sec, dtype=float) * density
+        power = self.power_gain * flow_kg_sec * c_th * t_diff - self.power_offset
+        return flow_kg_sec, power
+
+    # Complete conversion, returns a dictionary of all result arrays.
+    # If t_flow is None, the flow sensor temperatures are taken
+    # from the channel temperatures, see flow_temperatures().
+    def convert(self, adc_unscaled, flow_liter_sec, t_flow=None):
+        r_up, r_dn, t_up, t_dn = self.temperatures(adc_unscaled)
+        if t_flow is None:
+            t_flow = self.flow_temperatures(t_up, t_dn)
+        flow_kg_sec, power = self.powers(t_up, t_dn, t_flow, flow_liter_sec)
+        return {
+            "r_upstream": r_up,
+            "r_downstream": r_dn,
+            "t_upstream": t_up,
+            "t_downstream": t_dn,
+            "flow_kg_sec": flow_kg_sec,
+            "power_w": power,
+        }
@@ -9,6 +9,7 @@ import pigpio
 from picalor.picalor_state import PicalorState
 from picalor.picalor_api import PicalorApi
 from picalor.picalor_measurement_daemon import PicalorMeasurementDaemon
+from picalor.util_lib.simulated_hardware import SimulatedPi
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("picalor_core")
@@ -44,13 +45,13 @@ class Picalor():
         - 2x ADS1256 24-Bit 8-ch ADC
     * Waveshare "High Precision AD/DA board"
 
+    Without a pi object, simulated hardware is used if enabled in
+    the [simulation] configuration section, otherwise pigpio.pi().
+
     Ulrich Lukas 2022-08-17
     """
-    def __init__(self, pi, interactive=False):
+    def __init__(self, pi=None, interactive=False):
         logger.debug(f"Invocation thread: {threading.current_thread().name}")
-        # pigpio library is used for interfacing GPIOs and SPI communication
-        if not pi.connected:
-            raise IOError("Could not connect to hardware via pigpio library")
         self.interactive = interactive
         self.app_running = False
         atexit.register(self.stop_app)
@@ -59,6 +60,16 @@ class Picalor():
         self.poweroff_requested = threading.Event()
         # Store object representing the view- / API-facing application state
         self.state = PicalorState()
+        if pi is None:
+            sim_conf = self.state.conf.get("simulation", {})
+            if sim_conf.get("enabled", False):
+                pi = SimulatedPi(sim_conf)
+            else:
+                pi = pigpio.pi()
+        self.pi = pi
+        # pigpio library is used for interfacing GPIOs and SPI communication
+        if not pi.connected:
+            raise IOError("Could not connect to hardware via pigpio library")
         self.api = PicalorApi(self, self.state)
         self.measurement_daemon = PicalorMeasurementDaemon(pi, self.state, self.api)
 
@@ -118,12 +129,11 @@ def main():
           f"{Picalor.__doc__}\n\x1B[J\n"
           "Press CTRL-C to exit.\n"
           )
+    pc = Picalor()
     try:
-        pi = pigpio.pi()
-        pc = Picalor(pi)
         pc.run_app()
     finally:
-        pi.stop()
+        pc.pi.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,661 @@
+import os
+import time
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+
+logger = logging.getLogger("picalor_datalog")
+
+# Logged quantities, each stored as one row per measurement channel
+QUANTITIES = ("t_upstream", "t_downstream", "flow_kg_sec", "power_w")
+# Data log segment file format identifier, followed by header length
+SEGMENT_MAGIC = b"PICALOG1"
+SEGMENT_SUFFIX = ".pclog"
+
+
+class PicalorDataLog():
+    """Columnar, preallocated data log for the Picalor measurement results
+
+    Each quantity is stored in one float64 array of shape
+    (number of channels x capacity), time stamps in a float64 vector.
+    Appending a row is O(1) and does not allocate.
+
+    Overflow policy when capacity is reached:
+        "ring":  Oldest rows are overwritten (ring buffer)
+        "spill": All rows held in memory are written to a .npz file in
+                 spill_dir, then the in-memory log starts empty again.
+
+    Rows are addressed by absolute row index, i.e. the number of rows
+    appended before the respective row since the log was started.
+
+    Implementation detail: Every row is written twice, at buffer index i and
+    i + capacity. This way, the most recent rows always form a contiguous
+    slice of the buffer and all read access is done via numpy views.
+
+    If pyramid_levels is non-zero, all appended rows are also summarized
+    in a DataLogPyramid for decimated access to long time ranges.
+    """
+    def __init__(self,
+                 info,
+                 scan_interval_s,
+                 capacity=100_000,
+                 overflow="ring",
+                 spill_dir=None,
+                 segment_writer=None,
+                 pyramid_factor=16,
+                 pyramid_levels=3,
+                 ):
+        if capacity < 1:
+            raise ValueError("Data log capacity must be at least one row")
+        if overflow not in ("ring", "spill"):
+            raise ValueError(f"Invalid data log overflow policy: {overflow}")
+        if overflow == "spill" and spill_dir is None:
+            raise ValueError('Overflow policy "spill" requires a spill_dir')
+        self.info = list(info)
+        self.scan_interval_s = scan_interval_s
+        self.capacity = capacity
+        self.overflow = overflow
+        self.spill_dir = None if spill_dir is None else Path(spill_dir)
+        # Optional DataLogSegmentWriter streaming each row to disk
+        self.segment_writer = segment_writer
+        self.start_time = datetime.now().isoformat(" ", "seconds")
+        n_chs = len(self.info)
+        self._time_s = np.full(2*capacity, np.nan)
+        self._columns = {key: np.full((n_chs, 2*capacity), np.nan)
+                         for key in QUANTITIES}
+        # Buffer index where the next row is written, range(capacity)
+        self._head = 0
+        # Number of rows currently held in the buffer
+        self.n_rows = 0
+        # Total number of rows appended, i.e. absolute index of the next row
+        self.n_total = 0
+        # Number of appends started, one more than n_total while appending
+        self._n_started = 0
+        # Number of spill files written
+        self.n_spilled = 0
+        self.pyramid = None
+        if pyramid_levels > 0:
+            self.pyramid = DataLogPyramid(n_chs, capacity, pyramid_factor, pyramid_levels)
+
+    def __len__(self):
+        return self.n_rows
+
+    # Absolute row index of the oldest row held in memory
+    @property
+    def first_row(self):
+        return self.n_total - self.n_rows
+
+    # Append one row. "values" maps each of QUANTITIES
+    # to a sequence with one value per channel.
+    def append(self, time_s, values):
+        if self.n_rows == self.capacity and self.overflow == "spill":
+            try:
+                self.spill_to_file()
+            except OSError:
+                logger.error("Spilling failed, overwriting oldest rows instead")
+                self.overflow = "ring"
+        self._n_started = self.n_total + 1
+        i = self._head
+        j = i + self.capacity
+        self._time_s[i] = self._time_s[j] = time_s
+        for key, column in self._columns.items():
+            column[:, i] = column[:, j] = values[key]
+        self._head = (i + 1) % self.capacity
+        self.n_rows = min(self.n_rows + 1, self.capacity)
+        self.n_total += 1
+        if self.pyramid is not None:
+            self.pyramid.append(self._time_s[j],
+                                [column[:, j] for column in self._columns.values()])
+        if self.segment_writer is not None:
+            try:
+                self.segment_writer.write_row(
+                    self._time_s[j], [column[:, j] for column in self._columns.values()])
+            except OSError as e:
+                logger.error(f"Data log streaming to disk stopped! Error: {str(e)}")
+                self.segment_writer = None
+
+    # Flushes and closes the segment writer, if any. Data stays readable.
+    def close(self):
+        if self.segment_writer is not None:
+            self.segment_writer.close()
+            self.segment_writer = None
+
+    # Absolute row indices [start, stop) clipped to the rows held in memory
+    def _clip_rows(self, start=None, stop=None):
+        first = self.first_row
+        start = first if start is None else min(max(start, first), self.n_total)
+        stop = self.n_total if stop is None else min(max(stop, start), self.n_total)
+        return start, stop
+
+    # Buffer slice for absolute row indices [start, stop)
+    def _buffer_slice(self, start, stop):
+        # The last row held is at buffer index _head + capacity - 1
+        end = self._head + self.capacity
+        return slice(end - (self.n_total - start), end - (self.n_total - stop))
+
+    # Returns views (no copy) of time stamps and of all quantities for the
+    # absolute row indices [start, stop). Views must not be kept across appends.
+    def view(self, start=None, stop=None):
+        s = self._buffer_slice(*self._clip_rows(start, stop))
+        return self._time_s[s], {key: column[:, s]
+                                 for key, column in self._columns.items()}
+
+    # JSON-compatible dictionary of the data log for absolute row indices
+    # [start, stop). Field "row_offset" is the absolute index of the first
+    # row contained.
+    def as_dict(self, start=None, stop=None):
+        start, stop = self._clip_rows(start, stop)
+        time_s, columns = self.view(start, stop)
+        log = {
+            "start_time": self.start_time,
+            "scan_interval_s": self.scan_interval_s,
+            "info": self.info,
+            "row_offset": start,
+            "time_s": time_s.tolist(),
+        }
+        for key, column in columns.items():
+            log[key] = column.tolist()
+        return log
+
+    # Copy of the rows [start, stop) which is not affected by later appends
+    def snapshot(self, start=None, stop=None):
+        start, stop = self._clip_rows(start, stop)
+        time_s, columns = self.view(start, stop)
+        return DataLogSnapshot(self.start_time, self.scan_interval_s, self.info, start,
+                               time_s.copy(),
+                               {key: column.copy() for key, column in columns.items()})
+
+    # Not thread-safe, call from the appending thread only.
+    # Returns a reference to the rows currently held, which can be copied
+    # later from any other thread without locking, see DataLogRef.
+    def ref(self):
+        return DataLogRef(self)
+
+    # Rebuild a data log from the output of as_dict(), e.g. from a savefile
+    @classmethod
+    def from_dict(cls, log, capacity=None, overflow="ring", spill_dir=None,
+                  pyramid_factor=16, pyramid_levels=3):
+        n_rows = len(log["time_s"])
+        if capacity is None:
+            capacity = max(n_rows, 1)
+        datalog = cls(log["info"], log["scan_interval_s"], capacity, overflow, spill_dir,
+                      pyramid_factor=pyramid_factor, pyramid_levels=pyramid_levels)
+        datalog.start_time = log["start_time"]
+        datalog.n_total = log.get("row_offset", 0)
+        if datalog.pyramid is not None:
+            datalog.pyramid.row_offset = datalog.n_total
+        for i, t in enumerate(log["time_s"]):
+            datalog.append(t, {key: [ch[i] for ch in log[key]]
+                               for key in QUANTITIES})
+        return datalog
+
+    # Write all rows held in memory to a .npz file and empty the buffer
+    def spill_to_file(self):
+        time_s, columns = self.view()
+        stamp = self.start_time.replace(" ", "_")
+        filename = f"picalor_datalog_{stamp}_{self.n_spilled:04d}.npz"
+        file_obj = self.spill_dir.joinpath(filename)
+        logger.info(f"Data log full, spilling {self.n_rows} rows to: {file_obj}")
+        try:
+            np.savez(file_obj,
+                     info=np.array(self.info),
+                     row_offset=self.first_row,
+                     time_s=time_s,
+                     **columns)
+        except OSError as e:
+            logger.error(f"Could not write to file! Error: {str(e)}")
+            raise
+        self.n_spilled += 1
+        self.n_rows = 0
+        self._head = 0
+
+
+class DataLogSnapshot():
+    """Immutable copy of a range of data log rows, see PicalorDataLog.snapshot()
+
+    Serialization with as_dict() can be done from any thread.
+    """
+    def __init__(self, start_time, scan_interval_s, info, row_offset, time_s, columns):
+        self.start_time = start_time
+        self.scan_interval_s = scan_interval_s
+        self.info = info
+        self.row_offset = row_offset
+        self.time_s = time_s
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.time_s)
+
+    # Same format as PicalorDataLog.as_dict()
+    def as_dict(self):
+        log = {
+            "start_time": self.start_time,
+            "scan_interval_s": self.scan_interval_s,
+            "info": self.info,
+            "row_offset": self.row_offset,
+            "time_s": self.time_s.tolist(),
+        }
+        for key, column in self.columns.items():
+            log[key] = column.tolist()
+        return log
+
+    # Returns a snapshot of the rows of the older snapshot followed by the
+    # rows of this one if they are contiguous rows of the same data log,
+    # otherwise this snapshot is returned unchanged.
+    def merge(self, older):
+        if (older.start_time != self.start_time
+            or older.row_offset + len(older) != self.row_offset
+            ):
+            return self
+        return DataLogSnapshot(
+            self.start_time, self.scan_interval_s, self.info, older.row_offset,
+            np.concatenate([older.time_s, self.time_s]),
+            {key: np.concatenate([older.columns[key], column], axis=-1)
+             for key, column in self.columns.items()})
+
+
+class DataLogRef():
+    """Reference to the rows held by a PicalorDataLog at the time of creation
+
+    This does not copy any data. The rows can be copied with snapshot() from
+    any thread while the data log is appended concurrently, without locking:
+    The rows are copied first, then all rows which were overwritten by
+    appends started since creation of the reference are discarded from the
+    copy (ring buffer overflow), or all rows if the log was spilled to file.
+    Rows appended after creation of the reference are not included.
+    """
+    def __init__(self, log):
+        self._log = log
+        self.start_time = log.start_time
+        self.n_total = log.n_total
+        self.n_rows = log.n_rows
+        self.n_spilled = log.n_spilled
+        self._head = log._head
+
+    def __len__(self):
+        return self.n_rows
+
+    # Absolute row index of the oldest row referenced
+    @property
+    def first_row(self):
+        return self.n_total - self.n_rows
+
+    # Thread-safe. Copy of the rows for absolute row indices [start, stop)
+    # which are still valid, see above. Only the given quantities are copied,
+    # e.g. quantities=() for time stamps only.
+    def snapshot(self, start=None, stop=None, quantities=QUANTITIES):
+        log = self._log
+        first = self.first_row
+        start = first if start is None else min(max(start, first), self.n_total)
+        stop = self.n_total if stop is None else min(max(stop, start), self.n_total)
+        end = self._head + log.capacity
+        s = slice(end - (self.n_total - start), end - (self.n_total - stop))
+        time_s = log._time_s[s].copy()
+        columns = {key: log._columns[key][:, s].copy() for key in quantities}
+        # Read after copying. Each append started, including one in progress,
+        # overwrites the row at absolute index capacity rows before.
+        if log.n_spilled != self.n_spilled:
+            valid_start = stop
+        elif log.overflow == "ring":
+            valid_start = min(max(start, log._n_started - log.capacity), stop)
+        else:
+            valid_start = start
+        if valid_start > start:
+            logger.debug(f"Data log rows overwritten while copying: {valid_start - start}")
+            time_s = time_s[valid_start-start:]
+            columns = {key: column[:, valid_start-start:]
+                       for key, column in columns.items()}
+        return DataLogSnapshot(self.start_time, log.scan_interval_s, log.info,
+                               valid_start, time_s, columns)
+
+    # Thread-safe. Absolute row indices [start, stop) of the rows with time
+    # stamps t_start <= time_s < t_stop. None means no limit.
+    def time_range(self, t_start=None, t_stop=None):
+        times = self.snapshot(quantities=())
+        start, stop = _time_window(times.time_s, t_start, t_stop)
+        return times.row_offset + start, times.row_offset + stop
+
+    # Thread-safe. Decimated data log for the time range
+    # t_start <= time_s < t_stop with at most n_points points, each
+    # summarizing a bucket of consecutive rows by their minimum, maximum and
+    # mean values. Buckets are taken from the coarsest level of the
+    # DataLogPyramid needed, so this also covers rows which are no longer
+    # held in memory. Rows more recent than the last complete pyramid bucket
+    # are summarized from the rows held.
+    # Returns a JSON-compatible dictionary with keys "start_time",
+    # "scan_interval_s", "info", "rows_per_point", "time_s" (time stamp of
+    # the first row of each point), "time_last_s" (of the last row) and for
+    # each quantity, a dictionary with keys "min", "max" and "mean", each a
+    # list with one list of values per channel.
+    def decimate(self, t_start=None, t_stop=None, n_points=1000):
+        n_points = max(int(n_points), 1)
+        times = self.snapshot(quantities=())
+        start, stop = _time_window(times.time_s, t_start, t_stop)
+        raw_complete = start > 0 or times.row_offset == 0
+        start += times.row_offset
+        stop += times.row_offset
+        buckets = None
+        pyramid = self._log.pyramid
+        if pyramid is not None and not (raw_complete and stop - start <= n_points):
+            buckets = pyramid.buckets(t_start, t_stop, n_points)
+        if buckets is None:
+            # Rows held in memory, one point per row
+            t_first, t_last, stats, bucket_rows, tail_start = None, None, None, 1, start
+        else:
+            t_first, t_last, stats, bucket_rows, tail_start = buckets
+        if stop > tail_start or t_first is None:
+            tail = self.snapshot(max(tail_start, start), stop)
+            tail_stats = _row_stats(np.stack([tail.columns[key] for key in QUANTITIES]))
+            if buckets is not None and len(tail) > 0:
+                # Incomplete bucket
+                tail_stats = _reduce_stats(tail_stats, [0])
+                tail_times = tail.time_s[:1], tail.time_s[-1:]
+            else:
+                tail_times = tail.time_s, tail.time_s
+            if t_first is None:
+                t_first, t_last, stats = tail_times[0], tail_times[1], tail_stats
+            else:
+                t_first = np.concatenate([t_first, tail_times[0]])
+                t_last = np.concatenate([t_last, tail_times[1]])
+                stats = np.concatenate([stats, tail_stats], axis=-1)
+        n_group = max(-(-len(t_first) // n_points), 1)
+        if n_group > 1:
+            idx = np.arange(0, len(t_first), n_group)
+            stats = _reduce_stats(stats, idx)
+            t_first = t_first[idx]
+            t_last = t_last[np.minimum(idx + n_group, len(t_last)) - 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = stats[2] / stats[3]
+        decimated = {
+            "start_time": times.start_time,
+            "scan_interval_s": times.scan_interval_s,
+            "info": times.info,
+            "rows_per_point": bucket_rows * n_group,
+            "time_s": t_first.tolist(),
+            "time_last_s": t_last.tolist(),
+        }
+        for i, key in enumerate(QUANTITIES):
+            decimated[key] = {"min": stats[0, i].tolist(),
+                              "max": stats[1, i].tolist(),
+                              "mean": mean[i].tolist()}
+        return decimated
+
+
+class DataLogPyramid():
+    """Multi-resolution summary of all rows appended to a PicalorDataLog
+
+    Level k (k = 0 .. n_levels-1) holds buckets of factor**(k + 1)
+    consecutive rows. For each bucket, the time stamps of its first and last
+    row and, for each quantity and channel, the minimum, maximum, sum and
+    number of valid (non-NaN) values are stored.
+
+    Appending a row is O(1) amortized: Rows are collected until a level 0
+    bucket is complete, each factor complete buckets of one level are
+    combined into one bucket of the next level.
+
+    Each level holds the most recent n_buckets buckets in a ring buffer.
+    With n_buckets chosen as capacity / factor, level 0 covers about the
+    rows held by the data log and each further level a factor more, i.e.
+    the coarse levels keep the history of rows no longer held in memory.
+
+    Buckets can be copied from any thread while rows are appended, without
+    locking, using the same scheme as DataLogRef.
+    """
+    def __init__(self, n_chs, capacity=100_000, factor=16, n_levels=3):
+        if factor < 2:
+            raise ValueError("Data log pyramid factor must be at least two")
+        self.factor = int(factor)
+        # Multiple of factor, so combined buckets are contiguous
+        n_buckets = -(-max(capacity // self.factor, 1) // self.factor) * self.factor
+        self.levels = [_PyramidLevel(n_chs, self.factor**(k + 1), n_buckets)
+                       for k in range(n_levels)]
+        self._stage_time_s = np.full(self.factor, np.nan)
+        self._stage = np.full((len(QUANTITIES), n_chs, self.factor), np.nan)
+        self._n_staged = 0
+        # Absolute row index of the first row appended
+        self.row_offset = 0
+
+    # Appends one row. "columns" is a sequence with one value per channel
+    # for each of QUANTITIES.
+    def append(self, time_s, columns):
+        i = self._n_staged
+        self._stage_time_s[i] = time_s
+        for stage, values in zip(self._stage, columns):
+            stage[:, i] = values
+        self._n_staged = i + 1
+        if self._n_staged < self.factor:
+            return
+        self._n_staged = 0
+        level = self.levels[0]
+        level.append(self._stage_time_s[0], self._stage_time_s[-1],
+                     _reduce_stats(_row_stats(self._stage), [0])[..., 0])
+        for upper in self.levels[1:]:
+            if level.n_total % self.factor != 0:
+                break
+            t_first, t_last, stats = level.last_buckets(self.factor)
+            upper.append(t_first[0], t_last[-1], _reduce_stats(stats, [0])[..., 0])
+            level = upper
+
+    # Thread-safe. Copy of the buckets of the finest level which has at most
+    # n_points buckets for the time range t_start <= time_s < t_stop, and
+    # which reaches back to t_start or holds the oldest buckets of all levels.
+    # Buckets overlapping the time range are included.
+    # Returns (t_first, t_last, stats, bucket_rows, tail_start), with stats
+    # of shape (4, number of quantities, number of channels, number of
+    # buckets) for minimum, maximum, sum and valid count, and tail_start the
+    # absolute index of the first row not included in a complete bucket.
+    # Returns None if there is no complete bucket.
+    def buckets(self, t_start=None, t_stop=None, n_points=1000):
+        candidates = []
+        for level in self.levels:
+            t_first, t_last, offset, n_total = level.times()
+            if len(t_first) == 0:
+                break
+            start = 0 if t_start is None else int(np.searchsorted(t_last, t_start, "left"))
+            stop = (len(t_first) if t_stop is None
+                    else int(np.searchsorted(t_first, t_stop, "left")))
+            stop = max(stop, start)
+            complete = start > 0 or offset == 0
+            candidates.append((level, offset + start, offset + stop, n_total, complete))
+        if not candidates:
+            return None
+        oldest = min(offset for _, offset, _, _, _ in candidates)
+        covering = [c for c in candidates if c[4] or c[1] == oldest]
+        for level, start, stop, n_total, _ in covering:
+            # One more point for the incomplete bucket
+            if stop - start + 1 <= n_points:
+                break
+        buckets = level.copy(start, stop)
+        return (*buckets, level.bucket_rows, self.row_offset + n_total * level.bucket_rows)
+
+
+class _PyramidLevel():
+    def __init__(self, n_chs, bucket_rows, n_buckets):
+        self.bucket_rows = bucket_rows
+        self.n_buckets = n_buckets
+        self._t_first = np.full(n_buckets, np.nan)
+        self._t_last = np.full(n_buckets, np.nan)
+        # Minimum, maximum, sum and valid count
+        self._stats = np.full((4, len(QUANTITIES), n_chs, n_buckets), np.nan)
+        # Total number of complete buckets, i.e. absolute index of the next one
+        self.n_total = 0
+        # Number of appends started, one more than n_total while appending
+        self._n_started = 0
+
+    def append(self, t_first, t_last, stats):
+        self._n_started = self.n_total + 1
+        i = self.n_total % self.n_buckets
+        self._t_first[i] = t_first
+        self._t_last[i] = t_last
+        self._stats[..., i] = stats
+        self.n_total += 1
+
+    # Views of the last n buckets. Not thread-safe, call from appending thread.
+    def last_buckets(self, n):
+        i = self.n_total % self.n_buckets or self.n_buckets
+        s = slice(i - n, i)
+        return self._t_first[s], self._t_last[s], self._stats[..., s]
+
+    # Thread-safe. Copy of the time stamps of all valid buckets.
+    # Returns (t_first, t_last, absolute index of first bucket, n_total).
+    def times(self):
+        n_total = self.n_total
+        start = max(n_total - self.n_buckets, 0)
+        idx = np.arange(start, n_total) % self.n_buckets
+        t_first, t_last = self._t_first[idx], self._t_last[idx]
+        valid = min(self._n_valid_start(start), n_total)
+        return t_first[valid - start:], t_last[valid - start:], valid, n_total
+
+    # Thread-safe. Copy of the buckets with absolute indices [start, stop),
+    # buckets overwritten meanwhile are discarded, see DataLogRef.snapshot()
+    def copy(self, start, stop):
+        idx = np.arange(start, stop) % self.n_buckets
+        t_first, t_last, stats = self._t_first[idx], self._t_last[idx], self._stats[..., idx]
+        valid = min(self._n_valid_start(start), stop) - start
+        return t_first[valid:], t_last[valid:], stats[..., valid:]
+
+    # First absolute bucket index >= start which was not overwritten by an
+    # append started, including one in progress
+    def _n_valid_start(self, start):
+        return max(start, self._n_started - self.n_buckets)
+
+
+# Time stamps t_start <= time_s < t_stop as index range of the time_s vector
+def _time_window(time_s, t_start=None, t_stop=None):
+    # Time stamps are monotonic, see PicalorMeasurementDaemon
+    start = 0 if t_start is None else int(np.searchsorted(time_s, t_start, "left"))
+    stop = len(time_s) if t_stop is None else int(np.searchsorted(time_s, t_stop, "left"))
+    return start, max(stop, start)
+
+
+# Bucket statistics of single rows: Minimum, maximum, sum and valid count
+def _row_stats(values):
+    valid = ~np.isnan(values)
+    return np.stack([values, values, np.where(valid, values, 0.0), valid.astype(float)])
+
+
+# Combines buckets of stats along the last axis into groups starting at
+# the indices idx
+def _reduce_stats(stats, idx):
+    return np.stack([np.fmin.reduceat(stats[0], idx, axis=-1),
+                     np.fmax.reduceat(stats[1], idx, axis=-1),
+                     np.add.reduceat(stats[2], idx, axis=-1),
+                     np.add.reduceat(stats[3], idx, axis=-1)])
+
+
+class DataLogSegmentWriter():
+    """Append-only, crash-safe streaming of data log rows to disk
+
+    Rows are written into a directory of rotating segment files. Each segment
+    starts with SEGMENT_MAGIC, a little-endian uint32 header length and a
+    JSON header. The header is followed by fixed-width records of
+    little-endian float64 values: time stamp, then for each of QUANTITIES,
+    one value per channel.
+
+    The file is flushed and fsynced at most every fsync_interval_s seconds.
+    After a crash or power loss, at most this interval of data is lost and
+    an incomplete trailing record is ignored by read_segments().
+    """
+    def __init__(self,
+                 segment_dir,
+                 info,
+                 scan_interval_s,
+                 start_time,
+                 segment_rows=10_000,
+                 fsync_interval_s=10.0,
+                 ):
+        # Never append to segments of a previous data log
+        self.segment_dir = Path(segment_dir)
+        n = 1
+        while self.segment_dir.exists():
+            self.segment_dir = Path(f"{segment_dir}_{n}")
+            n += 1
+        self.segment_dir.mkdir(parents=True)
+        self.info = list(info)
+        self.scan_interval_s = scan_interval_s
+        self.start_time = start_time
+        self.segment_rows = segment_rows
+        self.fsync_interval_s = fsync_interval_s
+        self.row_width = 1 + len(QUANTITIES) * len(self.info)
+        self._row_buf = np.empty(self.row_width, dtype="<f8")
+        self._file = None
+        self._n_segment = 0
+        self._n_segment_rows = 0
+        self._n_rows = 0
+        self._t_last_sync = time.monotonic()
+
+    def write_row(self, time_s, columns):
+        if self._file is None or self._n_segment_rows >= self.segment_rows:
+            self._open_next_segment()
+        self._row_buf[0] = time_s
+        self._row_buf[1:] = np.concatenate(columns)
+        self._file.write(self._row_buf.tobytes())
+        self._n_segment_rows += 1
+        self._n_rows += 1
+        if time.monotonic() - self._t_last_sync >= self.fsync_interval_s:
+            self.sync()
+
+    def sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._t_last_sync = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def _open_next_segment(self):
+        self.close()
+        file_obj = self.segment_dir.joinpath(
+            f"segment_{self._n_segment:06d}{SEGMENT_SUFFIX}")
+        logger.debug(f"Opening new data log segment: {file_obj}")
+        header = json.dumps({
+            "start_time": self.start_time,
+            "scan_interval_s": self.scan_interval_s,
+            "info": self.info,
+            "quantities": QUANTITIES,
+            "row_offset": self._n_rows,
+        }).encode()
+        self._file = open(file_obj, "xb")
+        self._file.write(SEGMENT_MAGIC)
+        self._file.write(len(header).to_bytes(4, "little"))
+        self._file.write(header)
+        self._n_segment += 1
+        self._n_segment_rows = 0
+
+
+# Read all data log segments from segment_dir, returning a dictionary
+# in the same format as PicalorDataLog.as_dict().
+def read_segments(segment_dir):
+    log = None
+    for file_obj in sorted(Path(segment_dir).glob(f"*{SEGMENT_SUFFIX}")):
+        content = file_obj.read_bytes()
+        if content[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+            logger.error(f"Not a data log segment file: {file_obj}")
+            continue
+        pos = len(SEGMENT_MAGIC) + 4
+        header_len = int.from_bytes(content[len(SEGMENT_MAGIC):pos], "little")
+        header = json.loads(content[pos:pos+header_len])
+        pos += header_len
+        n_chs = len(header["info"])
+        row_width = 1 + len(QUANTITIES) * n_chs
+        # Incomplete trailing record from an interrupted write is ignored
+        n_rows = (len(content) - pos) // (8 * row_width)
+        rows = np.frombuffer(content, dtype="<f8", count=n_rows*row_width,
+                             offset=pos).reshape(n_rows, row_width)
+        if log is None:
+            log = {key: header[key] for key in
+                   ("start_time", "scan_interval_s", "info", "row_offset")}
+            log["time_s"] = []
+            for key in QUANTITIES:
+                log[key] = [[] for _ in range(n_chs)]
+        log["time_s"].extend(rows[:, 0].tolist())
+        for i, key in enumerate(QUANTITIES):
+            for ch in range(n_chs):
+                log[key][ch].extend(rows[:, 1 + i*n_chs + ch].tolist())
+    return log
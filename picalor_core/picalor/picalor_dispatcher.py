@@ -0,0 +1,103 @@
+import threading
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("picalor_dispatcher")
+
+# Lane of fast actions, which are run directly in the calling thread
+INLINE = "inline"
+
+
+class PicalorDispatcher():
+    """Runs API command actions on a small pool of worker threads
+
+    Each action is assigned to a lane. Actions of the INLINE lane are run
+    directly in the calling (i.e. frontend network) thread and must return
+    quickly. For all other lanes, at most lane_limits[lane] actions run
+    concurrently on the pool. Further actions of the same lane wait and
+    are started in the order they were submitted. Thus, a lane with a
+    limit of one runs its actions serialized, in order.
+
+    Lanes without a configured limit can use all worker threads.
+    """
+    def __init__(self, n_workers=4, lane_limits=None):
+        self.n_workers = max(int(n_workers), 1)
+        self.lane_limits = {} if lane_limits is None else dict(lane_limits)
+        self._lanes = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self.n_dispatched = 0
+        self.n_inline = 0
+
+    def start(self):
+        with self._lock:
+            self._lanes = {}
+            self._executor = ThreadPoolExecutor(max_workers=self.n_workers,
+                                                thread_name_prefix="API Worker")
+
+    # Thread-safe. Runs func() inline or queues it for its lane.
+    def submit(self, lane, func):
+        if lane == INLINE:
+            with self._lock:
+                self.n_inline += 1
+            self._run_guarded(func)
+            return
+        with self._lock:
+            self.n_dispatched += 1
+            state = self._lanes.get(lane)
+            if state is None:
+                limit = self.lane_limits.get(lane, self.n_workers)
+                state = self._lanes[lane] = _LaneState(max(int(limit), 1))
+            if self._executor is None:
+                raise RuntimeError("Command dispatcher is not running")
+            if state.n_running < state.limit:
+                state.n_running += 1
+                self._executor.submit(self._run_lane, state, func)
+            else:
+                state.pending.append(func)
+
+    # Waits for all running and queued actions if wait is True
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "n_dispatched": self.n_dispatched,
+                "n_inline": self.n_inline,
+                "lanes": {lane: {"n_running": state.n_running,
+                                 "n_pending": len(state.pending),
+                                 "max_pending": state.max_pending}
+                          for lane, state in self._lanes.items()},
+            }
+
+    def _run_lane(self, state, func):
+        while func is not None:
+            self._run_guarded(func)
+            # The next action of this lane is run on the same worker thread
+            with self._lock:
+                state.max_pending = max(state.max_pending, len(state.pending))
+                if state.pending:
+                    func = state.pending.popleft()
+                else:
+                    func = None
+                    state.n_running -= 1
+
+    @staticmethod
+    def _run_guarded(func):
+        try:
+            func()
+        except Exception as e:
+            logger.exception(f"Error in dispatched action.\nError: {e}")
+
+
+class _LaneState():
+    def __init__(self, limit):
+        self.limit = limit
+        self.n_running = 0
+        self.pending = deque()
+        self.max_pending = 0
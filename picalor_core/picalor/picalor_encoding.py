@@ -0,0 +1,153 @@
+import json
+import zlib
+import struct
+import logging
+import numpy as np
+from picalor.picalor_datalog import QUANTITIES, PicalorDataLog, DataLogSnapshot, DataLogRef
+from picalor.picalor_state import results_to_json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger("picalor_encoding")
+
+# Binary payload format identifier of the StructEncoder
+STRUCT_MAGIC = b"PCL1"
+# magic, schema ID, number of values, data log row offset,
+# number of data log rows, number of values per data log row
+STRUCT_HEADER_FORMAT = "<4sIIIII"
+STRUCT_HEADER_FIELDS = ("magic", "schema_id", "n_values",
+                        "row_offset", "n_rows", "row_width")
+# Row offset value if there is no data log
+STRUCT_NO_DATALOG = 0xFFFFFFFF
+
+
+class JsonEncoder():
+    """JSON text payloads, same as for the Picalor web app"""
+    name = "json"
+
+    # Returns the payload and a schema if this has changed, otherwise None
+    def encode(self, key, data):
+        return results_to_json(data), None
+
+
+class MsgpackEncoder():
+    """MessagePack binary payloads of the same structure as the JSON payloads.
+    NaN values are encoded as float NaN.
+    """
+    name = "msgpack"
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("MessagePack encoding requires the msgpack package")
+
+    def encode(self, key, data):
+        return msgpack.packb(data, default=_msgpack_default), None
+
+
+class StructEncoder():
+    """Fixed-layout little-endian binary payloads
+
+    Payload is a header with STRUCT_HEADER_FORMAT, followed by n_values
+    instantaneous values and n_rows data log rows of row_width values each,
+    all of float_format. Missing values are NaN.
+
+    The names of the instantaneous values and of the data log row values
+    are published in a JSON schema with a schema ID, which is the CRC32
+    of the schema. The schema must be re-read when a payload has a
+    different schema ID.
+    """
+    name = "struct"
+
+    def __init__(self, float_format="<f8"):
+        self.dtype = np.dtype(float_format).newbyteorder("<")
+        if self.dtype.kind != "f":
+            raise ValueError(f"Invalid float format: {float_format}")
+        # Last schema ID for each data key
+        self._schema_ids = {}
+
+    def encode(self, key, data):
+        names, values = zip(*results_values(data))
+        values = np.array([np.nan if value is None else value for value in values],
+                          dtype=self.dtype)
+        log = data["data_log"]
+        if isinstance(log, DataLogRef):
+            log = log.snapshot()
+        schema = {
+            "encoding": self.name,
+            "header_format": STRUCT_HEADER_FORMAT,
+            "header_fields": STRUCT_HEADER_FIELDS,
+            "float_format": self.dtype.str,
+            "values": list(names),
+            "data_log": None,
+        }
+        if log is None:
+            row_offset, rows = STRUCT_NO_DATALOG, np.zeros((0, 0), dtype=self.dtype)
+        else:
+            row_offset = log.row_offset
+            n_chs = len(log.info)
+            rows = np.empty((len(log), 1 + len(QUANTITIES) * n_chs), dtype=self.dtype)
+            rows[:, 0] = log.time_s
+            for i, quantity in enumerate(QUANTITIES):
+                rows[:, 1+i*n_chs:1+(i+1)*n_chs] = log.columns[quantity].T
+            schema["data_log"] = {
+                "start_time": log.start_time,
+                "scan_interval_s": log.scan_interval_s,
+                "info": log.info,
+                "row": ["time_s"] + [f"{quantity}[{ch}]" for quantity in QUANTITIES
+                                     for ch in range(n_chs)],
+            }
+        schema_json = json.dumps(schema)
+        schema_id = zlib.crc32(schema_json.encode())
+        header = struct.pack(STRUCT_HEADER_FORMAT, STRUCT_MAGIC, schema_id,
+                             len(values), row_offset, len(rows), rows.shape[1])
+        payload = header + values.tobytes() + rows.tobytes()
+        if self._schema_ids.get(key) == schema_id:
+            return payload, None
+        self._schema_ids[key] = schema_id
+        return payload, json.dumps({"schema_id": schema_id, **schema})
+
+
+# Names and values of all instantaneous results of results data.
+# Names are paths, e.g. "chs/0/power_w", also used as MQTT value topics.
+def results_values(data):
+    values = []
+    for i, ch in enumerate(data["measurements"]["chs"]):
+        for quantity in QUANTITIES:
+            values.append((f"chs/{i}/{quantity}", ch[quantity]))
+    for adc_key, adc in data["adcs"].items():
+        values.append((f"adcs/{adc_key}/r_ref/adc_unscaled",
+                       adc["r_ref"]["adc_unscaled"]))
+        for j, temp_ch in enumerate(adc["temp_chs"]):
+            for quantity in ("adc_unscaled", "resistance", "temperature"):
+                values.append((f"adcs/{adc_key}/temp_chs/{j}/{quantity}",
+                               temp_ch[quantity]))
+    for i, sensor in enumerate(data["flow_sensors"]):
+        values.append((f"flow_sensors/{i}/liter_sec", sensor["liter_sec"]))
+    return values
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, (PicalorDataLog, DataLogSnapshot)):
+        return obj.as_dict()
+    if isinstance(obj, DataLogRef):
+        return obj.snapshot().as_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+# Payload encoder from the frontend configuration. Falls back to JSON
+# if the configured encoding is not available.
+def payload_encoder(conf):
+    encoding = str(conf.get("PAYLOAD_ENCODING", "json"))
+    try:
+        if encoding == "msgpack":
+            return MsgpackEncoder()
+        elif encoding == "struct":
+            return StructEncoder(str(conf.get("STRUCT_FLOAT_FORMAT", "<f8")))
+        elif encoding != "json":
+            raise ValueError(f"Invalid payload encoding: {encoding}")
+    except (ImportError, ValueError, TypeError) as e:
+        logger.error(f"Using JSON payload encoding. Error: {e}")
+    return JsonEncoder()
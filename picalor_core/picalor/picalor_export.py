@@ -0,0 +1,144 @@
+import io
+import csv
+import gzip
+import json
+import math
+import logging
+import numpy as np
+from picalor.picalor_datalog import QUANTITIES
+
+logger = logging.getLogger("picalor_export")
+
+# Data log export file formats and file name suffixes
+EXPORT_FORMATS = {"jsonl": ".jsonl", "csv": ".csv"}
+
+
+# Writes a DataLogSnapshot as JSON in the same format as as_dict(), without
+# building the complete string. Arrays are serialized in chunks of rows.
+def write_datalog_json(f, log, chunk_rows=10_000):
+    header = {
+        "start_time": log.start_time,
+        "scan_interval_s": log.scan_interval_s,
+        "info": log.info,
+        "row_offset": log.row_offset,
+    }
+    f.write(json.dumps(header)[:-1])
+    f.write(', "time_s": ')
+    _write_json_array(f, log.time_s, chunk_rows)
+    for key, column in log.columns.items():
+        f.write(f', "{key}": [')
+        for i, ch_values in enumerate(column):
+            if i > 0:
+                f.write(", ")
+            _write_json_array(f, ch_values, chunk_rows)
+        f.write("]")
+    f.write("}")
+
+
+def _write_json_array(f, values, chunk_rows):
+    f.write("[")
+    for i in range(0, len(values), chunk_rows):
+        if i > 0:
+            f.write(", ")
+        f.write(json.dumps(values[i:i+chunk_rows].tolist())[1:-1].replace("NaN", "null"))
+    f.write("]")
+
+
+class DataLogExporter():
+    """Streaming export of data log rows into a JSON Lines or CSV file,
+    optionally gzip-compressed
+
+    Rows are copied from a DataLogRef in chunks of chunk_rows rows while the
+    data log is appended concurrently, so memory use does not depend on the
+    number of rows exported. Rows which are overwritten in the ring buffer
+    before they are copied are skipped and counted in n_skipped.
+
+    JSON Lines: The first line is a header object with keys "start_time",
+    "scan_interval_s", "info" and "quantities". Each following line is one
+    row object with keys "row", "time_s" and the quantities, each a list of
+    one value per channel. NaN values are written as null.
+
+    CSV: Header line with columns "row", "time_s" and one column for each
+    quantity and channel, named e.g. "power_w M1 (ADC1)". NaN values are
+    written as empty fields.
+    """
+    def __init__(self, fmt="jsonl", compress=False, chunk_rows=1000):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Invalid data log export format: {fmt}")
+        self.fmt = fmt
+        self.compress = compress
+        self.chunk_rows = max(int(chunk_rows), 1)
+        self.n_rows = 0
+        self.n_skipped = 0
+
+    # File name suffix for the export format
+    @property
+    def suffix(self):
+        return EXPORT_FORMATS[self.fmt] + (".gz" if self.compress else "")
+
+    # Exports rows [start, stop) of the DataLogRef log into file_obj.
+    # Returns a summary dictionary.
+    def export(self, log, file_obj, start=None, stop=None):
+        start = log.first_row if start is None else max(start, log.first_row)
+        stop = log.n_total if stop is None else min(stop, log.n_total)
+        self.n_rows = 0
+        self.n_skipped = 0
+        # Empty snapshot for the data log properties
+        header = log.snapshot(start, start, quantities=())
+        if self.compress:
+            f = gzip.open(file_obj, "wt", newline="")
+        else:
+            f = open(file_obj, "w", newline="")
+        with f:
+            if self.fmt == "csv":
+                writer = csv.writer(f)
+                writer.writerow(["row", "time_s"] + [f"{key} {info}"
+                                                     for key in QUANTITIES
+                                                     for info in header.info])
+            else:
+                f.write(json.dumps({
+                    "start_time": header.start_time,
+                    "scan_interval_s": header.scan_interval_s,
+                    "info": header.info,
+                    "quantities": QUANTITIES,
+                }) + "\n")
+            row = start
+            while row < stop:
+                chunk = log.snapshot(row, min(row + self.chunk_rows, stop))
+                self.n_skipped += chunk.row_offset - row
+                if self.fmt == "csv":
+                    self._write_csv_rows(writer, chunk)
+                else:
+                    self._write_jsonl_rows(f, chunk)
+                self.n_rows += len(chunk)
+                row = chunk.row_offset + len(chunk)
+        if self.n_skipped:
+            logger.warning(f"Data log rows overwritten during export: {self.n_skipped}")
+        return {
+            "filename": file_obj.name,
+            "format": self.fmt,
+            "compressed": self.compress,
+            "row_offset": start,
+            "n_rows": self.n_rows,
+            "n_skipped": self.n_skipped,
+        }
+
+    @staticmethod
+    def _write_jsonl_rows(f, chunk):
+        columns = {key: column.T.tolist() for key, column in chunk.columns.items()}
+        lines = io.StringIO()
+        for i, time_s in enumerate(chunk.time_s.tolist()):
+            row = {"row": chunk.row_offset + i, "time_s": time_s}
+            for key, values in columns.items():
+                row[key] = values[i]
+            lines.write(json.dumps(row))
+            lines.write("\n")
+        f.write(lines.getvalue().replace("NaN", "null"))
+
+    @staticmethod
+    def _write_csv_rows(writer, chunk):
+        values = [chunk.time_s[:, None]] + [column.T for column in chunk.columns.values()]
+        for i, row in enumerate(np.hstack(values).tolist()):
+            writer.writerow([chunk.row_offset + i]
+                            + [None if math.isnan(value) else value for value in row])
+
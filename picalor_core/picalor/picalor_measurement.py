@@ -1,9 +1,10 @@
 import logging
 import json
+import threading
+import time
+from collections import OrderedDict, deque
 import numpy as np
-from picalor.util_lib.pt1000_sensor import (
-    ptRTD_temperature, wheatstone, wheatstone_factor
-)
+from picalor.util_lib.pt1000_sensor import wheatstone_factor
 from pipyadc import ADS1256_definitions as adc_def
 
 logger = logging.getLogger("Measurement")
@@ -47,163 +48,247 @@ class Measurement():
         self.flow_sensor = flow_sensor
         self.fluid = fluid
         # These are only short-cuts to the config items
-        # Average this number of measurements
-        self.FILTER_SIZE = state.conf["measurements"]["FILTER_SIZE"]
         # Measurement configuration for this measurement channel (!= ADC channel!)
-        self.own_conf = state.conf["measurements"]["chs"][measurement_index]
+        self.measurement_index = measurement_index
+        conf = state.conf.snapshot()
+        self.own_conf = conf["measurements"]["chs"][measurement_index]
         self.adc_key = self.own_conf["adc_device"]
         logger.info(f"Configuring measurement channel: {self.own_conf['info']}")
         self.temp_ch_up = self.own_conf["temp_ch_up"]
         self.temp_ch_dn = self.own_conf["temp_ch_dn"]
         self.flow_sensor_temp_ch = self.own_conf["flow_sensor_temp_ch"]
-        adc_conf = state.conf["adcs"][self.adc_key]
+        adc_conf = conf["adcs"][self.adc_key]
         self.adc_temp_chs = adc_conf["temp_chs"]
-        # Reference channel resistance ratio
-        self.N_REF = adc_conf["r_ref"]["r_s"] / adc_conf["r_ref"]["r_ref"]
-        self.adc_mux_seq = [
-            # Resistance reference channel  first,
-              getattr(adc_def, adc_conf["r_ref"]["mux"]) << 4
-            | getattr(adc_def, adc_conf["aincom"]["mux"]),
-            # followed by the upstream temperature sensor, and
-              getattr(adc_def, self.adc_temp_chs[self.temp_ch_up]["mux"]) << 4
-            | getattr(adc_def, adc_conf["r_ref"]["mux"]),
-            # completed by the downstream sensor for the current acquisition
-              getattr(adc_def, self.adc_temp_chs[self.temp_ch_dn]["mux"]) << 4
-            | getattr(adc_def, self.adc_temp_chs[self.temp_ch_up]["mux"]),
-        ]
-        # ADC raw channel offset values. (Likely unnecessary, should be zero)
-        self.adc_offsets = np.array([
-            adc_conf["r_ref"]["adc_offset"],
-            self.adc_temp_chs[self.temp_ch_up]["adc_offset"],
-            self.adc_temp_chs[self.temp_ch_dn]["adc_offset"],
-        ])
-        # Measurement channel series (bridge high-side) resistance value
-        self.r_s_up = self.adc_temp_chs[self.temp_ch_up]["r_s"]
-        self.r_s_dn = self.adc_temp_chs[self.temp_ch_dn]["r_s"]
-        # Resistance offset from instrument calibration
-        self.r_offset_up = self.adc_temp_chs[self.temp_ch_up]["r_offset"]
-        self.r_offset_dn = self.adc_temp_chs[self.temp_ch_dn]["r_offset"]
-        # Platinum RTD base (0°C) resistance calibration values
-        self.r_0_up = self.own_conf["r_0_up"]
-        self.r_0_dn = self.own_conf["r_0_dn"]
-        # Resistance offset for wiring resistance
-        self.r_wires_up = self.own_conf["r_wires_up"]
-        self.r_wires_dn = self.own_conf["r_wires_dn"]
+        # ADC input multiplexer codes and raw channel offset values
+        self.adc_inputs = measurement_adc_inputs(adc_conf, self.own_conf)
+        # Indices of the above inputs in the sample table shared by all
+        # measurements of the same ADC. Set by AdcAcquisitionPlan.
+        self.plan_idxs = None
+        self.flow_sensor_idx = self.own_conf["flow_sensor"]
         # Results
         self.results_meas = state.results["measurements"]["chs"][measurement_index]
         self.results_adc = state.results["adcs"][self.adc_key]
         self.results_adc_temp_chs = state.results["adcs"][self.adc_key]["temp_chs"]
-        self.results_log = state.results["data_log"]
-        # Buffer for raw input samples.
-        # For each measurement channel, three samples are acquired in succession:
-        # resistance reference -> upstream Pt1000 sensor -> downstream Pt1000 sensor
-        self.adc_buf = np.zeros((self.FILTER_SIZE, 3), dtype=int)
-
-    def scan_sensors(self):
-        # To be called repeatedly to update adc_buf with new ADC samples and
-        # calculate results with averaged data.
-        self.adc_obj.read_sequence(self.adc_mux_seq, self.adc_buf[0])
-        for j in range(1, self.FILTER_SIZE):
-            # Do the data acquisition of the multiplexed input channels
-            self.adc_obj.read_continue(self.adc_mux_seq, self.adc_buf[j])
-    
-        # Average of input samples without offset correction
-        adc_avg = np.average(self.adc_buf, axis=0)
-        # Elementwise operation (np.array):
-        adc_unscaled = adc_avg - self.adc_offsets
-
-        # Calculate resistances for multi-leg wheatstone bridge setup
-        # starting with upstream (cold inlet) sensor resistance value
-        r_upstream_w_offset = wheatstone(
-            adc_unscaled[1],
-            adc_unscaled[0],
-            self.N_REF,
-            self.r_s_up
-        )
-        r_upstream = r_upstream_w_offset - self.r_offset_up - self.r_wires_up
-
-        # Downstream sensor uses the upstream sensor as reference bridge leg
-        # Differential measurement must be added to absolute measurement
-        # to calculate the reference voltage for the second bridge setup.
-        r_downstream = wheatstone(
-            adc_unscaled[2],
-            adc_unscaled[1] + adc_unscaled[0],
-            self.r_s_up / r_upstream_w_offset,
-            self.r_s_dn
-        ) - self.r_offset_dn - self.r_wires_dn
-        # Write results to state
+
+    # Called with the averaged and offset-corrected ADC samples for the
+    # resistance reference, upstream and downstream sensor inputs and with
+    # the results of the conversion by the BatchConverter.
+    def write_temperatures(self, adc_unscaled, r_upstream, r_downstream,
+                           t_upstream, t_downstream):
         self.results_adc["r_ref"]["adc_unscaled"] = adc_unscaled[0]
         self.results_adc_temp_chs[self.temp_ch_up]["adc_unscaled"] = adc_unscaled[1]
         self.results_adc_temp_chs[self.temp_ch_dn]["adc_unscaled"] = adc_unscaled[2]
         self.results_adc_temp_chs[self.temp_ch_up]["resistance"] = r_upstream
         self.results_adc_temp_chs[self.temp_ch_dn]["resistance"] = r_downstream
-        # Calculate temperatures from Pt1000 sensor resistances
-        # Inverted H.L.Callendar equation for Pt1000 temperatures:
-        t_upstream = ptRTD_temperature(r_upstream, r_0=self.r_0_up)
-        t_downstream = ptRTD_temperature(r_downstream, r_0=self.r_0_dn)
         self.results_adc_temp_chs[self.temp_ch_up]["temperature"] = t_upstream
         self.results_adc_temp_chs[self.temp_ch_dn]["temperature"] = t_downstream
         self.results_meas["t_upstream"] = t_upstream
         self.results_meas["t_downstream"] = t_downstream
-    
-    def calculate_power(self):
-        t_upstream = self.results_meas["t_upstream"]
-        t_downstream = self.results_meas["t_downstream"]
-        # Flow sensor temperature might be on another channel
-        t_flow = self.results_adc_temp_chs[self.flow_sensor_temp_ch]["temperature"]
-        # Own calibration values
-        power_offset = self.own_conf["power_offset"]
-        power_gain = self.own_conf["power_gain"]
-        # Calculate power
-        t_avg = 0.5 * (t_upstream + t_downstream)
-        c_th = self.fluid.get_c_th(t_avg)
-        t_diff = t_downstream - t_upstream
-        flow_liter_sec = self.flow_sensor.read_liter_sec()
-        flow_kg_sec = flow_liter_sec * self.fluid.get_density(t_flow)
-        # Write results back to application state
-        power = power_gain * flow_kg_sec * c_th * t_diff - power_offset
+
+    # Flow sensor temperature might be on another channel
+    def get_flow_sensor_temperature(self):
+        return self.results_adc_temp_chs[self.flow_sensor_temp_ch]["temperature"]
+
+    def write_power(self, flow_kg_sec, power):
         self.results_meas["flow_kg_sec"] = flow_kg_sec
         self.results_meas["power_w"] = power
 
     def set_power_offset(self, offset):
-        self.own_conf["power_offset"] = offset
+        self.state.conf.set_item(
+            ("measurements", "chs", self.measurement_index, "power_offset"), offset)
 
     def set_power_gain(self, gain):
-        self.own_conf["power_gain"] = gain
+        self.state.conf.set_item(
+            ("measurements", "chs", self.measurement_index, "power_gain"), gain)
 
     def tare_power(self):
         logger.debug("Performing Zero-Calibration for measurement:\n"
                      f"{self.own_conf['info']}")
         power = self.results_meas["power_w"]
-        self.own_conf["power_offset"] += power
-        logger.debug(f"New offset:    {self.own_conf['power_offset']: 12.3f}")
+        if power is None or np.isnan(power):
+            logger.warning("No power value, zero calibration skipped")
+            return
+        ch_conf = self.state.conf.snapshot()["measurements"]["chs"][self.measurement_index]
+        offset = ch_conf["power_offset"] + power
+        self.set_power_offset(offset)
+        logger.debug(f"New offset:    {offset: 12.3f}")
+
+
+# ADC input multiplexer codes and raw channel offset values for one
+# measurement channel. (Offsets are likely unnecessary, should be zero)
+def measurement_adc_inputs(adc_conf, ch_conf):
+    temp_chs = adc_conf["temp_chs"]
+    temp_ch_up = temp_chs[ch_conf["temp_ch_up"]]
+    temp_ch_dn = temp_chs[ch_conf["temp_ch_dn"]]
+    return [
+        # Resistance reference channel  first,
+        (  getattr(adc_def, adc_conf["r_ref"]["mux"]) << 4
+         | getattr(adc_def, adc_conf["aincom"]["mux"]),
+         adc_conf["r_ref"]["adc_offset"]),
+        # followed by the upstream temperature sensor, and
+        (  getattr(adc_def, temp_ch_up["mux"]) << 4
+         | getattr(adc_def, adc_conf["r_ref"]["mux"]),
+         temp_ch_up["adc_offset"]),
+        # completed by the downstream sensor for the current acquisition
+        (  getattr(adc_def, temp_ch_dn["mux"]) << 4
+         | getattr(adc_def, temp_ch_up["mux"]),
+         temp_ch_dn["adc_offset"]),
+    ]
 
 
 class Fluid():
+    """Temperature-dependent thermal fluid properties
+
+    Each property is configured either as a rational polynomial or as a
+    table for piecewise linear interpolation. The configuration is compiled
+    once into cached numpy coefficient arrays, which are only re-compiled by
+    update() when the fluid configuration has changed.
+
+    Evaluation works for scalar or numpy array temperature arguments.
+    """
     def __init__(self, fluid_conf):
-        self.conf = fluid_conf
+        self.conf = None
+        self.update(fluid_conf)
+
+    # Re-compile evaluators if fluid_conf has changed. Returns True if changed.
+    def update(self, fluid_conf):
+        # Plain Python copy for comparison and for evaluation
+        conf = json.loads(json.dumps(fluid_conf))
+        if conf == self.conf:
+            return False
+        self.conf = conf
+        self._density = self._compile("density")
+        self._c_th = self._compile("c_th")
+        return True
 
     # Fluid density depending on temperature in degrees celsius
     def get_density(self, t_celsius):
-        if self.conf["density_use_polynomial"]:
-            d_num = np.poly1d(self.conf["density_numerator"])
-            d_denom = np.poly1d(self.conf["density_denominator"])
-            return d_num(t_celsius) / d_denom(t_celsius)
-        else:
-            d_t_ref = self.conf["density_t_ref"]
-            d_values = self.conf["density_values"]
-            return np.interp(t_celsius, d_t_ref, d_values)
+        return self._density(t_celsius)
 
     # Specific heat capacity
     def get_c_th(self, t_celsius):
-        if self.conf["c_th_use_polynomial"]:
-            c_num = np.poly1d(self.conf["c_th_numerator"])
-            c_denom = np.poly1d(self.conf["c_th_denominator"])
-            return c_num(t_celsius) / c_denom(t_celsius)
+        return self._c_th(t_celsius)
+
+    # Returns an evaluator function for the property with config key prefix
+    def _compile(self, prefix):
+        if self.conf[f"{prefix}_use_polynomial"]:
+            numerator = np.array(self.conf[f"{prefix}_numerator"], dtype=float)
+            denominator = np.array(self.conf[f"{prefix}_denominator"], dtype=float)
+            # np.polyval uses Horner's scheme
+            return lambda t: np.polyval(numerator, t) / np.polyval(denominator, t)
         else:
-            c_t_ref = self.conf["c_th_t_ref"]
-            c_values = self.conf["c_th_values"]
-            return np.interp(t_celsius, c_t_ref, c_values)
+            t_ref = np.array(self.conf[f"{prefix}_t_ref"], dtype=float)
+            values = np.array(self.conf[f"{prefix}_values"], dtype=float)
+            return lambda t: np.interp(t, t_ref, values)
+
+
+class CalibrationJob():
+    """Acquisition of one calibration point for one temperature channel,
+    i.e. with one calibration resistance attached, see Calibrator.
+
+    Status is one of: "queued", "running", "done", "cancelled", "failed"
+    """
+    def __init__(self, job_id, adc_key, temp_ch_idx, value_key, cal_resistance,
+                 n_samples, response_cmd=None):
+        self.job_id = job_id
+        self.adc_key = adc_key
+        self.temp_ch_idx = temp_ch_idx
+        self.value_key = value_key
+        self.cal_resistance = cal_resistance
+        self.n_samples = n_samples
+        # Command which is responded to when the job is finished, if any
+        self.response_cmd = response_cmd
+        self.status = "queued"
+        self.n_acquired = 0
+        self.message = ""
+        # Calibration values written to the configuration
+        self.result = None
+        self.cancel_requested = False
+        self.finished = threading.Event()
+
+    def as_dict(self):
+        return {
+            "job_id": self.job_id,
+            "type": "two_point",
+            "adc_key": self.adc_key,
+            "temp_ch_idx": self.temp_ch_idx,
+            "value_key": self.value_key,
+            "cal_resistance": self.cal_resistance,
+            "status": self.status,
+            "progress": self.n_acquired / self.n_samples,
+            "message": self.message,
+            "result": self.result,
+        }
+
+
+class BatchCalibrationJob():
+    """Acquisition of one calibration point for each of a number of
+    temperature channels, possibly on several ADC devices, see Calibrator.
+
+    points is a list of dictionaries with keys "adc_key", "temp_ch_idx" and
+    "cal_resistance". The channels of each ADC device are acquired together
+    in one multiplexer sequence. Each point is added to the "cal_points" of
+    its temperature channel configuration, then r_s, r_offset and r_quad are
+    fitted for all channels of the batch which have enough points.
+
+    Status is one of: "queued", "running", "done", "cancelled", "failed"
+    """
+    def __init__(self, job_id, points, n_samples, fit_quadratic=False,
+                 clear_points=False, response_cmd=None):
+        self.job_id = job_id
+        self.points = points
+        self.adc_keys = list(dict.fromkeys(point["adc_key"] for point in points))
+        # Number of samples for each ADC device
+        self.n_samples = n_samples
+        self.fit_quadratic = fit_quadratic
+        # If True, previous calibration points of the channels are discarded
+        self.clear_points = clear_points
+        self.response_cmd = response_cmd
+        self.status = "queued"
+        self.n_acquired = 0
+        self.message = ""
+        # Fit results for each channel of the batch
+        self.result = None
+        self.cancel_requested = False
+        self.finished = threading.Event()
+
+    def as_dict(self):
+        return {
+            "job_id": self.job_id,
+            "type": "batch",
+            "points": self.points,
+            "fit_quadratic": self.fit_quadratic,
+            "status": self.status,
+            "progress": self.n_acquired / (self.n_samples * len(self.adc_keys)),
+            "message": self.message,
+            "result": self.result,
+        }
+
+
+# Least-squares fit of the channel calibration values for a list of
+# calibration points [cal_resistance, wheatstone_factor], model is:
+#     cal_resistance = r_s * wh + r_quad * wh**2 - r_offset
+# Returns dictionary of r_s, r_offset, r_quad and the residuals in Ohms.
+def fit_calibration(cal_points, quadratic=False):
+    points = np.array(cal_points, dtype=float).reshape(-1, 2)
+    r_cal, wh = points[:, 0], points[:, 1]
+    columns = [wh, -np.ones_like(wh)]
+    if quadratic:
+        columns.append(wh**2)
+    design = np.stack(columns, axis=-1)
+    if len(points) < design.shape[1]:
+        raise ValueError(f"Need at least {design.shape[1]} calibration points, "
+                         f"got {len(points)}")
+    coeffs, *_ = np.linalg.lstsq(design, r_cal, rcond=None)
+    residuals = r_cal - design @ coeffs
+    return {
+        "r_s": float(coeffs[0]),
+        "r_offset": float(coeffs[1]),
+        "r_quad": float(coeffs[2]) if quadratic else 0.0,
+        "residuals": residuals.tolist(),
+        "rms_residual": float(np.sqrt(np.mean(residuals**2))),
+        "max_residual": float(np.max(np.abs(residuals))),
+    }
 
 
 class Calibrator():
@@ -220,143 +305,365 @@ class Calibrator():
            r_ref     pt1000_up
              |           |
               ___________ ADC_AINCOM (0V)
+
+    Calibration jobs are queued from the API and run one after the other on
+    a background thread. Each job has exclusive access to its ADC device,
+    while the other ADC devices are scanned normally. Measurements on the
+    ADC device being calibrated output NaN values for the duration of the job.
+
+    Batch jobs acquire calibration points for many temperature channels at
+    once and fit the calibration values by least squares, see
+    BatchCalibrationJob and fit_calibration().
+
+    Status of all recent jobs is published on the "calibration" data key
+    when a job is queued, started or finished, and while it makes progress
+    at most every PROGRESS_INTERVAL_S seconds.
     """
+    # Number of finished jobs kept for status queries
+    MAX_FINISHED_JOBS = 20
+    # Minimum time between publishing job progress
+    PROGRESS_INTERVAL_S = 1.0
+
     def __init__(self, meas_daemon, state, api):
         self.meas_daemon = meas_daemon
         self.state = state
         self.api = api
-        self.FILTER_SIZE = state.conf["measurements"]["FILTER_SIZE"]
-        # Buffer for raw input samples. First, resistance reference is sampled,
-        # then, the attached calibration standard is sampled
-        self.adc_buf = np.zeros((self.FILTER_SIZE, 2), dtype=int)
-    
-    # This is called from the API.
-    # calibration data for the requested temperature channel has been acquired
-    # and calibration results have been written back to state.conf.
-    def calibrate_channel(self, adc_key, temp_ch_idx, value_key, cal_resistance):
-        msg = ""
-        if cal_resistance < 0.0 or value > 10000.0:
-            msg = f"Cal resistance must be between 0.0 and 10000.0!"
-        if not value_key in ("cal_r_a", "cal_r_b"):
-            msg = f"Invalid resistance value key: {value_key}"
-        if not adc_key in self.state.conf["adcs"].keys():
-            msg = f"Invalid ADC key: {adc_key}"
-        if not temp_ch_idx in range(7):
-            msg = f"Invalid temp channel index: {temp_ch_idx}"
-        if self.meas_daemon.calibration_mode_enabled.is_set():
-            msg = "Calibration already in process. Please wait!"
-        if msg:
-            logger.error(msg)
-            self.api.send_response("calibrate_temp_channel", msg, False)
-            self.api.push_error_str(msg)
-            return
-        # Instance data required by measurement_thread_acquire_cal_data()
-        self.adc_key = adc_key
-        self.temp_ch_idx = temp_ch_idx
-        self.value_key = value_key
-        # Get calibration resistor value and current calibration state
-        # from config. Config must be populated with resistance value in advance.
-        self.state.config_update_lock.acquire()
-        temp_ch_conf = self.state.conf["adcs"][adc_key]["temp_chs"][temp_ch_idx]
-        temp_ch_conf[value_key] = cal_resistance
-        wh_a = temp_ch_conf["cal_wh_a"]
-        wh_b = temp_ch_conf["cal_wh_b"]
-        # If both channels have previous calibration results,
-        # first invalidate old calibration.
-        # Zero would evaluate as false, so no direct comparison
-        if False not in (wh_a, wh_b):
-            temp_ch_conf["cal_wh_a"] = False
-            temp_ch_conf["cal_wh_b"] = False
-        self.state.config_update_lock.release()
-        logger.debug(f"Got current calibration values: {wh_a} and {wh_b}")
-        # If both channels have previous calibration results,
-        # first invalidate old calibration
+        self._jobs = OrderedDict()
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._next_job_id = 1
+        self._stop_requested = False
+        self._thread_obj = None
+        self._t_last_push = 0.0
+
+    # Thread-safe, called from the API. Validates the calibration arguments
+    # and queues a new job. Returns the job status dictionary.
+    def start_job(self, cal_args, response_cmd=None):
+        adc_key = cal_args["adc_key"]
+        temp_ch_idx = cal_args["temp_ch_idx"]
+        value_key = cal_args["value_key"]
+        cal_resistance = float(cal_args["cal_resistance"])
+        conf = self.state.conf.snapshot()
+        adcs_conf = conf["adcs"]
+        if adc_key not in adcs_conf.keys():
+            raise ValueError(f"Invalid ADC key: {adc_key}")
+        if temp_ch_idx not in range(len(adcs_conf[adc_key]["temp_chs"])):
+            raise ValueError(f"Invalid temp channel index: {temp_ch_idx}")
+        meas_conf = conf["measurements"]
+        n_samples = int(meas_conf.get("calibration_samples", meas_conf["FILTER_SIZE"]))
+        if value_key not in ("cal_r_a", "cal_r_b"):
+            raise ValueError(f"Invalid resistance value key: {value_key}")
+        if not 0.0 <= cal_resistance <= 10000.0:
+            raise ValueError("Cal resistance must be between 0.0 and 10000.0!")
+        with self._cond:
+            job = CalibrationJob(self._next_job_id, adc_key, temp_ch_idx, value_key,
+                                 cal_resistance, max(n_samples, 1), response_cmd)
+            self._queue_job(job)
+        logger.info(f"Calibration job {job.job_id} queued for ADC: {adc_key}, "
+                    f"temp channel: {temp_ch_idx}, value: {value_key}")
+        self._push_status()
+        return job.as_dict()
+
+    # Thread-safe, called from the API. cal_args is a dictionary with keys:
+    #   "points":   List of {"adc_key", "temp_ch_idx", "cal_resistance"}
+    #   "fit_quadratic":    Optional, default from configuration
+    #   "clear_points":     Optional, discard previous points of the channels
+    # Returns the job status dictionary.
+    def start_batch_job(self, cal_args, response_cmd=None):
+        points = []
+        conf = self.state.conf.snapshot()
+        adcs_conf = conf["adcs"]
+        for point in cal_args["points"]:
+            adc_key = point["adc_key"]
+            temp_ch_idx = point["temp_ch_idx"]
+            cal_resistance = float(point["cal_resistance"])
+            if adc_key not in adcs_conf.keys():
+                raise ValueError(f"Invalid ADC key: {adc_key}")
+            if temp_ch_idx not in range(len(adcs_conf[adc_key]["temp_chs"])):
+                raise ValueError(f"Invalid temp channel index: {temp_ch_idx}")
+            if not 0.0 <= cal_resistance <= 10000.0:
+                raise ValueError("Cal resistance must be between 0.0 and 10000.0!")
+            # Only one calibration standard can be attached to a channel
+            if any(p["adc_key"] == adc_key and p["temp_ch_idx"] == temp_ch_idx
+                   for p in points):
+                raise ValueError(f"Duplicate channel: {adc_key}, {temp_ch_idx}")
+            points.append({"adc_key": adc_key, "temp_ch_idx": temp_ch_idx,
+                           "cal_resistance": cal_resistance})
+        meas_conf = conf["measurements"]
+        n_samples = int(meas_conf.get("calibration_samples", meas_conf["FILTER_SIZE"]))
+        fit_quadratic = bool(cal_args.get(
+            "fit_quadratic", meas_conf.get("calibration_fit_quadratic", False)))
+        if not points:
+            raise ValueError("No calibration points given")
+        with self._cond:
+            job = BatchCalibrationJob(self._next_job_id, points, max(n_samples, 1),
+                                      fit_quadratic,
+                                      bool(cal_args.get("clear_points", False)),
+                                      response_cmd)
+            self._queue_job(job)
+        logger.info(f"Batch calibration job {job.job_id} queued for "
+                    f"{len(points)} channels on ADCs: {job.adc_keys}")
+        self._push_status()
+        return job.as_dict()
+
+    # Thread-safe. Queued jobs are cancelled immediately, running jobs
+    # after the ADC sample currently acquired.
+    def cancel_job(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                raise ValueError(f"No such calibration job: {job_id}")
+            job.cancel_requested = True
+            if job in self._queue:
+                self._queue.remove(job)
+                self._finish_job(job, "cancelled", "Cancelled before start")
+        self._push_status()
+        return job.as_dict()
+
+    # Thread-safe. Cancels all jobs and waits until the ADC is released.
+    def cancel_all(self, message="Cancelled", timeout=30):
+        with self._cond:
+            for job in self._queue:
+                job.cancel_requested = True
+                self._finish_job(job, "cancelled", message)
+            self._queue.clear()
+            running = [job for job in self._jobs.values() if job.status == "running"]
+            for job in running:
+                job.cancel_requested = True
+                job.message = message
+        for job in running:
+            job.finished.wait(timeout)
+
+    def stop(self, timeout=30):
+        self.cancel_all("Calibrator stopped", timeout)
+        with self._cond:
+            self._stop_requested = True
+            self._cond.notify()
+            thread_obj = self._thread_obj
+            self._thread_obj = None
+        if thread_obj is not None:
+            thread_obj.join(timeout)
+
+    # Thread-safe. Status of the queued, running and recent finished jobs
+    def jobs_json(self):
+        with self._cond:
+            return json.dumps([job.as_dict() for job in self._jobs.values()])
+
+    def _push_status(self):
+        self._t_last_push = time.monotonic()
+        self.api.push_calibration_status(self.jobs_json())
+
+    # Calibration thread only. Publishes the status if PROGRESS_INTERVAL_S
+    # has elapsed since it was last published.
+    def _push_progress(self):
+        if time.monotonic() - self._t_last_push >= self.PROGRESS_INTERVAL_S:
+            self._push_status()
+
+    # Must be called with self._cond held
+    def _queue_job(self, job):
+        self._next_job_id += 1
+        self._jobs[job.job_id] = job
+        self._queue.append(job)
+        if self._thread_obj is None:
+            self._stop_requested = False
+            self._thread_obj = threading.Thread(
+                target=self._calibration_thread, name="Calibration Thread",
+                daemon=True)
+            self._thread_obj.start()
+        self._cond.notify()
+
+    # Must be called with self._cond held
+    def _finish_job(self, job, status, message=""):
+        job.status = status
+        if message:
+            job.message = message
+        job.finished.set()
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished.is_set()]
+        for job_id in finished[:-self.MAX_FINISHED_JOBS]:
+            del self._jobs[job_id]
+
+    def _calibration_thread(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stop_requested:
+                    self._cond.wait()
+                if self._stop_requested:
+                    return
+                job = self._queue.popleft()
+                job.status = "running"
+            self._push_status()
+            try:
+                if isinstance(job, BatchCalibrationJob):
+                    self._run_batch_job(job)
+                else:
+                    self._run_job(job)
+                status = "cancelled" if job.cancel_requested else "done"
+            except Exception as e:
+                logger.exception(f"Calibration job {job.job_id} failed")
+                status, job.message = "failed", str(e)
+            with self._cond:
+                self._finish_job(job, status, job.message or status.capitalize())
+            self._push_status()
+            if job.response_cmd is not None:
+                if status == "done" and isinstance(job, BatchCalibrationJob):
+                    self.api.send_response(job.response_cmd, json.dumps(job.as_dict()))
+                elif status == "done":
+                    adcs_json = json.dumps(self.state.conf.snapshot()["adcs"])
+                    self.api.send_response(job.response_cmd, adcs_json)
+                else:
+                    self.api.send_response(job.response_cmd,
+                                           json.dumps(f"Calibration {status}: {job.message}"),
+                                           False)
+
+    # Acquires the calibration data and writes the results into state.conf
+    def _run_job(self, job):
         logger.info(
-            f"Acquiring calibration data for resistance value: {cal_resistance}\n"
-            f"ADC: ({adc_key},  temp channel: {temp_ch_idx}, value: {value_key})"
+            f"Acquiring calibration data for resistance value: {job.cal_resistance}\n"
+            f"ADC: ({job.adc_key},  temp channel: {job.temp_ch_idx}, "
+            f"value: {job.value_key})"
         )
-        # This blocks until data is acquired.
-        # Makes the measurement deamon thread acquire data and
-        # write cal_wh_a and cal_wh_b directly into state.conf.
-        self._trigger_acquisition_wait_for_data()
-        # Read newly acquired data values
-        self.state.config_update_lock.acquire()
-        wh_a = temp_ch_conf["cal_wh_a"]
-        wh_b = temp_ch_conf["cal_wh_b"]
-        self.state.config_update_lock.release()
-        # Calculate calibration results and write to state.conf
-        logger.info(f"New calibration values: {wh_a} and {wh_b}")
-        if False in (wh_a, wh_b):
-            logger.info(f"Need second calibration result for channel")
-            self.api.send_response("calibrate__temp_channel",
-                                    json.dumps(self.state.conf["adcs"])
-                                    )
+        with self.state.config_update_lock:
+            adc_conf = self.state.conf["adcs"][job.adc_key]
+            temp_ch_conf = adc_conf["temp_chs"][job.temp_ch_idx]
+            N_REF = adc_conf["r_ref"]["r_s"] / adc_conf["r_ref"]["r_ref"]
+            adc_mux_seq = [
+                # Resistance reference channel  first,
+                  getattr(adc_def, adc_conf["r_ref"]["mux"]) << 4
+                | getattr(adc_def, adc_conf["aincom"]["mux"]),
+                # followed by the temperature sensor channel
+                  getattr(adc_def, temp_ch_conf["mux"]) << 4
+                | getattr(adc_def, adc_conf["r_ref"]["mux"]),
+            ]
+            adc_offsets = np.array([
+                adc_conf["r_ref"]["adc_offset"],
+                temp_ch_conf["adc_offset"]
+            ])
+        # First, resistance reference is sampled,
+        # then, the attached calibration standard is sampled
+        adc_avg = self._acquire(job, job.adc_key, adc_mux_seq, job.n_samples)
+        if adc_avg is None:
             return
-        # If this is the second calibration point for the calibration procedure
-        try:
-            self.state.config_update_lock.acquire()
+        # Elementwise operation (np.array):
+        adc_unscaled = adc_avg - adc_offsets
+        # Calculate resistances for wheatstone bridge setup
+        wh_factor = float(wheatstone_factor(adc_unscaled[1], adc_unscaled[0], N_REF))
+        other_key = "cal_wh_b" if job.value_key == "cal_r_a" else "cal_wh_a"
+        wh_key = "cal_wh_a" if job.value_key == "cal_r_a" else "cal_wh_b"
+        with self.state.config_update_lock:
+            # Configuration might have been replaced during the acquisition
+            temp_ch_conf = self.state.conf["adcs"][job.adc_key]["temp_chs"][job.temp_ch_idx]
+            temp_ch_conf[job.value_key] = job.cal_resistance
+            # If both channels have previous calibration results, the old
+            # calibration is invalidated and this is the first new point.
+            # Zero would evaluate as false, so no direct comparison
+            if (temp_ch_conf["cal_wh_a"] is not False
+                and temp_ch_conf["cal_wh_b"] is not False
+                ):
+                temp_ch_conf[other_key] = False
+            logger.debug(f"Setting wheatstone factor {wh_key}: {wh_factor}")
+            temp_ch_conf[wh_key] = wh_factor
+            job.result = {wh_key: wh_factor}
+            if temp_ch_conf[other_key] is False:
+                self.state.conf.refresh_snapshot()
+                logger.info(f"Need second calibration result for channel")
+                return
+            # If this is the second calibration point for the calibration procedure
+            wh_a = temp_ch_conf["cal_wh_a"]
+            wh_b = temp_ch_conf["cal_wh_b"]
             r_a = temp_ch_conf["cal_r_a"]
             r_b = temp_ch_conf["cal_r_b"]
             r_s = (r_a - r_b) / (wh_a - wh_b)
             r_offset = r_s * wh_a - r_a
             temp_ch_conf["r_s"] = r_s
             temp_ch_conf["r_offset"] = r_offset
-            self.state.config_update_lock.release()
-            logger.debug(f"r_s: {r_s},  r_offset: {r_offset}")
-            self.api.send_response("calibrate__temp_channel",
-                                    json.dumps(self.state.conf["adcs"])
-                                    )
-        except Exception as e:
-            self.state.config_update_lock.release()
-            logger.exception(e)
-            self.api.send_response("calibrate__temp_channel",
-                                   json.dumps(str(e)),
-                                   False
-                                   )
-
-    # Called from measurement thread when its self.calibration_mode_enabled is set.
-    def measurement_thread_acquire_cal_data(self):
-        logger.debug(f"{self.adc_key},  {self.temp_ch_idx},  {self.value_key}:  "
-                     "Acquiring calibration data"
-                     )
-        adc_obj = self.meas_daemon.adc_objs[self.adc_key]
-        adc_conf = self.state.conf["adcs"][self.adc_key]
-        adc_temp_ch_conf = adc_conf["temp_chs"][self.temp_ch_idx]
-        N_REF = adc_conf["r_ref"]["r_s"] / adc_conf["r_ref"]["r_ref"]
-        adc_mux_seq = [
-            # Resistance reference channel  first,
-              getattr(adc_def, adc_conf["r_ref"]["mux"]) << 4
-            | getattr(adc_def, adc_conf["aincom"]["mux"]),
-            # followed by the temperature sensor channel
-              getattr(adc_def, adc_temp_ch_conf["mux"]) << 4
-            | getattr(adc_def, adc_conf["r_ref"]["mux"]),
-        ]
-        adc_offsets = np.array([
-            adc_conf["r_ref"]["adc_offset"],
-            adc_temp_ch_conf["adc_offset"]
-        ])
-        # From now, update adc_buf cyclically with new ADC samples and
-        # calculate results with averaged data.
-        adc_obj.read_sequence(adc_mux_seq, self.adc_buf[0])
-        for j in range(1, self.FILTER_SIZE):
-            # Do the data acquisition of the multiplexed input channels
-            adc_obj.read_continue(adc_mux_seq, self.adc_buf[j])
-        # Average of input samples without offset correction
-        adc_avg = np.average(self.adc_buf, axis=0)
-        # Elementwise operation (np.array):
-        adc_unscaled = adc_avg - adc_offsets
-        # Calculate resistances for wheatstone bridge setup
-        wh_factor = wheatstone_factor(adc_unscaled[1], adc_unscaled[0], N_REF)
-        if self.value_key == "cal_r_a":
-            logger.debug(f"Setting wheatstone factor cal_wh_a: {wh_factor}")
-            adc_temp_ch_conf["cal_wh_a"] = wh_factor
-        else:
-            logger.debug(f"Setting wheatstone factor cal_wh_b: {wh_factor}")
-            adc_temp_ch_conf["cal_wh_b"] = wh_factor
-
-    def _trigger_acquisition_wait_for_data(self):
-        self.meas_daemon.cal_data_ready.clear()
-        self.meas_daemon.calibration_mode_enabled.set()
-        if not self.meas_daemon.cal_data_ready.wait(timeout=30):
-            logger.error("Timeout in _trigger_acquisition_wait_for_data!")
-        # meas_daemon.calibration_mode_enabled is cleared in mesurement thread
\ No newline at end of file
+            # Quadratic term is only set by the batch calibration fit
+            if "r_quad" in temp_ch_conf:
+                temp_ch_conf["r_quad"] = 0.0
+            job.result.update({"r_s": r_s, "r_offset": r_offset})
+            self.state.conf.refresh_snapshot()
+        # New calibration values are applied by setting up the measurements new
+        self.meas_daemon.request_rebuild()
+        logger.info(f"New calibration values: {wh_a} and {wh_b}")
+        logger.debug(f"r_s: {r_s},  r_offset: {r_offset}")
+
+    # Acquires the calibration points of all channels of the batch, then
+    # updates the calibration points and fitted values in state.conf.
+    # Nothing is written if the job is cancelled.
+    def _run_batch_job(self, job):
+        wh_factors = {}
+        for adc_key in job.adc_keys:
+            adc_points = [p for p in job.points if p["adc_key"] == adc_key]
+            with self.state.config_update_lock:
+                adc_conf = self.state.conf["adcs"][adc_key]
+                N_REF = adc_conf["r_ref"]["r_s"] / adc_conf["r_ref"]["r_ref"]
+                r_ref_mux = getattr(adc_def, adc_conf["r_ref"]["mux"])
+                temp_ch_confs = [adc_conf["temp_chs"][p["temp_ch_idx"]]
+                                 for p in adc_points]
+                # Resistance reference channel first, followed by all
+                # temperature channels of this ADC in one sequence
+                adc_mux_seq = (
+                    [r_ref_mux << 4 | getattr(adc_def, adc_conf["aincom"]["mux"])]
+                    + [getattr(adc_def, ch_conf["mux"]) << 4 | r_ref_mux
+                       for ch_conf in temp_ch_confs]
+                )
+                adc_offsets = np.array(
+                    [adc_conf["r_ref"]["adc_offset"]]
+                    + [ch_conf["adc_offset"] for ch_conf in temp_ch_confs]
+                )
+            logger.info(f"Acquiring batch calibration data for ADC: {adc_key}, "
+                        f"temp channels: {[p['temp_ch_idx'] for p in adc_points]}")
+            adc_avg = self._acquire(job, adc_key, adc_mux_seq, job.n_samples)
+            if adc_avg is None:
+                return
+            adc_unscaled = adc_avg - adc_offsets
+            for point, u_ch in zip(adc_points, adc_unscaled[1:]):
+                wh_factors[(adc_key, point["temp_ch_idx"])] = float(
+                    wheatstone_factor(u_ch, adc_unscaled[0], N_REF))
+        results = []
+        with self.state.config_update_lock:
+            for point in job.points:
+                adc_key, temp_ch_idx = point["adc_key"], point["temp_ch_idx"]
+                temp_ch_conf = self.state.conf["adcs"][adc_key]["temp_chs"][temp_ch_idx]
+                wh_factor = wh_factors[(adc_key, temp_ch_idx)]
+                cal_points = [] if job.clear_points else [
+                    [float(r), float(wh)] for r, wh in temp_ch_conf.get("cal_points", [])]
+                # A repeated measurement of the same standard replaces the old one
+                cal_points = [p for p in cal_points if p[0] != point["cal_resistance"]]
+                cal_points.append([point["cal_resistance"], wh_factor])
+                cal_points.sort()
+                temp_ch_conf["cal_points"] = cal_points
+                result = {"adc_key": adc_key, "temp_ch_idx": temp_ch_idx,
+                          "wh_factor": wh_factor, "n_points": len(cal_points)}
+                try:
+                    fit = fit_calibration(cal_points, job.fit_quadratic)
+                except ValueError as e:
+                    result["message"] = str(e)
+                else:
+                    temp_ch_conf["r_s"] = fit["r_s"]
+                    temp_ch_conf["r_offset"] = fit["r_offset"]
+                    temp_ch_conf["r_quad"] = fit["r_quad"]
+                    result.update(fit)
+                    logger.debug(f"Channel {adc_key}, {temp_ch_idx} fit: {fit}")
+                results.append(result)
+            self.state.conf.refresh_snapshot()
+        job.result = results
+        n_fitted = sum("r_s" in result for result in results)
+        if n_fitted:
+            self.meas_daemon.request_rebuild()
+        job.message = f"Fitted {n_fitted} of {len(results)} channels"
+        logger.info(f"Batch calibration job {job.job_id}: {job.message}")
+
+    # Averaged raw samples of the ADC input sequence, without offset
+    # correction, or None if the job was cancelled.
+    def _acquire(self, job, adc_key, adc_mux_seq, n_samples):
+        adc_buf = np.zeros((n_samples, len(adc_mux_seq)), dtype=int)
+        with self.meas_daemon.exclusive_adc(adc_key) as adc_obj:
+            adc_obj.read_sequence(adc_mux_seq, adc_buf[0])
+            job.n_acquired += 1
+            for j in range(1, n_samples):
+                self._push_progress()
+                if job.cancel_requested:
+                    return None
+                adc_obj.read_continue(adc_mux_seq, adc_buf[j])
+                job.n_acquired += 1
+        return np.average(adc_buf, axis=0)
@@ -1,10 +1,21 @@
-import threading
 import time
+import json
 import math
+import threading
 import logging
-from pipyadc import ADS1256, ADS1256_definitions, ADS1256_default_config
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+from pipyadc import ADS1256_definitions, ADS1256_default_config
 from picalor.picalor_measurement import Fluid, Measurement, Calibrator
+from picalor.picalor_acquisition import SharedBusADS1256, AcquisitionScheduler
+from picalor.picalor_conversion import BatchConverter
+from picalor.picalor_datalog import QUANTITIES
+from picalor.picalor_rawcapture import RawCapture
 from picalor.util_lib.flow_sensor import FlowSensorPulseType, FlowSensorFixed
+from picalor.util_lib.scan_scheduler import ScanScheduler
+from picalor.util_lib.stage_timer import StageTimers
+from picalor.util_lib.simulated_hardware import SimulatedPi, SimulatedADS1256
 
 logger = logging.getLogger("measurement_daemon")
 
@@ -15,17 +26,25 @@ class PicalorMeasurementDaemon():
         self.api = api
         # Will be set from _configure_and_start_sensors()
         self.adc_objs = {}
+        # Held while an ADC is accessed, see exclusive_adc()
+        self.adc_locks = {}
         self.flow_sensors = []
         # Will be set from _configure_measurements_enable_acquisition()
         self.measurements = []
+        self.acquisition_scheduler = None
+        self.converter = None
+        self.fluids = {}
+        self.raw_capture = None
         # Could be a subclass of this class but using composition
         self.calibrator = Calibrator(self, state, api)
         # Events controlling the measurement thread operation
-        self.calibration_mode_enabled = threading.Event()
         self._datalog_enabled = threading.Event()
         self._clear_datalog_requested = threading.Event()
         self._acquisition_enabled = threading.Event()
-        self.cal_data_ready = threading.Event()
+        self._rebuild_requested = threading.Event()
+        self._power_calibration_changed = threading.Event()
+        # Channel indices of requested tare_power() calls
+        self._tare_requests = deque()
         # Shutdown flag makes thread loop exit
         self._shutdown_requested = threading.Event()
         self._thread_obj = threading.Thread(
@@ -34,8 +53,13 @@ class PicalorMeasurementDaemon():
             args=()
         )
         self._thread_obj.setDaemon(True)
+        # Set from measurement thread
+        self.scan_scheduler = None
         self._log_start_time = None
-        self._log_time_digits = None
+        # Timing of the measurement loop stages, see diagnostics_json()
+        self.stage_timers = StageTimers(
+            state.conf["measurements"].get("diagnostics_window", 1000))
+        self._t_diagnostics_pushed = None
 
     def start(self):
         self._configure_and_start_sensors()
@@ -45,26 +69,45 @@ class PicalorMeasurementDaemon():
     def stop(self):
         timeout = 12
         try:
-            timeout += self.state.conf["measurements"]["scan_interval_s"]
+            timeout += self.state.conf.snapshot()["measurements"]["scan_interval_s"]
         except (AttributeError, TypeError):
             pass
         self._shutdown_requested.set()
+        self.calibrator.stop()
         if self._thread_obj is not None:
             self._thread_obj.join(timeout)
         self._stop_sensors_stop_acquisition()
+        self.state.results.measurement_thread_close_datalog()
+        self.state.conf.close()
 
+    # Thread-safe. Power calibration values are written into state.conf,
+    # they are applied from the measurement thread before the next scan.
     def set_power_offset(self, ch_idx, value):
-        self.measurements[ch_idx].set_power_offset(value)
+        self._check_ch_idx(ch_idx)
+        self.state.conf.set_item(("measurements", "chs", ch_idx, "power_offset"), value)
+        self._power_calibration_changed.set()
 
+    # Thread-safe, see set_power_offset()
     def set_power_gain(self, ch_idx, value):
-        self.measurements[ch_idx].set_power_gain(value)
+        self._check_ch_idx(ch_idx)
+        self.state.conf.set_item(("measurements", "chs", ch_idx, "power_gain"), value)
+        self._power_calibration_changed.set()
 
+    # Thread-safe. Zero calibration of the channel is done from the
+    # measurement thread before the next scan.
     def tare_power(self, ch_idx):
-        self.measurements[ch_idx].tare_power()
+        self._check_ch_idx(ch_idx)
+        self._tare_requests.append(ch_idx)
+        self._power_calibration_changed.set()
+
+    def _check_ch_idx(self, ch_idx):
+        if ch_idx not in range(len(self.state.conf.snapshot()["measurements"]["chs"])):
+            raise ValueError(f"Invalid measurement channel index: {ch_idx}")
     
     # This clears the log when enabling the log (if not already enabled)
     def set_datalog_enabled(self, value):
-        self.state.conf["measurements"]["datalog_enabled"] = value
+        if self.state.conf.snapshot()["measurements"]["datalog_enabled"] != value:
+            self.state.conf.set_item(("measurements", "datalog_enabled"), value)
         if value:
             self._datalog_enabled.set()
         else:
@@ -73,6 +116,48 @@ class PicalorMeasurementDaemon():
     def clear_datalog(self):
         self._clear_datalog_requested.set()
 
+    # Thread-safe. Measurements, conversion and acquisition plans are set up
+    # new from the measurement thread, e.g. for new calibration values.
+    def request_rebuild(self):
+        self._rebuild_requested.set()
+
+    # Thread-safe. Exclusive access to one ADC device, e.g. for the Calibrator.
+    # Blocks until a running scan of this ADC is completed. Until released,
+    # scans of this ADC are skipped while all other ADCs are scanned normally.
+    # This also applies to acquisition set up new in the meantime, e.g. after
+    # a configuration change, see AdcAcquisitionPlan and ContinuousSampler.
+    @contextmanager
+    def exclusive_adc(self, adc_key, timeout=30):
+        adc_lock = self.adc_locks.get(adc_key)
+        if adc_lock is None:
+            raise ValueError(f"ADC not running: {adc_key}")
+        # Background sampling is paused first, so that the sampler does not
+        # compete for the lock
+        scheduler = self.acquisition_scheduler
+        if scheduler is not None:
+            scheduler.pause(adc_key)
+        try:
+            if not adc_lock.acquire(timeout=timeout):
+                raise TimeoutError(f"Timeout waiting for access to ADC: {adc_key}")
+            try:
+                yield self.adc_objs[adc_key]
+            finally:
+                adc_lock.release()
+        finally:
+            if scheduler is not None:
+                scheduler.resume(adc_key)
+
+    # Thread-safe. Timing statistics of the measurement loop stages
+    # and of the scan scheduler.
+    def diagnostics_json(self):
+        scheduler = self.scan_scheduler
+        return json.dumps({
+            "stages": self.stage_timers.stats(),
+            "scheduler": None if scheduler is None else scheduler.stats(),
+            "publisher": self.api.publisher.stats(),
+            "dispatcher": self.api.dispatcher.stats(),
+        })
+
     # When sensors are re-configured, the measurements also have to be
     # re-configured. This is why acquisition_enabled is cleared but not reset here.
     def _configure_and_start_sensors(self):
@@ -80,37 +165,89 @@ class PicalorMeasurementDaemon():
                      f"{threading.current_thread().name}")
         # Initialise the ADCs and add instances here
         self.adc_objs = {}
-        for key in self.state.conf["adcs"].keys():
-            logger.info(f"Configuring ADC: {key}")
-            adc_hw_conf = self._get_adc_hw_conf(key)
-            logger.debug(f"adc_hw_conf.adcon: {adc_hw_conf.adcon}")
-            logger.debug(f"adc_hw_conf.drate: {adc_hw_conf.drate}")
-            adc_obj = ADS1256(adc_hw_conf, self.pi)
-            adc_obj.cal_self()
-            self.adc_objs[key] = adc_obj
-        # Flow Sensors
-        self.flow_sensors = []
-        for i, conf in enumerate(self.state.conf["flow_sensors"]):
-            sns_type = conf['type']
-            logger.info(f"Configuring flow sensor {i} of type: {sns_type}")
-            if sns_type == "pulse":
-                self.flow_sensors.append(FlowSensorPulseType(self.pi, conf))
-            elif sns_type == "fixed":
-                self.flow_sensors.append(FlowSensorFixed(conf))
+        self.adc_locks = {}
+        for key in self.state.conf.snapshot()["adcs"].keys():
+            self._start_adc(key)
+        self._start_flow_sensors()
+
+    def _start_adc(self, key):
+        logger.info(f"Configuring ADC: {key}")
+        adc_conf = self.state.conf.snapshot()["adcs"][key]
+        adc_hw_conf = self._get_adc_hw_conf(adc_conf)
+        logger.debug(f"adc_hw_conf.adcon: {adc_hw_conf.adcon}")
+        logger.debug(f"adc_hw_conf.drate: {adc_hw_conf.drate}")
+        if isinstance(self.pi, SimulatedPi):
+            adc_obj = SimulatedADS1256(adc_hw_conf, self.pi, adc_conf)
+        else:
+            adc_obj = SharedBusADS1256(adc_hw_conf, self.pi)
+        adc_obj.cal_self()
+        self.adc_objs[key] = adc_obj
+        # Lock is kept when the ADC is restarted, see exclusive_adc()
+        self.adc_locks.setdefault(key, threading.Lock())
+
+    # Stops the ADC and starts it again if it is still configured.
+    # Acquisition must be stopped.
+    def _restart_adc(self, key):
+        adc_obj = self.adc_objs.pop(key, None)
+        if adc_obj is not None:
+            adc_obj.stop()
+        if key in self.state.conf.snapshot()["adcs"].keys():
+            self._start_adc(key)
+        else:
+            self.adc_locks.pop(key, None)
+
+    def _start_flow_sensors(self):
+        self.flow_sensors = [self._create_flow_sensor(i, conf) for i, conf
+                             in enumerate(self.state.conf.snapshot()["flow_sensors"])]
+
+    # Acquisition must be stopped
+    def _restart_flow_sensor(self, i):
+        self.flow_sensors[i].stop()
+        conf = self.state.conf.snapshot()["flow_sensors"][i]
+        self.flow_sensors[i] = self._create_flow_sensor(i, conf)
+        # Results are otherwise only initialized for new result structures
+        flow_sensor_results = self.state.results["flow_sensors"][i]
+        flow_sensor_results["info"] = conf["info"]
+        if conf["type"] == "fixed":
+            flow_sensor_results["liter_sec"] = conf["FLOW_LITER_SEC"]
+
+    # Sensors of invalid type are replaced by a sensor returning NaN values,
+    # so that sensor indices always match the configuration and results.
+    def _create_flow_sensor(self, i, conf):
+        sns_type = conf['type']
+        logger.info(f"Configuring flow sensor {i} of type: {sns_type}")
+        if sns_type == "pulse":
+            return FlowSensorPulseType(self.pi, conf)
+        elif sns_type == "fixed":
+            return FlowSensorFixed(conf)
+        logger.error(f"Invalid flow sensor type: {sns_type}")
+        return FlowSensorFixed({"FLOW_LITER_SEC": math.nan})
 
     def _stop_sensors_stop_acquisition(self):
         logger.debug("Stopping ADC and flow sensors")
-        self._acquisition_enabled.clear()
+        self._stop_acquisition()
         for adc in self.adc_objs.values():
             adc.stop()
         self.adc_objs = {}
+        self._stop_flow_sensors()
+
+    def _stop_flow_sensors(self):
         for sensor in self.flow_sensors:
             sensor.stop()
         self.flow_sensors = []
 
-    def _get_adc_hw_conf(self, key):
+    def _stop_acquisition(self):
+        self._acquisition_enabled.clear()
+        if self.acquisition_scheduler is not None:
+            self.acquisition_scheduler.shutdown()
+            self.acquisition_scheduler = None
+        if self.raw_capture is not None:
+            self.raw_capture.close()
+            self.raw_capture = None
+
+    def _get_adc_hw_conf(self, adc_conf):
         conf_dict = vars(ADS1256_default_config).copy()
-        ads1256_config = self.state.conf["adcs"][key]["ads1256_config"]
+        ads1256_config = adc_conf["ads1256_config"]
         conf_dict.update(ads1256_config)
         # String configuration items must be converted to int flags
         # as defined in ADS1256_definitions
@@ -127,17 +264,17 @@ class PicalorMeasurementDaemon():
     def _configure_measurements_enable_acquisition(self):
         name = threading.current_thread().name
         logger.debug(f"_configure_measurements called from thread: {name}")
+        conf = self.state.conf.snapshot()
         try:
-            n = len(self.state.conf["measurements"]["chs"])
+            n = len(conf["measurements"]["chs"])
             logger.info(f"Number of heat measurement channels configured: {n}")
-            n = self.state.conf["measurements"]["FILTER_SIZE"]
+            n = conf["measurements"]["FILTER_SIZE"]
             logger.info(f"Output values averaged over {n} ADC samples.")
             # Setup fluid objects
-            f_conf = self.state.conf["fluids"]
-            self.fluids = {key: Fluid(f_conf[key]) for key in f_conf.keys()}
+            self._update_fluids()
             # Setup measurement objects
             self.measurements = []
-            for i, ch_conf in enumerate(self.state.conf["measurements"]["chs"]):
+            for i, ch_conf in enumerate(conf["measurements"]["chs"]):
                 try:
                     adc_obj = self.adc_objs[ch_conf["adc_device"]]
                     flow_sensor = self.flow_sensors[ch_conf["flow_sensor"]]
@@ -150,62 +287,159 @@ class PicalorMeasurementDaemon():
                     return
                 m = Measurement(self.state, i, adc_obj, flow_sensor, fluid)
                 self.measurements.append(m)
+            self.converter = BatchConverter(conf, self.fluids)
+            if conf["measurements"].get("raw_capture_enabled", False):
+                try:
+                    self.raw_capture = RawCapture(self.state.results.save_dir,
+                                                  self.state.conf)
+                except OSError as e:
+                    msg = f"Raw ADC data capture disabled!\nError: {e}"
+                    logger.error(msg)
+                    self.api.push_error_str(msg)
+            self.acquisition_scheduler = AcquisitionScheduler(
+                self.state,
+                self.measurements,
+                self.adc_objs,
+                conf["measurements"].get("parallel_acquisition", True),
+                (conf["measurements"].get("acquisition_mode", "burst")
+                 == "continuous"),
+                self.raw_capture,
+                self.adc_locks,
+            )
         except Exception as e:
             msg = f"Error configuring measurements!\nError: {e}"
             logger.exception(msg)
             self.api.push_error_str(msg)
             self._acquisition_enabled.clear()
             return
-        self.set_datalog_enabled(self.state.conf["measurements"]["datalog_enabled"])
+        self.set_datalog_enabled(conf["measurements"]["datalog_enabled"])
         self._acquisition_enabled.set()
 
-    def _acquire_measurement_data(self):
+    # Restarts only the sensors affected by the configuration changes.
+    # Results and data log are kept unless their structure has changed.
+    def _apply_config_changes(self, changes):
+        logger.info(f"Applying configuration changes: {changes.summary()}")
+        restart_adcs = set(changes.restart_adcs)
+        if changes.restart_all_sensors:
+            restart_adcs |= set(self.adc_objs) | set(self.state.conf.snapshot()["adcs"].keys())
+        elif isinstance(self.pi, SimulatedPi):
+            # Simulated ADC devices model the bridge circuit from their config
+            restart_adcs |= changes.changed_adcs
+        restart_all_flow_sensors = (changes.restart_all_sensors
+                                    or changes.restart_all_flow_sensors)
+        rebuild = (changes.rebuild_measurements or changes.reinit_results
+                   or restart_adcs or restart_all_flow_sensors
+                   or changes.restart_flow_sensors)
+        if rebuild:
+            if restart_adcs:
+                # Calibration jobs must release the ADCs first
+                self.calibrator.cancel_all("Cancelled by configuration change")
+            self._stop_acquisition()
+            for key in sorted(restart_adcs):
+                self._restart_adc(key)
+            if restart_all_flow_sensors:
+                self._stop_flow_sensors()
+                self._start_flow_sensors()
+        if changes.reinit_results:
+            self.state.results.initialize_new()
+            self._clear_datalog_requested.set()
+        elif changes.clear_datalog:
+            self._clear_datalog_requested.set()
+        if rebuild:
+            if not restart_all_flow_sensors:
+                for i in sorted(changes.restart_flow_sensors):
+                    self._restart_flow_sensor(i)
+            self._configure_measurements_enable_acquisition()
+        else:
+            self.set_datalog_enabled(
+                self.state.conf.snapshot()["measurements"]["datalog_enabled"])
+        self._update_scan_interval()
+
+    # Fluid objects are kept and only re-compiled if their config has changed
+    def _update_fluids(self):
+        f_conf = self.state.conf.snapshot()["fluids"]
+        fluids = {}
+        for key in f_conf.keys():
+            fluid = self.fluids.get(key)
+            if fluid is None:
+                fluid = Fluid(f_conf[key])
+            elif fluid.update(f_conf[key]):
+                logger.info(f"Fluid configuration changed: {key}")
+            fluids[key] = fluid
+        self.fluids = fluids
+
+    # Data log row is only appended if log_data is True
+    def _acquire_measurement_data(self, log_data=True):
         # The flow meter channel for each power measurement can use a different
         # temperature measurement channel, while extra ADC acquisiton cycles
         # only for the flow meter would be wasteful.
-        # This is why first, all temperature channels have to be acquired
-        for measurement in self.measurements:
-            measurement.scan_sensors()
+        # This is why first, all temperature channels have to be acquired.
+        # Channels on different ADC devices are acquired concurrently.
+        t = time.perf_counter()
+        self.acquisition_scheduler.scan_all()
+        t = self.stage_timers.lap("adc_scan", t)
         # Flow sensor read-out is non-blocking, we read all
+        flow_sensor_results = self.state.results["flow_sensors"]
         for i, sensor in enumerate(self.flow_sensors):
-            flow = sensor.read_liter_sec()
-            self.state.results["flow_sensors"][i]["liter_sec"] = flow
+            flow_sensor_results[i]["liter_sec"] = sensor.read_liter_sec()
+        if self.raw_capture is not None:
+            self.raw_capture.record_flows(
+                time.time(), [data["liter_sec"] for data in flow_sensor_results])
+        t = self.stage_timers.lap("flow_read", t)
+        # All channels are converted in batch
+        adc_unscaled = self.acquisition_scheduler.adc_unscaled_table(self.measurements)
+        r_up, r_dn, t_up, t_dn = self.converter.temperatures(adc_unscaled)
+        for i, measurement in enumerate(self.measurements):
+            measurement.write_temperatures(adc_unscaled[i].tolist(),
+                                           r_up[i].item(), r_dn[i].item(),
+                                           t_up[i].item(), t_dn[i].item())
+        t = self.stage_timers.lap("temperatures", t)
         # Afterwards we can calculate and publish the interdependent results
-        for measurement in self.measurements:
-            measurement.calculate_power()
-        if self._datalog_enabled.is_set():
+        t_flow = np.array([m.get_flow_sensor_temperature()
+                           for m in self.measurements], dtype=float)
+        flow_liter_sec = np.array([flow_sensor_results[m.flow_sensor_idx]["liter_sec"]
+                                   for m in self.measurements], dtype=float)
+        flow_kg_sec, power = self.converter.powers(t_up, t_dn, t_flow, flow_liter_sec)
+        for i, measurement in enumerate(self.measurements):
+            measurement.write_power(flow_kg_sec[i].item(), power[i].item())
+        t = self.stage_timers.lap("power", t)
+        if log_data and self._datalog_enabled.is_set():
             if (self._clear_datalog_requested.is_set()
                 or self.state.results["data_log"] is None
                 ):
                 self._clear_datalog_requested.clear()
                 self.state.results.measurement_thread_initialize_datalog()
-                self._log_start_time = time.time()
+                self._log_start_time = self.scan_scheduler.t_tick
             log = self.state.results["data_log"]
-            t = round(time.time() - self._log_start_time, self._log_time_digits)
-            log["time_s"].append(t)
-            for ch, data in enumerate(self.state.results["measurements"]["chs"]):
-                log["t_upstream"][ch].append(data["t_upstream"])
-                log["t_downstream"][ch].append(data["t_downstream"])
-                log["flow_kg_sec"][ch].append(data["flow_kg_sec"])
-                log["power_w"][ch].append(data["power_w"])
-
-
+            chs = self.state.results["measurements"]["chs"]
+            log.append(round(self.scan_scheduler.t_tick - self._log_start_time, 6),
+                       {key: [data[key] for data in chs] for key in QUANTITIES})
+            t = self.stage_timers.lap("datalog", t)
+        # Readers in other threads only see complete scans
+        self.state.results.measurement_thread_publish()
+        self.stage_timers.lap("results_publish", t)
 
     def _measurement_thread(self):
         logger.debug(f"Measurement thread: {threading.current_thread().name}")
-        scan_interval_s = int(self.state.conf["measurements"]["scan_interval_s"])
-        self._log_time_digits = -int(math.log10(scan_interval_s))
-        t_next_sample = 1 + int(time.time()) + scan_interval_s
+        scan_interval_s = float(self.state.conf.snapshot()["measurements"]["scan_interval_s"])
+        time_scale = self.pi.time_scale if isinstance(self.pi, SimulatedPi) else 1.0
+        self.scan_scheduler = ScanScheduler(scan_interval_s, time_scale)
+        # Live data is published and data log is appended every n-th scan
+        n_scan = 0
         while True:
-            if self._shutdown_requested.is_set():
+            if not self.scan_scheduler.wait_next(self._shutdown_requested):
                 return
-            self._measurement_thread_time = time.time()
-            delta_t = t_next_sample - self._measurement_thread_time
-            t_next_sample += scan_interval_s
-            if delta_t > 0.0:
-                time.sleep(delta_t)
-            else:
-                logger.warning("Timeout occurred - beware of missing data!")
+            if self.scan_scheduler.overrun:
+                stats = self.scan_scheduler.stats()
+                logger.warning(
+                    "Timeout occurred - beware of missing data! "
+                    f"Overruns: {stats['n_overruns']}, "
+                    f"missed scans: {stats['n_missed']} "
+                    f"of {stats['n_ticks'] + stats['n_missed']}"
+                )
+                last = self.stage_timers.last()
+                logger.warning("Last stage durations: " + ", ".join(
+                    f"{stage}: {duration:.4f} s" for stage, duration in last.items()))
             # Check for configuration updates and apply if needed.
             # This is supposed to be a re-configuration without adding or
             # removal of channels and without the need to restart all sensors.
@@ -215,35 +449,73 @@ class PicalorMeasurementDaemon():
                 # Writes pending updates to state.conf
                 self.state.conf.measurement_thread_commit_pending_updates()
                 self.state.config_update_lock.release()
+                self._update_fluids()
+                if self.converter is not None:
+                    self.converter.update_power_calibration(self.state.conf.snapshot())
+                self._update_scan_interval()
                 self.api.send_response("upload_norestart__config", self.state.conf.as_json())
-            # If the base configuration has been changed, ADC and flow sensors
-            # must be restarted and measurements must be set up new 
+            if self._power_calibration_changed.is_set():
+                self._power_calibration_changed.clear()
+                self._update_power_calibration()
+            # If the base configuration has been changed, only the sensors and
+            # measurement components affected by the changes are set up new
             if self.state.config_updated.is_set():
-                self._stop_sensors_stop_acquisition()
                 self.state.config_update_lock.acquire()
                 self.state.config_updated.clear()
                 # Writes pending updates to state.conf
-                did_save = self.state.conf.measurement_thread_commit_pending_updates()
+                changes = self.state.conf.measurement_thread_commit_pending_updates()
                 self.state.config_update_lock.release()
-                self.state.results.initialize_new()
-                self._clear_datalog_requested.set()
-                self._configure_and_start_sensors()
-                self._configure_measurements_enable_acquisition()
-                if did_save:
+                self._apply_config_changes(changes)
+                if changes.patch_response:
+                    self.api.send_response("upload_patch__config", changes.patch_json())
+                elif changes.saved:
                     self.api.send_response("upload_save__config", self.state.conf.as_json())
                 else:
                     self.api.send_response("upload__config", self.state.conf.as_json())
-            # Flag set by Calibrator instance
-            if self.calibration_mode_enabled.is_set():
-                self.state.config_update_lock.acquire()
-                self.calibrator.measurement_thread_acquire_cal_data()
-                self.state.config_update_lock.release()
-                self.calibration_mode_enabled.clear()
-                # Waited for by Calibrator instance
-                self.cal_data_ready.set()
-            # Main operation mode of measurement daemon
-            elif self._acquisition_enabled.is_set():
-                self.state.results_update_lock.acquire()
-                self._acquire_measurement_data()
-                self.state.results_update_lock.release()
-                self.api.push_live_data()
\ No newline at end of file
+            if self._rebuild_requested.is_set():
+                self._rebuild_requested.clear()
+                self._stop_acquisition()
+                self._configure_measurements_enable_acquisition()
+            # Main operation mode of measurement daemon.
+            # Calibration jobs run concurrently, see Calibrator.
+            if self._acquisition_enabled.is_set():
+                meas_conf = self.state.conf.snapshot()["measurements"]
+                n_publish = int(meas_conf.get("publish_every_n_scans", 1))
+                n_scan = (n_scan + 1) % max(n_publish, 1)
+                publish = n_scan == 0
+                t = time.perf_counter()
+                self._acquire_measurement_data(log_data=publish)
+                t = self.stage_timers.lap("acquire_total", t)
+                if publish:
+                    self.api.push_live_data()
+                    self.stage_timers.lap("publish", t)
+                self._push_diagnostics_if_due()
+
+    # Diagnostics are published every diagnostics_interval_s, zero disables
+    def _push_diagnostics_if_due(self):
+        interval_s = float(
+            self.state.conf.snapshot()["measurements"].get("diagnostics_interval_s", 60.0))
+        if interval_s <= 0.0:
+            return
+        t_now = self.scan_scheduler.t_tick
+        if self._t_diagnostics_pushed is None:
+            self._t_diagnostics_pushed = t_now
+        elif t_now - self._t_diagnostics_pushed >= interval_s:
+            self._t_diagnostics_pushed = t_now
+            self.api.push_diagnostics(self.diagnostics_json())
+
+    # Apply changed scan_interval_s setting to the running scheduler
+    def _update_scan_interval(self):
+        interval_s = float(self.state.conf.snapshot()["measurements"]["scan_interval_s"])
+        if interval_s != self.scan_scheduler.interval_s:
+            logger.info(f"New scan interval: {interval_s} s")
+            self.scan_scheduler.set_interval(interval_s)
+
+    # Applies requested zero calibrations and changed power calibration values
+    def _update_power_calibration(self):
+        while self._tare_requests:
+            ch_idx = self._tare_requests.popleft()
+            if ch_idx < len(self.measurements):
+                self.measurements[ch_idx].tare_power()
+        if self.converter is not None:
+            self.converter.update_power_calibration(self.state.conf.snapshot())
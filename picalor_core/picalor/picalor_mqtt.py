@@ -1,7 +1,9 @@
 import time
+import math
 import logging
 import json
 import paho.mqtt.client as mqtt_client
+from picalor.picalor_encoding import payload_encoder, results_values
 
 logger = logging.getLogger("picalor_mqtt")
 
@@ -16,6 +18,23 @@ class PicalorMqtt():
         self.data_topic = conf["CORE_DATA_TOPIC"]
         self.cmd_req_topic = conf["CORE_CMD_REQ_TOPIC"]
         self.cmd_resp_topic = conf["CORE_CMD_RESP_TOPIC"]
+        # Encoding of results data payloads, see picalor_encoding
+        self.encoder = payload_encoder(conf)
+        # "payload", "values" or "both", see default config
+        self.publish_mode = str(conf.get("DATA_PUBLISH_MODE", "payload"))
+        if self.publish_mode not in ("payload", "values", "both"):
+            logger.error(f"Invalid data publish mode: {self.publish_mode}")
+            self.publish_mode = "payload"
+        self.value_topics_qos = int(conf.get("VALUE_TOPICS_QOS", 0))
+        self.value_topics_retain = bool(conf.get("VALUE_TOPICS_RETAIN", True))
+        self.value_topics_deadband = {
+            str(quantity): float(deadband) for quantity, deadband
+            in conf.get("VALUE_TOPICS_DEADBAND", {}).items()
+        }
+        # Last published value for each value topic, publisher thread only
+        self._value_topics_last = {}
+        # Set from the network thread after a reconnect
+        self._value_topics_reset = False
         # paho.mqtt.client
         self.backend = mqtt_client.Client()
         self.backend.on_connect = self._on_connect
@@ -24,6 +43,53 @@ class PicalorMqtt():
     def push_data_json(self, key, json_str):
         self.backend.publish(f"{self.data_topic}/{key}", json_str)
 
+    def push_data(self, key, data):
+        self.push_encoded(key, self.encode_data(key, data))
+
+    # Results data is encoded with the configured payload encoding.
+    # Returns the item to be published with push_encoded().
+    def encode_data(self, key, data):
+        if self.publish_mode == "values":
+            return data, None, None
+        payload, schema = self.encoder.encode(key, data)
+        return data, payload, schema
+
+    # A changed payload schema is published retained on the "schema" subtopic.
+    def push_encoded(self, key, encoded):
+        data, payload, schema = encoded
+        if self.publish_mode != "payload":
+            self._push_value_topics(data)
+        if payload is None:
+            return
+        if schema is not None:
+            self.backend.publish(f"{self.data_topic}/{key}/schema", schema, retain=True)
+        self.backend.publish(f"{self.data_topic}/{key}", payload)
+
+    # Each instantaneous value is published as JSON on its own topic, e.g.
+    # "data/picalor/core/values/chs/0/power_w", if it changed by more than
+    # the deadband configured for the quantity since it was last published.
+    def _push_value_topics(self, data):
+        if self._value_topics_reset:
+            self._value_topics_reset = False
+            self._value_topics_last = {}
+        last_values = self._value_topics_last
+        for name, value in results_values(data):
+            if value is not None and math.isnan(value):
+                value = None
+            if name in last_values:
+                last = last_values[name]
+                if value is None or last is None:
+                    if value is last:
+                        continue
+                else:
+                    deadband = self.value_topics_deadband.get(name.rsplit("/", 1)[-1], 0.0)
+                    if abs(value - last) <= deadband:
+                        continue
+            self.backend.publish(f"{self.data_topic}/values/{name}", json.dumps(value),
+                                 qos=self.value_topics_qos,
+                                 retain=self.value_topics_retain)
+            last_values[name] = value
+
     def push_error_str(self, message_str):
         self.backend.publish(f"{self.data_topic}/errors", message_str)
 
@@ -54,6 +120,9 @@ class PicalorMqtt():
 
     def _on_connect(self, client, _userdata, _flags, rc):
         logger.info(f"OK, Picalor MQTT connection established.")
+        # All values are published again after a reconnect. The last values
+        # are only reset from the publisher thread, see _push_value_topics().
+        self._value_topics_reset = True
         client.subscribe(f"{self.cmd_req_topic}/+")
         if rc == 0:
             pass
@@ -0,0 +1,106 @@
+import time
+import threading
+import logging
+from collections import OrderedDict
+from picalor.util_lib.stage_timer import StageTimers
+
+logger = logging.getLogger("picalor_publisher")
+
+
+class PicalorPublisher():
+    """Publishes data on the frontend data topics from a dedicated thread
+
+    The measurement thread only queues results snapshots, encoding and
+    the frontend publish calls are done on the publisher thread. This way,
+    serialization cost and network latency do not delay the next scan.
+    Each frontend encodes results data with its own payload encoding.
+
+    The queue holds at most one pending item for each data key and at most
+    max_pending items. When a new item is queued for a key which is still
+    pending, the pending item is replaced (coalesced, i.e. drop-to-latest).
+    An optional merge function merge(older, newer) can then combine both
+    items, e.g. to keep data log rows of the older item.
+    If max_pending keys are pending, the oldest item is dropped.
+    """
+    def __init__(self, frontends, max_pending=8):
+        self.frontends = frontends
+        self.max_pending = max(int(max_pending), 1)
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self._stop_requested = False
+        self.n_queued = 0
+        self.n_published = 0
+        self.n_coalesced = 0
+        self.n_dropped = 0
+        self.stage_timers = StageTimers()
+        self._thread_obj = None
+
+    def start(self):
+        with self._cond:
+            self._stop_requested = False
+        self._thread_obj = threading.Thread(
+            target=self._publisher_thread, name="Publisher Thread", daemon=True)
+        self._thread_obj.start()
+
+    # Items still pending are published before the thread exits
+    def stop(self, timeout=10):
+        with self._cond:
+            self._stop_requested = True
+            self._cond.notify()
+        if self._thread_obj is not None:
+            self._thread_obj.join(timeout)
+            self._thread_obj = None
+
+    # Thread-safe, never blocks on encoding or publishing.
+    # data is a JSON string or results data, see PicalorMqtt.encode_data()
+    def publish(self, key, data, merge=None):
+        with self._cond:
+            self.n_queued += 1
+            if key in self._pending:
+                older = self._pending.pop(key)
+                if merge is not None:
+                    data = merge(older, data)
+                self.n_coalesced += 1
+            elif len(self._pending) >= self.max_pending:
+                dropped_key, _ = self._pending.popitem(last=False)
+                logger.debug(f"Publish queue full, dropped data key: {dropped_key}")
+                self.n_dropped += 1
+            self._pending[key] = data
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            counters = {
+                "n_queued": self.n_queued,
+                "n_published": self.n_published,
+                "n_coalesced": self.n_coalesced,
+                "n_dropped": self.n_dropped,
+                "n_pending": len(self._pending),
+            }
+        return {**counters, "stages": self.stage_timers.stats()}
+
+    def _publisher_thread(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stop_requested:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                key, data = self._pending.popitem(last=False)
+            try:
+                t = time.perf_counter()
+                if isinstance(data, str):
+                    for frontend in self.frontends:
+                        frontend.push_data_json(key, data)
+                    self.stage_timers.lap("send", t)
+                else:
+                    encoded = [frontend.encode_data(key, data)
+                               for frontend in self.frontends]
+                    t = self.stage_timers.lap("encode", t)
+                    for frontend, item in zip(self.frontends, encoded):
+                        frontend.push_encoded(key, item)
+                    self.stage_timers.lap("send", t)
+                with self._cond:
+                    self.n_published += 1
+            except Exception as e:
+                logger.exception(f"Error publishing data key: {key}\nError: {e}")
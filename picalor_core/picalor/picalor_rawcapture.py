@@ -0,0 +1,204 @@
+import json
+import time
+import logging
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+import tomlkit
+
+logger = logging.getLogger("picalor_rawcapture")
+
+# One record for each single ADC sample
+RAW_SAMPLE_DTYPE = np.dtype([("time_s", "<f8"), ("mux", "u1"), ("value", "<i4")])
+# One record for each flow sensor read-out
+RAW_FLOW_DTYPE = np.dtype([("time_s", "<f8"), ("sensor", "u1"), ("liter_sec", "<f8")])
+RAW_SUFFIX = ".raw"
+# Capture session files
+METADATA_FILENAME = "capture.json"
+CONFIG_FILENAME = "picalor_config.toml"
+FLOWS_FILENAME = f"flow_sensors{RAW_SUFFIX}"
+
+
+class RawCaptureFile():
+    """Append-only, memory-mapped binary file of fixed-size records
+
+    The file is grown in steps of chunk_rows records, the unused trailing
+    records are zero. When closed, the file is truncated to the records
+    written. After a crash, read_capture_file() removes the zero padding.
+
+    Modified pages are flushed to disk at most every flush_interval_s seconds.
+    """
+    def __init__(self, file_obj, dtype, chunk_rows=65_536, flush_interval_s=10.0):
+        self.file_obj = Path(file_obj)
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+        self.flush_interval_s = flush_interval_s
+        self.n_rows = 0
+        self._file = open(self.file_obj, "xb+")
+        self._map = None
+        self._t_last_flush = time.monotonic()
+
+    # Append records, fields are given as keyword arguments,
+    # arrays of the same length or broadcastable scalars.
+    def append(self, n_rows, **fields):
+        if self._map is None or self.n_rows + n_rows > len(self._map):
+            self._remap(self.n_rows + n_rows)
+        records = self._map[self.n_rows:self.n_rows+n_rows]
+        for key, values in fields.items():
+            records[key] = values
+        self.n_rows += n_rows
+        if time.monotonic() - self._t_last_flush >= self.flush_interval_s:
+            self.flush()
+
+    def flush(self):
+        if self._map is not None:
+            self._map.flush()
+        self._t_last_flush = time.monotonic()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._map = None
+        self._file.truncate(self.n_rows * self.dtype.itemsize)
+        self._file.close()
+
+    # Grow file to hold at least n_rows records
+    def _remap(self, n_rows):
+        n_chunks = -(-n_rows // self.chunk_rows)
+        capacity = n_chunks * self.chunk_rows
+        if self._map is not None:
+            self._map.flush()
+        self._file.truncate(capacity * self.dtype.itemsize)
+        self._map = np.memmap(self._file, dtype=self.dtype, mode="r+",
+                              shape=(capacity,))
+
+
+class RawAdcRecorder():
+    """Records complete cycles of the ADC input multiplexer sequence
+
+    Only the start and end time of each cycle is known, time stamps of the
+    single samples are interpolated assuming equal conversion times.
+    """
+    def __init__(self, capture_file, mux_seq):
+        self.capture_file = capture_file
+        self.enabled = True
+        self.mux_seq = np.array(mux_seq, dtype=np.uint8)
+        n = len(self.mux_seq)
+        # Fraction of cycle time passed at the end of each conversion
+        self._frac = np.arange(1, n + 1) / n
+
+    # rows:     (n_cycles, len(mux_seq)) array of ADC samples
+    # t_bounds: n_cycles + 1 time stamps, start of the first cycle and
+    #           end time of each cycle
+    def record(self, t_bounds, rows):
+        if not self.enabled:
+            return
+        rows = np.atleast_2d(rows)
+        t_bounds = np.asarray(t_bounds, dtype=float)
+        time_s = t_bounds[:-1, None] + np.diff(t_bounds)[:, None] * self._frac
+        try:
+            self.capture_file.append(
+                rows.size,
+                time_s=time_s.ravel(),
+                mux=np.tile(self.mux_seq, len(rows)),
+                value=rows.ravel(),
+            )
+        except OSError as e:
+            logger.error(f"Raw ADC data capture stopped! Error: {str(e)}")
+            self.enabled = False
+
+
+class RawCapture():
+    """Raw capture session for offline reprocessing
+
+    All single ADC samples and flow sensor read-outs are streamed into
+    memory-mapped binary files in a new folder "picalor_raw_[start time]".
+    The folder also holds a copy of the configuration and a metadata file
+    with the input multiplexer sequence of each ADC.
+
+    conf is the PicalorConfig, the configuration file text is saved from
+    the tomlkit document and all other values are read from its snapshot.
+
+    See picalor_reprocess script for the offline conversion.
+    """
+    def __init__(self, base_dir, conf):
+        stamp = datetime.now().isoformat("_", "seconds")
+        self.capture_dir = Path(base_dir).joinpath(f"picalor_raw_{stamp}")
+        n = 1
+        while self.capture_dir.exists():
+            self.capture_dir = Path(base_dir).joinpath(f"picalor_raw_{stamp}_{n}")
+            n += 1
+        self.capture_dir.mkdir(parents=True)
+        logger.info(f"Raw ADC data capture to: {self.capture_dir}")
+        self.capture_dir.joinpath(CONFIG_FILENAME).write_text(conf.as_toml())
+        self.metadata = {
+            "start_time": stamp.replace("_", " "),
+            "scan_interval_s": float(conf.snapshot()["measurements"]["scan_interval_s"]),
+            "sample_dtype": RAW_SAMPLE_DTYPE.descr,
+            "flow_dtype": RAW_FLOW_DTYPE.descr,
+            "adcs": {},
+        }
+        self._files = []
+        self._flows = self._open(FLOWS_FILENAME, RAW_FLOW_DTYPE)
+        self._write_metadata()
+
+    # Recorder for samples of one ADC device, to be used from one thread only
+    def adc_recorder(self, adc_key, mux_seq):
+        filename = f"{adc_key}{RAW_SUFFIX}"
+        self.metadata["adcs"][adc_key] = {
+            "file": filename,
+            "mux_seq": [int(code) for code in mux_seq],
+        }
+        self._write_metadata()
+        return RawAdcRecorder(self._open(filename, RAW_SAMPLE_DTYPE), mux_seq)
+
+    # Flow sensor read-outs for all sensors, in order of configuration
+    def record_flows(self, time_s, liter_sec):
+        try:
+            self._flows.append(len(liter_sec),
+                               time_s=time_s,
+                               sensor=np.arange(len(liter_sec)),
+                               liter_sec=liter_sec)
+        except OSError as e:
+            logger.error(f"Flow sensor data capture failed! Error: {str(e)}")
+
+    def close(self):
+        for capture_file in self._files:
+            try:
+                capture_file.close()
+            except OSError as e:
+                logger.error(f"Error closing raw capture file! Error: {str(e)}")
+
+    def _open(self, filename, dtype):
+        capture_file = RawCaptureFile(self.capture_dir.joinpath(filename), dtype)
+        self._files.append(capture_file)
+        return capture_file
+
+    def _write_metadata(self):
+        self.capture_dir.joinpath(METADATA_FILENAME).write_text(
+            json.dumps(self.metadata, indent=4))
+
+
+# Read a raw capture file as numpy record array.
+# Zero padding after an unclean shutdown is removed.
+def read_capture_file(file_obj, dtype=RAW_SAMPLE_DTYPE):
+    dtype = np.dtype(dtype)
+    size = Path(file_obj).stat().st_size
+    n_rows = size // dtype.itemsize
+    if n_rows == 0:
+        return np.zeros(0, dtype=dtype)
+    records = np.memmap(file_obj, dtype=dtype, mode="r", shape=(n_rows,))
+    time_s = records["time_s"]
+    while n_rows > 0 and time_s[n_rows-1] == 0.0:
+        n_rows -= 1
+    return records[:n_rows]
+
+
+# Load capture session metadata, configuration and flow sensor records
+def read_capture_dir(capture_dir):
+    capture_dir = Path(capture_dir)
+    metadata = json.loads(capture_dir.joinpath(METADATA_FILENAME).read_text())
+    conf = tomlkit.loads(capture_dir.joinpath(CONFIG_FILENAME).read_text())
+    flows = read_capture_file(capture_dir.joinpath(FLOWS_FILENAME), RAW_FLOW_DTYPE)
+    return metadata, conf, flows
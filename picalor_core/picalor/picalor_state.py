@@ -1,10 +1,16 @@
 import threading
 import logging
+import copy
 import json
 import tomlkit
 from datetime import datetime
 from importlib.resources import files
 from pathlib import Path
+from picalor.picalor_datalog import (PicalorDataLog, DataLogSnapshot, DataLogRef,
+                                     DataLogSegmentWriter)
+from picalor.picalor_config_diff import ConfigChanges, config_patch, plain_config
+from picalor.picalor_config_writer import ConfigFileWriter
+from picalor.picalor_export import DataLogExporter, write_datalog_json
 
 logger = logging.getLogger("picalor_state_store")
 PACKAGE_NAME = "picalor"
@@ -21,9 +27,9 @@ class PicalorState():
         self.conf = PicalorConfig(self)
         # Measurement results are stored here and pushed to the view models
         self.results = PicalorResults(self, self.conf)
-        # Threading locks for modification of the respecitve store items
+        # Threading lock for modification of the configuration.
+        # Results are published as immutable snapshots and need no lock.
         self.config_update_lock = threading.Lock()
-        self.results_update_lock = threading.Lock()
         # Events notifying the measurement daemon to take action
         self.config_updated = threading.Event()
         self.config_updated_norestart = threading.Event()
@@ -32,8 +38,17 @@ class PicalorState():
 class PicalorConfig():
     """Core configuration for Picalor application
 
-    Saving to file must be triggered explicitly.
+    Saving to file must be triggered explicitly. The file is written
+    atomically from a background thread, see ConfigFileWriter.
+
+    The tomlkit document is kept for round-trip saving to file. For reading,
+    snapshot() returns a plain Python copy of the document, which is
+    regenerated when changes are committed. The JSON representation of the
+    snapshot is cached for as_json().
     """
+    # Number of rotated backups of the config file
+    N_BACKUPS = 3
+
     def __init__(self,
                  store,
                  filename="picalor_config.toml",
@@ -44,29 +59,43 @@ class PicalorConfig():
         # updated values and self.config_updated is set. Configuration is then updated
         # when self.commit_pending_updates is called from the application thread
         self.pending_config_updates = {}
+        # Plain Python copy and JSON string of the document, see snapshot()
+        self._snapshot = ({}, "{}")
         store_dir = Path.home().joinpath(f".{PACKAGE_NAME}")
         store_dir.mkdir(exist_ok=True)
         self.file_obj = store_dir.joinpath(filename)
         self.default_file_obj = files(PACKAGE_NAME).joinpath(default_filename)
+        self.writer = ConfigFileWriter(self.file_obj, self.as_toml,
+                                       self.N_BACKUPS)
         # When initializing new, we assume the main thread is not yet running,
         # no restarting of sensors needed..
         self.restore_from_file(initialize = True)
         self._save_to_file_requested = False
+        self._patch_response_requested = False
 
     # Not thread-safe!
     # Called from constructor with initialize = True, then directly
     # setting the state representation
     # TBD: implement reset-config button..
     def restore_from_file(self, initialize=False):
-        logger.info(f"Reading config file: {str(self.file_obj)}")
-        try:
-            new_config = tomlkit.loads(self.file_obj.read_text())
-        except FileNotFoundError:
+        new_config = None
+        # If the config file is damaged, the newest valid backup is used
+        for file_obj in [self.file_obj] + self.writer.backup_files():
+            logger.info(f"Reading config file: {str(file_obj)}")
+            try:
+                new_config = tomlkit.loads(file_obj.read_text())
+                break
+            except FileNotFoundError:
+                pass
+            except (tomlkit.exceptions.ParseError, UnicodeDecodeError) as e:
+                logger.error(f"Config file damaged: {str(file_obj)}\nError: {e}")
+        if new_config is None:
             logger.warning(f'Config file not found. Restoring defaults.')
             new_config = tomlkit.loads(self.default_file_obj.read_text())
         # See above
         if initialize:
             self.tomlkit_doc = new_config
+            self.refresh_snapshot()
         else:
             self.store.config_update_lock.acquire()
             # Overwrites all previous changes
@@ -76,10 +105,29 @@ class PicalorConfig():
 
     # Thread-safe, can be called any time
     def as_json(self):
-        self.store.config_update_lock.acquire()
-        json_str = json.dumps(self.tomlkit_doc).replace("NaN", "null")
-        self.store.config_update_lock.release()
-        return json_str
+        return self._snapshot[1]
+
+    # Thread-safe. Plain Python copy of the configuration as of the last
+    # commit. This is shared by all readers and must not be modified.
+    def snapshot(self):
+        return self._snapshot[0]
+
+    # Regenerates the snapshot after the tomlkit document was modified.
+    # Must be called with config_update_lock held or from measurement thread
+    # before the measurement thread is started.
+    def refresh_snapshot(self):
+        json_str = json.dumps(self.tomlkit_doc)
+        self._snapshot = (json.loads(json_str), json_str.replace("NaN", "null"))
+
+    # Thread-safe. Sets one configuration item, path is the sequence of keys
+    # or list indices, e.g. ("measurements", "chs", 0, "power_offset")
+    def set_item(self, path, value):
+        with self.store.config_update_lock:
+            item = self.tomlkit_doc
+            for key in path[:-1]:
+                item = item[key]
+            item[path[-1]] = value
+            self.refresh_snapshot()
 
     # Thread-safe, called from API.
     # Sends notify response, also triggers send from measurement thread.
@@ -107,33 +155,54 @@ class PicalorConfig():
         self._save_to_file_requested = True
         self.set__config(new_config)
 
+    # Thread-safe, called from API.
+    # Same as set__config, but the API response is a JSON patch of the
+    # changes instead of the complete configuration.
+    def set_patch__config(self, new_config):
+        self._patch_response_requested = True
+        self.set__config(new_config)
+
     # Not thread-safe - To be called from application thread ONLY!
-    # Update all existing config items with values from pending_config_updates. 
+    # Update all existing config items with values from pending_config_updates.
+    # Only items which have changed are replaced. Returns ConfigChanges.
     def measurement_thread_commit_pending_updates(self):
         logger.debug("Updating configuration from pending obj...")
+        patch = []
         for key, value in self.pending_config_updates.items():
             if key in self.tomlkit_doc:
-                self.tomlkit_doc[key] = value
+                key_patch = config_patch(plain_config(self.tomlkit_doc[key]),
+                                         plain_config(value),
+                                         f"/{key}")
+                if key_patch:
+                    self.tomlkit_doc[key] = value
+                    patch += key_patch
             else:
                 logger.error(f"Key not found in picalor configuration: {key}")
         self.pending_config_updates = {}
+        if patch:
+            self.refresh_snapshot()
+        changes = ConfigChanges(patch, self._save_to_file_requested,
+                                self._patch_response_requested)
+        self._patch_response_requested = False
         if self._save_to_file_requested:
-            self.measurement_thread_save_to_file()
+            self.save_to_file()
             self._save_to_file_requested = False
-            return True
-        else:
-            return False
+        return changes
 
-    # Not thread-safe! Handled from mesurement thread
-    def measurement_thread_save_to_file(self):
-        logger.info(f"Saving config to file: {str(self.file_obj)}")
-        textcontent = tomlkit.dumps(self.tomlkit_doc)
-        try:
-            self.file_obj.write_text(textcontent)
-            return self.file_obj.name
-        except OSError as e:
-            logger.error(f"Could not write to file! Error: {str(e)}")
-            raise
+    # Thread-safe. Requests writing the config file from the writer thread.
+    # Returns the request number for ConfigFileWriter.wait()
+    def save_to_file(self):
+        return self.writer.save()
+
+    # Writes a pending save request and stops the writer thread
+    def close(self):
+        self.writer.stop()
+
+    # Thread-safe. TOML text of the configuration, as saved to file.
+    # Must not be called with config_update_lock held.
+    def as_toml(self):
+        with self.store.config_update_lock:
+            return tomlkit.dumps(self.tomlkit_doc)
 
     # Direct element access is not thread safe - only used from mesurement thead
     def __getitem__(self, key):
@@ -145,6 +214,10 @@ class PicalorConfig():
     def __delitem__(self, key):
         del self.tomlkit_doc[key]
 
+    # For optional configuration sections missing in older config files
+    def get(self, key, default=None):
+        return self.tomlkit_doc.get(key, default)
+
 
 class PicalorResults():
     """Measurement state representation for Picalor application, with a
@@ -152,6 +225,12 @@ class PicalorResults():
 
     Data is generated in the core application.
     A push to the views is triggered from there.
+
+    The measurement thread writes results into a private working copy (data).
+    At the end of each scan, an immutable copy of the instantaneous values and
+    a reference to the data log rows are published by swapping a single
+    reference (double buffering). Readers in other threads only access the
+    published copy, so they never block acquisition and never wait for it.
     """
     def __init__(self,
                  store,
@@ -168,48 +247,155 @@ class PicalorResults():
         # Reading this directly is not thread-safe!
         # This is instantaneous results
         self.data = {}
+        # Results published at the end of the last scan. The dictionary and
+        # all contained values are never modified after publishing.
+        # The data log is a DataLogRef.
+        self._published = {}
+        # Number of data log rows already published, see measurement_thread_snapshot_live()
+        self._log_rows_pushed = 0
         self.initialize_new()
 
     # This is thread-safe and can be called any time
     def as_json(self):
-        self.store.results_update_lock.acquire()
-        json_str = json.dumps(self.data).replace("NaN", "null")
-        self.store.results_update_lock.release()
-        return json_str
+        return results_to_json(self.snapshot())
+
+    # Not thread-safe, measurement thread only!
+    # Publishes the current results, see class docstring
+    def measurement_thread_publish(self):
+        published = {key: copy.deepcopy(value)
+                     for key, value in self.data.items() if key != "data_log"}
+        log = self.data["data_log"]
+        published["data_log"] = None if log is None else log.ref()
+        self._published = published
+
+    # This is thread-safe and never blocks.
+    # Results as published at the end of the last scan, without any copy.
+    # The data log is a DataLogRef, its rows are copied when serialized,
+    # see results_to_json(). Do not modify.
+    def published(self):
+        return self._published
+
+    # This is thread-safe and never blocks.
+    # Copy of the complete results as published at the end of the last scan.
+    # Instantaneous values are shared with other snapshots, do not modify.
+    def snapshot(self):
+        published = self._published
+        log = published.get("data_log")
+        return {**published, "data_log": None if log is None else log.snapshot()}
+
+    # Not thread-safe, measurement thread only!
+    # Compact live data: Only the instantaneous values plus the data log rows
+    # which were appended since the last call. Data log field "row_offset" is
+    # the index of the first row sent, a zero value means a new data log.
+    def measurement_thread_snapshot_live(self):
+        published = self._published
+        live = {key: published[key] for key in ("measurements", "adcs", "flow_sensors")}
+        log = published["data_log"]
+        if log is None:
+            live["data_log"] = None
+        else:
+            live["data_log"] = log.snapshot(self._log_rows_pushed)
+            self._log_rows_pushed = log.n_total
+        return live
 
     # Not thread-safe!
     def initialize_from_file(self, filename):
         logger.info(f"Looking for previous measurements in savefile: {filename}")
         try:
             file_obj = Path(filename)
-            self.store.results_update_lock.acquire()
             restored = json.loads(file_obj.read_text())
+            if restored.get("data_log") is not None:
+                restored["data_log"] = PicalorDataLog.from_dict(
+                    restored["data_log"], **self._datalog_options())
             self.data.update(restored)
+            self.measurement_thread_publish()
             logger.info(f'Restored previous measurements: {restored["title"]}')
             return True
         except FileNotFoundError:
             logger.info(f'No savefile found. Initializing Picalor with clean state')
             return False
-        finally:
-            self.store.results_update_lock.release()
 
-    # This is thread-safe and can be called any time
+    # This is thread-safe and can be called any time.
+    # The data log is copied once and written in chunks, the complete JSON
+    # string is never built in memory.
     def save_to_file(self):
         date_time_string = datetime.now().isoformat("_", "seconds")
         filename = f"{self.filename_base}_{date_time_string}.json"
         file_obj = self.save_dir.joinpath(filename)
         logger.info(f"Saving Picalor measurements to file: {str(file_obj)}")
+        data = self.snapshot()
+        log = data.pop("data_log")
         try:
-            file_obj.write_text(self.as_json())
+            with open(file_obj, "w") as f:
+                # Results JSON object without the closing brace
+                f.write(results_to_json(data)[:-1])
+                f.write(', "data_log": ')
+                if log is None:
+                    f.write("null")
+                else:
+                    write_datalog_json(f, log)
+                f.write("}")
             return file_obj.name
         except OSError as e:
             logger.error(f"Could not write to file! Error: {str(e)}")
             raise
 
+    # This is thread-safe and can be called any time.
+    # Streams the data log rows with time stamps t_start <= time_s < t_stop
+    # into a JSON Lines or CSV file, see DataLogExporter.
+    # Returns a summary dictionary including the file name.
+    def export_datalog(self, fmt="jsonl", compress=False, t_start=None, t_stop=None):
+        log = self._published.get("data_log")
+        if log is None:
+            raise ValueError("Data log is not enabled")
+        meas_conf = self.conf.snapshot()["measurements"]
+        exporter = DataLogExporter(fmt, compress,
+                                   meas_conf.get("datalog_export_chunk_rows", 1000))
+        start, stop = log.time_range(t_start, t_stop)
+        # Exported row range in file name, never overwrite previous exports
+        stamp = log.start_time.replace(" ", "_")
+        name = f"picalor_datalog_{stamp}_rows_{start}-{stop}"
+        file_obj = self.save_dir.joinpath(f"{name}{exporter.suffix}")
+        n = 1
+        while file_obj.exists():
+            file_obj = self.save_dir.joinpath(f"{name}_{n}{exporter.suffix}")
+            n += 1
+        logger.info(f"Exporting data log to file: {str(file_obj)}")
+        try:
+            return exporter.export(log, file_obj, start, stop)
+        except OSError as e:
+            logger.error(f"Could not write to file! Error: {str(e)}")
+            raise
+
+    # This is thread-safe and never blocks.
+    # Copy of the data log rows with time stamps t_start <= time_s < t_stop,
+    # limited to the first datalog_slice_max_rows rows. Field "complete" is
+    # False if rows were left out due to the limit or overwritten meanwhile.
+    def datalog_slice(self, t_start=None, t_stop=None):
+        log = self._published.get("data_log")
+        if log is None:
+            return None
+        max_rows = int(self.conf.snapshot()["measurements"].get(
+            "datalog_slice_max_rows", 10_000))
+        start, stop = log.time_range(t_start, t_stop)
+        log_slice = log.snapshot(start, min(stop, start + max_rows)).as_dict()
+        log_slice["complete"] = log_slice["row_offset"] == start and stop - start <= max_rows
+        return log_slice
+
+    # This is thread-safe and never blocks.
+    # Decimated data log with at most n_points min/max/mean points for the
+    # time range t_start <= time_s < t_stop, see DataLogRef.decimate()
+    def datalog_range(self, t_start=None, t_stop=None, n_points=1000):
+        log = self._published.get("data_log")
+        if log is None:
+            return None
+        return log.decimate(t_start, t_stop, n_points)
+
     # Not thread-safe!
     def initialize_new(self):
         logger.debug("Initializing result storage..")
-        conf = self.conf
+        self.measurement_thread_close_datalog()
+        conf = self.conf.snapshot()
         data = {
             "title": "Picalor Measurement Results",
             "measurements": {
@@ -250,29 +436,46 @@ class PicalorResults():
                 "liter_sec": flow,
             })
         self.data = data
+        self.measurement_thread_publish()
 
     # Not thread-safe!
     def measurement_thread_initialize_datalog(self):
-        conf = self.conf
-        log = {
-            "start_time": None,
-            "scan_interval_s": conf["measurements"]["scan_interval_s"],
-            "info": [],
-            "time_s": [],
-            "t_upstream": [],
-            "t_downstream": [],
-            "flow_kg_sec": [],
-            "power_w": [],
-        }
-        for ch_conf in conf["measurements"]["chs"]:
-            log["info"].append(ch_conf["info"])
-            log["t_upstream"].append([])
-            log["t_downstream"].append([])
-            log["flow_kg_sec"].append([])
-            log["power_w"].append([])
-        now = datetime.now().isoformat(" ", "seconds")
-        log["start_time"] = now
+        conf = self.conf.snapshot()
+        self.measurement_thread_close_datalog()
+        info = [ch_conf["info"] for ch_conf in conf["measurements"]["chs"]]
+        # Data log rows are appended every n-th scan
+        scan_interval_s = (conf["measurements"]["scan_interval_s"]
+                           * conf["measurements"].get("publish_every_n_scans", 1))
+        log = PicalorDataLog(info, scan_interval_s, **self._datalog_options())
+        if conf["measurements"].get("datalog_stream_enabled", True):
+            stamp = log.start_time.replace(" ", "_")
+            log.segment_writer = DataLogSegmentWriter(
+                self.save_dir.joinpath(f"picalor_datalog_{stamp}"),
+                info,
+                scan_interval_s,
+                log.start_time,
+                int(conf["measurements"].get("datalog_segment_rows", 10_000)),
+                float(conf["measurements"].get("datalog_fsync_interval_s", 10.0)),
+            )
         self.data["data_log"] = log
+        self._log_rows_pushed = 0
+
+    # Not thread-safe!
+    # Flushes and closes the on-disk data log stream, if any
+    def measurement_thread_close_datalog(self):
+        if self.data.get("data_log") is not None:
+            self.data["data_log"].close()
+
+    # Capacity and overflow policy of the data log from config
+    def _datalog_options(self):
+        meas_conf = self.conf.snapshot()["measurements"]
+        return {
+            "capacity": int(meas_conf.get("datalog_capacity", 100_000)),
+            "overflow": str(meas_conf.get("datalog_overflow", "ring")),
+            "spill_dir": self.save_dir,
+            "pyramid_factor": int(meas_conf.get("datalog_pyramid_factor", 16)),
+            "pyramid_levels": int(meas_conf.get("datalog_pyramid_levels", 3)),
+        }
 
     # Direct element access is not thread-safe!
     def __setitem__(self, key, value):
@@ -282,4 +485,26 @@ class PicalorResults():
         return self.data[key]
 
     def __delitem__(self, key):
-        del self.data[key]
\ No newline at end of file
+        del self.data[key]
+
+
+# Serialization of results items which are not plain JSON types
+def _json_default(obj):
+    if isinstance(obj, (PicalorDataLog, DataLogSnapshot)):
+        return obj.as_dict()
+    if isinstance(obj, DataLogRef):
+        return obj.snapshot().as_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+# JSON string of results or results snapshots
+def results_to_json(data):
+    return json.dumps(data, default=_json_default).replace("NaN", "null")
+
+
+# Coalescing of live data snapshots which were not yet published:
+# Data log rows of the older snapshot are kept.
+def merge_live_snapshots(older, newer):
+    if older["data_log"] is not None and newer["data_log"] is not None:
+        newer["data_log"] = newer["data_log"].merge(older["data_log"])
+    return newer
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""Picalor offline reprocessing of raw ADC data captures
+
+Converts the raw ADC samples and flow sensor read-outs recorded with
+the "raw_capture_enabled" setting into a data log, using the configuration
+recorded with the capture or any other (e.g. corrected) configuration file.
+
+Raw samples are averaged over consecutive time intervals of the scan
+interval length. Flow sensor read-outs are interpolated to the interval
+centers. Flows of "fixed" flow sensors and the SENSITIVITY of "pulse" type
+flow sensors are taken from the configuration used for reprocessing.
+
+Output is a JSON file in the format of the "data_log" field of
+the Picalor results savefile.
+"""
+import sys
+import json
+import logging
+import argparse
+from pathlib import Path
+import numpy as np
+import tomlkit
+from pipyadc import ADS1256_definitions as adc_def
+from picalor.picalor_measurement import measurement_adc_inputs
+from picalor.picalor_conversion import BatchConverter
+from picalor.picalor_datalog import QUANTITIES, PicalorDataLog
+from picalor.picalor_rawcapture import read_capture_dir, read_capture_file
+from picalor.util_lib.pt1000_sensor import ptRTD_temperature, wheatstone
+
+logger = logging.getLogger("picalor_reprocess")
+
+# Raw samples are processed in chunks of this number of records
+CHUNK_ROWS = 1_000_000
+
+
+# Average raw ADC samples for each input in mux_seq over time intervals
+# [t_0 + k * interval_s, t_0 + (k+1) * interval_s) for k in range(n_bins).
+# Returns (n_bins, len(mux_seq)) array, NaN where no samples were recorded.
+def bin_averages(records, mux_seq, t_0, interval_s, n_bins):
+    n_inputs = len(mux_seq)
+    input_idx = np.full(256, -1)
+    input_idx[mux_seq] = np.arange(n_inputs)
+    sums = np.zeros(n_bins * n_inputs)
+    counts = np.zeros(n_bins * n_inputs)
+    for start in range(0, len(records), CHUNK_ROWS):
+        chunk = records[start:start+CHUNK_ROWS]
+        bins = ((chunk["time_s"] - t_0) // interval_s).astype(int)
+        cols = input_idx[chunk["mux"]]
+        valid = (bins >= 0) & (bins < n_bins) & (cols >= 0)
+        idxs = bins[valid] * n_inputs + cols[valid]
+        sums += np.bincount(idxs, weights=chunk["value"][valid],
+                            minlength=n_bins*n_inputs)
+        counts += np.bincount(idxs, minlength=n_bins*n_inputs)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (sums / counts).reshape(n_bins, n_inputs)
+
+
+# Flow sensor read-outs interpolated to the bin centers, one column per
+# flow sensor of the reprocessing configuration.
+def bin_flows(flows, conf, capture_conf, t_0, interval_s, n_bins):
+    t_bins = t_0 + (np.arange(n_bins) + 0.5) * interval_s
+    captured_sensors = capture_conf["flow_sensors"]
+    flow_liter_sec = np.full((n_bins, len(conf["flow_sensors"])), np.nan)
+    for i, sensor_conf in enumerate(conf["flow_sensors"]):
+        if sensor_conf["type"] == "fixed":
+            flow_liter_sec[:, i] = sensor_conf["FLOW_LITER_SEC"]
+            continue
+        records = flows[flows["sensor"] == i]
+        if i >= len(captured_sensors) or len(records) == 0:
+            logger.warning(f"No captured data for flow sensor: {sensor_conf['info']}")
+            continue
+        flow_liter_sec[:, i] = np.interp(t_bins, records["time_s"], records["liter_sec"])
+        # Flow sensor sensitivity correction
+        captured = captured_sensors[i]
+        if captured["type"] == "pulse":
+            flow_liter_sec[:, i] *= captured["SENSITIVITY"] / sensor_conf["SENSITIVITY"]
+    return flow_liter_sec
+
+
+# Temperature of a flow sensor temperature channel which is not part of any
+# measurement channel, same evaluation as in AdcAcquisitionPlan.
+def flow_only_temperature(averages, mux_seq, adc_conf, temp_ch):
+    r_ref_mux = getattr(adc_def, adc_conf["r_ref"]["mux"])
+    r_ref_code = r_ref_mux << 4 | getattr(adc_def, adc_conf["aincom"]["mux"])
+    ch_conf = adc_conf["temp_chs"][temp_ch]
+    ch_code = getattr(adc_def, ch_conf["mux"]) << 4 | r_ref_mux
+    if ch_code not in mux_seq:
+        return np.nan
+    u_ref = averages[:, mux_seq.index(r_ref_code)] - adc_conf["r_ref"]["adc_offset"]
+    u_ch = averages[:, mux_seq.index(ch_code)] - ch_conf["adc_offset"]
+    n_ref = adc_conf["r_ref"]["r_s"] / adc_conf["r_ref"]["r_ref"]
+    r = wheatstone(u_ch, u_ref, n_ref, ch_conf["r_s"])
+    r += ch_conf.get("r_quad", 0.0) * (r / ch_conf["r_s"])**2 - ch_conf["r_offset"]
+    return ptRTD_temperature(r)
+
+
+def reprocess(capture_dir, conf=None, interval_s=None):
+    metadata, capture_conf, flows = read_capture_dir(capture_dir)
+    if conf is None:
+        conf = capture_conf
+    if interval_s is None:
+        interval_s = metadata["scan_interval_s"]
+    # Raw samples of all ADCs
+    records = {
+        key: (read_capture_file(Path(capture_dir).joinpath(adc["file"])),
+              adc["mux_seq"])
+        for key, adc in metadata["adcs"].items()
+    }
+    times = [r["time_s"][[0, -1]] for r, _ in records.values() if len(r)]
+    if not times:
+        raise ValueError("No raw ADC samples found")
+    t_0 = min(t[0] for t in times)
+    n_bins = int((max(t[1] for t in times) - t_0) // interval_s) + 1
+    logger.info(f"Averaging raw samples into {n_bins} intervals of {interval_s} s")
+    averages = {key: (bin_averages(r, mux_seq, t_0, interval_s, n_bins), mux_seq)
+                for key, (r, mux_seq) in records.items()}
+    # Input table for all measurement channels of the new configuration
+    chs = conf["measurements"]["chs"]
+    adc_unscaled = np.empty((n_bins, len(chs), 3))
+    for i, ch in enumerate(chs):
+        adc_key = ch["adc_device"]
+        if adc_key not in averages:
+            raise ValueError(f"No raw data captured for ADC: {adc_key}")
+        avg, mux_seq = averages[adc_key]
+        adc_inputs = measurement_adc_inputs(conf["adcs"][adc_key], ch)
+        for k, (mux_code, adc_offset) in enumerate(adc_inputs):
+            if mux_code not in mux_seq:
+                raise ValueError(f"ADC input not captured for channel: {ch['info']}")
+            adc_unscaled[:, i, k] = avg[:, mux_seq.index(mux_code)] - adc_offset
+    converter = BatchConverter(conf)
+    r_up, r_dn, t_up, t_dn = converter.temperatures(adc_unscaled)
+    t_flow = converter.flow_temperatures(t_up, t_dn)
+    for i in np.flatnonzero(converter.t_flow_src < 0):
+        adc_key = chs[i]["adc_device"]
+        avg, mux_seq = averages[adc_key]
+        t_flow[:, i] = flow_only_temperature(
+            avg, mux_seq, conf["adcs"][adc_key], chs[i]["flow_sensor_temp_ch"])
+    flow_liter_sec = bin_flows(flows, conf, capture_conf, t_0, interval_s, n_bins)
+    flow_kg_sec, power = converter.powers(
+        t_up, t_dn, t_flow, flow_liter_sec[:, converter.flow_sensor_idx])
+    results = {
+        "t_upstream": t_up,
+        "t_downstream": t_dn,
+        "flow_kg_sec": flow_kg_sec,
+        "power_w": power,
+    }
+    # Intervals without samples are omitted
+    valid = np.flatnonzero(~np.isnan(adc_unscaled).any(axis=(1, 2)))
+    datalog = PicalorDataLog([ch["info"] for ch in chs], interval_s,
+                             capacity=max(len(valid), 1))
+    datalog.start_time = metadata["start_time"]
+    for k in valid:
+        datalog.append(round(k * interval_s, 6),
+                       {key: results[key][k] for key in QUANTITIES})
+    return datalog.as_dict()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reprocess a Picalor raw ADC data capture")
+    parser.add_argument("capture_dir",
+                        help='raw capture folder "picalor_raw_[start time]"')
+    parser.add_argument("-c", "--config",
+                        help="configuration file used for reprocessing, "
+                             "default is the configuration of the capture")
+    parser.add_argument("-o", "--output",
+                        help="output JSON file, default is "
+                             "picalor_reprocessed.json in the capture folder")
+    parser.add_argument("-i", "--interval", type=float,
+                        help="averaging interval in seconds, "
+                             "default is the scan interval of the capture")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    conf = None
+    if args.config is not None:
+        conf = tomlkit.loads(Path(args.config).read_text())
+    try:
+        log = reprocess(args.capture_dir, conf, args.interval)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Reprocessing failed! Error: {e}")
+        sys.exit(1)
+    out_file = args.output
+    if out_file is None:
+        out_file = Path(args.capture_dir).joinpath("picalor_reprocessed.json")
+    Path(out_file).write_text(json.dumps(log).replace("NaN", "null"))
+    print(f"{len(log['time_s'])} data log rows written to: {out_file}")
+
+
+if __name__ == "__main__":
+    main()
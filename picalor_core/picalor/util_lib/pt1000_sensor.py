@@ -2,6 +2,18 @@
 import numpy as np
 
 
+# Callendar-Van Dusen coefficients for platinum RTDs (ITS-90)
+PT_A =  3.9083E-3
+PT_B = -5.775E-7
+# Only for negative temperatures
+PT_C = -4.183E-12
+# Polynomial correction coefficients for negative temperatures, see below
+PT_NEG_CORRECTION = np.array(
+    [1.51892983e+00, -2.85842067e+00, -5.34227299e+00,
+     1.80282972e+01, -1.61875985e+01,  4.84112370e+00]
+)
+
+
 def ptRTD_temperature(r_x, r_0=1000.0):
     """Quadratic equation for the temperature of platinum RTDs.
     This is the inversion of the H.L.Callendar polynomial for positive
@@ -20,22 +32,37 @@ def ptRTD_temperature(r_x, r_0=1000.0):
 
     Source for the correction term:
     https://github.com/ulikoehler/UliEngineering
+
+    Arguments can be scalars or numpy arrays (elementwise operation).
     """
-    PT_A =  3.9083E-3
-    PT_B = -5.775E-7
     # Uncorrected solution which is exact for positive temperatures
-    r_norm = r_x / r_0
+    r_norm = np.asarray(r_x) / r_0
     theta = (- PT_A + np.sqrt(PT_A**2 - 4*PT_B*(1 - r_norm))
             ) / (2*PT_B)
-    if r_norm < 1.0:
-        # Polynomial correction only for negative temperatures
-        correction = np.poly1d(
-            [1.51892983e+00, -2.85842067e+00, -5.34227299e+00,
-             1.80282972e+01, -1.61875985e+01,  4.84112370e+00]
-        )
-        return theta + correction(r_norm)
-    else:
-        return theta
+    # Polynomial correction only for negative temperatures
+    theta = np.where(r_norm < 1.0,
+                     theta + np.polyval(PT_NEG_CORRECTION, r_norm),
+                     theta)
+    if theta.ndim == 0:
+        return float(theta)
+    return theta
+
+
+def ptRTD_resistance(theta, r_0=1000.0):
+    """Callendar-Van Dusen equation for the resistance of platinum RTDs
+    at temperature theta in °C according to the ITS-90 scale.
+
+    Arguments can be scalars or numpy arrays (elementwise operation).
+    """
+    theta = np.asarray(theta, dtype=float)
+    r_norm = 1.0 + PT_A*theta + PT_B*theta**2
+    r_norm = np.where(theta < 0.0,
+                      r_norm + PT_C*(theta - 100.0)*theta**3,
+                      r_norm)
+    r_x = r_0 * r_norm
+    if r_x.ndim == 0:
+        return float(r_x)
+    return r_x
 
 
 def wheatstone(ud, u0, nref, rs1):
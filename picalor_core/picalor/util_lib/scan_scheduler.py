@@ -0,0 +1,99 @@
+import math
+import time
+
+
+class ScanScheduler():
+    """Drift-free periodic scheduling based on the monotonic clock
+
+    Ticks are scheduled at fixed multiples of the (float) interval from the
+    start time, so that there is no accumulating drift and wall clock
+    changes (e.g. NTP steps) have no effect.
+
+    When processing of the previous tick runs past the time of the next tick
+    (overrun), the next scan is run immediately and all further missed ticks
+    are skipped, keeping the time grid.
+
+    Timing statistics are accumulated for overruns and for the jitter,
+    i.e. the delay between scheduled tick time and actual wake-up time.
+
+    With a time_scale other than 1.0, all times are in simulated time
+    running time_scale times faster than the monotonic clock.
+    """
+    def __init__(self, interval_s, time_scale=1.0):
+        if interval_s <= 0.0:
+            raise ValueError("Scan interval must be a positive number")
+        if time_scale <= 0.0:
+            raise ValueError("Time scale must be a positive number")
+        self.interval_s = float(interval_s)
+        self.time_scale = float(time_scale)
+        self._t_origin = time.monotonic()
+        self._t_start = self._now()
+        # Scheduled (monotonic) time of the current tick
+        self.t_tick = self._t_start
+        # Tick index of the current tick, counted from start
+        self.n_tick = 0
+        # True if the current tick was reached only after its scheduled time
+        self.overrun = False
+        self.reset_stats()
+
+    # Change interval, the next tick is one new interval after the last one.
+    def set_interval(self, interval_s):
+        if interval_s <= 0.0:
+            raise ValueError("Scan interval must be a positive number")
+        self._t_start = self.t_tick
+        self.n_tick = 0
+        self.interval_s = float(interval_s)
+
+    # Sleeps until the next scheduled tick. If stop_event is set while
+    # waiting, returns early with a False value, otherwise returns True.
+    def wait_next(self, stop_event=None):
+        self.n_tick += 1
+        t_next = self._t_start + self.n_tick * self.interval_s
+        delay = t_next - self._now()
+        self.overrun = delay <= 0.0
+        if not self.overrun:
+            if stop_event is not None:
+                if stop_event.wait(delay / self.time_scale):
+                    return False
+            else:
+                time.sleep(delay / self.time_scale)
+        else:
+            # Skip all missed ticks, i.e. those already in the past
+            n_missed = math.floor(-delay / self.interval_s)
+            self.n_tick += n_missed
+            self.n_overruns += 1
+            self.n_missed += n_missed
+            # Actual time of this scan is now, not t_next
+            t_next = self._now()
+        self.t_tick = t_next
+        jitter = self._now() - t_next
+        self.n_ticks += 1
+        self._jitter_sum += jitter
+        self._jitter_sq_sum += jitter * jitter
+        self.jitter_max_s = max(self.jitter_max_s, jitter)
+        return True
+
+    # Monotonic clock, scaled by time_scale
+    def _now(self):
+        return self._t_origin + (time.monotonic() - self._t_origin) * self.time_scale
+
+    def reset_stats(self):
+        self.n_ticks = 0
+        self.n_overruns = 0
+        self.n_missed = 0
+        self.jitter_max_s = 0.0
+        self._jitter_sum = 0.0
+        self._jitter_sq_sum = 0.0
+
+    # Summary of timing statistics
+    def stats(self):
+        n = max(self.n_ticks, 1)
+        return {
+            "interval_s": self.interval_s,
+            "n_ticks": self.n_ticks,
+            "n_overruns": self.n_overruns,
+            "n_missed": self.n_missed,
+            "jitter_mean_s": self._jitter_sum / n,
+            "jitter_rms_s": math.sqrt(self._jitter_sq_sum / n),
+            "jitter_max_s": self.jitter_max_s,
+        }
@@ -0,0 +1,188 @@
+import time
+import math
+import threading
+import logging
+import numpy as np
+from pipyadc import ADS1256_definitions as adc_def
+from picalor.util_lib.pt1000_sensor import ptRTD_resistance
+
+logger = logging.getLogger("simulated_hardware")
+
+# ADS1256 input multiplexer value of the AINCOM input
+AINCOM_INPUT = adc_def.NEG_AINCOM
+# Full scale output code of the ADS1256
+ADC_CODE_MAX = 2**23 - 1
+
+
+class SimulatedClock():
+    """Monotonic clock running time_scale times faster than real time"""
+    def __init__(self, time_scale=1.0):
+        if time_scale <= 0.0:
+            raise ValueError("Time scale must be a positive number")
+        self.time_scale = float(time_scale)
+        self._t_origin = time.monotonic()
+
+    # Simulated time in seconds since start of simulation
+    def now(self):
+        return (time.monotonic() - self._t_origin) * self.time_scale
+
+    # Sleep for a duration of simulated time
+    def sleep(self, duration_s):
+        if duration_s > 0.0:
+            time.sleep(duration_s / self.time_scale)
+
+
+class SimulatedPi():
+    """Replacement for the pigpio.pi() object for running the Picalor
+    application without hardware, e.g. for benchmarks and soak tests
+
+    Supports the subset of the pigpio API used by FlowSensorPulseType.
+    Flow sensor pulses are generated on demand, i.e. all GPIO callbacks
+    due are run when get_current_tick() is called, without extra threads.
+    Pulse periods are flow_pulse_hz with random relative jitter.
+
+    sim_conf is the [simulation] section of the configuration.
+    """
+    def __init__(self, sim_conf):
+        self.sim_conf = sim_conf
+        self.clock = SimulatedClock(sim_conf.get("time_scale", 1.0))
+        self.time_scale = self.clock.time_scale
+        self.connected = True
+        self.flow_pulse_hz = float(sim_conf.get("flow_pulse_hz", 85.0))
+        self.flow_jitter = float(sim_conf.get("flow_jitter", 0.01))
+        self._rng = np.random.default_rng()
+        self._callbacks = []
+        self._lock = threading.Lock()
+        logger.warning(f"Using simulated hardware, time scale: {self.time_scale}")
+
+    def stop(self):
+        with self._lock:
+            self._callbacks = []
+
+    # Simulated microseconds since start, wrapping at 32 bits like pigpio
+    def get_current_tick(self):
+        tick_us = int(self.clock.now() * 1e6)
+        self._run_callbacks(tick_us)
+        return tick_us & 0xFFFFFFFF
+
+    def set_mode(self, gpio, mode):
+        pass
+
+    def set_pull_up_down(self, gpio, pud):
+        pass
+
+    def callback(self, user_gpio, edge, func):
+        cb = _SimulatedCallback(self, user_gpio, func, int(self.clock.now() * 1e6))
+        with self._lock:
+            self._callbacks.append(cb)
+        return cb
+
+    def _run_callbacks(self, tick_us):
+        if self.flow_pulse_hz <= 0.0:
+            return
+        period_us = 1e6 / self.flow_pulse_hz
+        with self._lock:
+            callbacks = list(self._callbacks)
+        for cb in callbacks:
+            while cb.next_tick_us <= tick_us:
+                cb.func(cb.gpio, 0, int(cb.next_tick_us) & 0xFFFFFFFF)
+                jitter = self.flow_jitter * self._rng.standard_normal()
+                cb.next_tick_us += period_us * max(1.0 + jitter, 0.1)
+
+    def _cancel(self, cb):
+        with self._lock:
+            if cb in self._callbacks:
+                self._callbacks.remove(cb)
+
+
+class _SimulatedCallback():
+    def __init__(self, pi, gpio, func, tick_us):
+        self.pi = pi
+        self.gpio = gpio
+        self.func = func
+        self.next_tick_us = tick_us
+
+    def cancel(self):
+        self.pi._cancel(self)
+
+
+class SimulatedADS1256():
+    """Replacement for the pipyadc ADS1256 class for running the Picalor
+    application without hardware
+
+    Output codes are calculated for the bridge circuit of the Picalor
+    hardware (see Measurement), with all bridge legs supplied by
+    excitation_code (in ADC output code units). Temperature channel i has
+    a Pt1000 sensor at the synthetic temperature:
+
+        temperature_c + i * temperature_step_c
+        + temperature_swing_c * sin(2 pi t / temperature_period_s)
+
+    The calibration resistance offset of each channel is added, so that the
+    configured calibration values are recovered. Gaussian noise of
+    noise_rms_codes is added to each sample.
+
+    Each conversion takes conversion_time_s of simulated time. If that is not
+    configured, this is the inverse of the configured data rate (drate).
+
+    Supports the subset of the ADS1256 API used by the Picalor application.
+    """
+    def __init__(self, conf, pi, adc_conf):
+        sim_conf = pi.sim_conf
+        self.clock = pi.clock
+        drate_names = {getattr(adc_def, name): name
+                       for name in dir(adc_def) if name.startswith("DRATE_")}
+        drate = float(drate_names[conf.drate][6:].replace("_", "."))
+        self.conversion_time_s = float(sim_conf.get("conversion_time_s", 1.0/drate))
+        self.excitation_code = float(sim_conf.get("excitation_code", 33_300_000))
+        self.noise_rms_codes = float(sim_conf.get("noise_rms_codes", 10.0))
+        self.temperature_c = float(sim_conf.get("temperature_c", 25.0))
+        self.temperature_step_c = float(sim_conf.get("temperature_step_c", 1.0))
+        self.temperature_swing_c = float(sim_conf.get("temperature_swing_c", 0.5))
+        self.temperature_period_s = float(sim_conf.get("temperature_period_s", 600.0))
+        self._rng = np.random.default_rng()
+        # Bridge high-side and low-side resistances for each ADC input.
+        # Unused inputs are at 0V, same as AINCOM.
+        self._rs = np.ones(AINCOM_INPUT + 1)
+        self._r_fixed = np.zeros(AINCOM_INPUT + 1)
+        r_ref_input = getattr(adc_def, adc_conf["r_ref"]["mux"])
+        self._rs[r_ref_input] = adc_conf["r_ref"]["r_s"]
+        self._r_fixed[r_ref_input] = adc_conf["r_ref"]["r_ref"]
+        temp_chs = adc_conf["temp_chs"]
+        self._temp_inputs = np.array([getattr(adc_def, ch["mux"]) for ch in temp_chs])
+        self._rs[self._temp_inputs] = [ch["r_s"] for ch in temp_chs]
+        self._r_offsets = np.array([ch["r_offset"] for ch in temp_chs], dtype=float)
+        self._temp_ch_idxs = np.arange(len(temp_chs))
+
+    def cal_self(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def read_sequence(self, ch_sequence, ch_buffer=None):
+        return self.read_continue(ch_sequence, ch_buffer)
+
+    def read_continue(self, ch_sequence, ch_buffer=None):
+        codes = np.asarray(ch_sequence, dtype=int)
+        self.clock.sleep(len(codes) * self.conversion_time_s)
+        u_nodes = self._node_voltages(self.clock.now())
+        values = (u_nodes[codes >> 4] - u_nodes[codes & 0xF]
+                  + self.noise_rms_codes * self._rng.standard_normal(len(codes)))
+        values = np.clip(np.rint(values), -ADC_CODE_MAX - 1, ADC_CODE_MAX).astype(int)
+        if ch_buffer is None:
+            return values.tolist()
+        ch_buffer[:] = values
+        return ch_buffer
+
+    # Bridge node voltages for all ADC inputs in output code units
+    def _node_voltages(self, t_s):
+        temperatures = (
+              self.temperature_c
+            + self.temperature_step_c * self._temp_ch_idxs
+            + self.temperature_swing_c * math.sin(
+                2*math.pi * t_s / self.temperature_period_s)
+        )
+        r = self._r_fixed.copy()
+        r[self._temp_inputs] = ptRTD_resistance(temperatures) + self._r_offsets
+        return self.excitation_code * r / (self._rs + r)
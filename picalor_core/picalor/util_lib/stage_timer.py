@@ -0,0 +1,86 @@
+import time
+import threading
+import numpy as np
+
+
+class StageTimers():
+    """Per-stage timing statistics for a processing loop
+
+    Durations of each named stage are kept in a ring buffer of the latest
+    window values, from which the rolling median, 99th percentile and
+    maximum are calculated on demand. The all-time maximum is kept as well.
+
+    Timing is done with laps of the monotonic performance counter:
+
+        t = time.perf_counter()
+        do_something()
+        t = stage_timers.lap("something", t)
+        do_something_else()
+        t = stage_timers.lap("something_else", t)
+
+    Recording is done from one thread, stats() can be called from any thread.
+    """
+    def __init__(self, window=1000):
+        if window < 1:
+            raise ValueError("Window must be at least one value")
+        self.window = int(window)
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    # Record duration since t_start for the stage, returns the current time
+    def lap(self, stage, t_start):
+        t_now = time.perf_counter()
+        self.record(stage, t_now - t_start)
+        return t_now
+
+    def record(self, stage, duration_s):
+        with self._lock:
+            data = self._stages.get(stage)
+            if data is None:
+                data = self._stages[stage] = _StageData(self.window)
+            data.add(duration_s)
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+
+    # Latest duration of each stage
+    def last(self):
+        with self._lock:
+            return {stage: data.last_s for stage, data in self._stages.items()}
+
+    # Dictionary of statistics for each stage, times in seconds
+    def stats(self):
+        with self._lock:
+            stages = {stage: (data.values(), data.last_s, data.max_all_s, data.n)
+                      for stage, data in self._stages.items()}
+        result = {}
+        for stage, (values, last_s, max_all_s, n) in stages.items():
+            p50, p99 = np.percentile(values, (50.0, 99.0))
+            result[stage] = {
+                "n": n,
+                "last_s": last_s,
+                "p50_s": float(p50),
+                "p99_s": float(p99),
+                "max_s": float(np.max(values)),
+                "max_all_s": max_all_s,
+            }
+        return result
+
+
+class _StageData():
+    def __init__(self, window):
+        self._buf = np.zeros(window)
+        self.n = 0
+        self.last_s = 0.0
+        self.max_all_s = 0.0
+
+    def add(self, duration_s):
+        self._buf[self.n % len(self._buf)] = duration_s
+        self.n += 1
+        self.last_s = duration_s
+        self.max_all_s = max(self.max_all_s, duration_s)
+
+    # Copy of the values in the window
+    def values(self):
+        return self._buf[:min(self.n, len(self._buf))].copy()
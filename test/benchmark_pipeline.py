@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""Picalor measurement pipeline benchmarks
+
+Times the hot paths of each scan and of the publishing and saving of
+results, using the simulated hardware backend with zero ADC conversion
+time. Runs without the pigpio daemon and, except for the optional MQTT
+benchmark, without an MQTT broker.
+
+Results can be saved as a baseline JSON file and compared against on
+later runs. A benchmark is reported as a regression if it is slower than
+the baseline by more than the tolerance, in which case the exit code is 1.
+Baselines are only comparable on the same machine, i.e. they should be
+recorded on the Raspberry Pi the application is deployed on.
+
+Usage examples:
+    python3 test/benchmark_pipeline.py --save-baseline
+    python3 test/benchmark_pipeline.py --tolerance 0.2 --mqtt
+"""
+import os
+import sys
+import json
+import timeit
+import platform
+import argparse
+import tempfile
+import logging
+from pathlib import Path
+
+# Default configuration and an empty savedata folder are used
+os.environ["HOME"] = tempfile.mkdtemp(prefix="picalor_benchmark_")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath("picalor_core")))
+
+import numpy as np
+from picalor.picalor_state import PicalorState
+from picalor.picalor_datalog import QUANTITIES, PicalorDataLog
+from picalor.picalor_measurement_daemon import PicalorMeasurementDaemon
+from picalor.picalor_mqtt import PicalorMqtt
+from picalor.util_lib.scan_scheduler import ScanScheduler
+from picalor.util_lib.simulated_hardware import SimulatedPi
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent.joinpath("benchmark_baseline.json")
+DATALOG_SIZES = {"1k": 1_000, "100k": 100_000, "1M": 1_000_000}
+
+
+class NullApi():
+    def push_error_str(self, message):
+        pass
+
+    def send_response(self, cmd_name, response_json="true", success=True):
+        pass
+
+    def push_live_data(self):
+        pass
+
+
+def make_daemon():
+    state = PicalorState()
+    sim_conf = state.conf["simulation"]
+    sim_conf["conversion_time_s"] = 0.0
+    sim_conf["flow_pulse_hz"] = 0.0
+    state.conf["measurements"]["datalog_enabled"] = False
+    # Direct changes of the document are only seen after refreshing
+    state.conf.refresh_snapshot()
+    daemon = PicalorMeasurementDaemon(SimulatedPi(sim_conf), state, NullApi())
+    daemon._configure_and_start_sensors()
+    daemon._configure_measurements_enable_acquisition()
+    daemon.scan_scheduler = ScanScheduler(
+        float(state.conf["measurements"]["scan_interval_s"]))
+    daemon._acquire_measurement_data(log_data=False)
+    return daemon
+
+
+def make_datalog(info, n_rows):
+    log = PicalorDataLog(info, 1.0, capacity=n_rows)
+    rng = np.random.default_rng(0)
+    row = {key: rng.standard_normal(len(info)) for key in QUANTITIES}
+    for i in range(n_rows):
+        log.append(float(i), row)
+    return log
+
+
+# Returns dictionary of benchmark names and callables
+def make_benchmarks(args):
+    daemon = make_daemon()
+    state = daemon.state
+    converter = daemon.converter
+    table = daemon.acquisition_scheduler.adc_unscaled_table(daemon.measurements)
+    r_up, r_dn, t_up, t_dn = converter.temperatures(table)
+    t_flow = converter.flow_temperatures(t_up, t_dn)
+    flow_liter_sec = np.full(len(daemon.measurements), 10e-3)
+    fluid = next(iter(daemon.fluids.values()))
+    t_array = np.linspace(0.0, 100.0, 1000)
+    benchmarks = {
+        "scan_full": daemon._acquire_measurement_data,
+        "conversion_temperatures": lambda: converter.temperatures(table),
+        "conversion_powers":
+            lambda: converter.powers(t_up, t_dn, t_flow, flow_liter_sec),
+        "fluid_scalar": lambda: (fluid.get_c_th(25.0), fluid.get_density(25.0)),
+        "fluid_array_1k": lambda: (fluid.get_c_th(t_array), fluid.get_density(t_array)),
+        "config_as_json": state.conf.as_json,
+        "config_refresh_snapshot": state.conf.refresh_snapshot,
+        "results_publish": state.results.measurement_thread_publish,
+    }
+    info = [ch["info"] for ch in state.conf["measurements"]["chs"]]
+    sizes = ["1k", "100k"] if args.quick else list(DATALOG_SIZES)
+    for size in sizes:
+        names = (f"results_as_json_{size}", f"results_save_to_file_{size}",
+                 f"datalog_export_jsonl_{size}", f"datalog_decimate_{size}")
+        if not any(args.filter in name for name in names):
+            continue
+        log = make_datalog(info, DATALOG_SIZES[size])
+        # Default arguments bind the current data log
+        def as_json(log=log):
+            state.results["data_log"] = log
+            state.results.measurement_thread_publish()
+            return state.results.as_json()
+        benchmarks[f"results_as_json_{size}"] = as_json
+        benchmarks[f"datalog_decimate_{size}"] = lambda log=log: log.ref().decimate()
+        if size != "1M":
+            def save_to_file(log=log):
+                state.results["data_log"] = log
+                state.results.measurement_thread_publish()
+                file_obj = state.results.save_dir.joinpath(state.results.save_to_file())
+                file_obj.unlink()
+            benchmarks[f"results_save_to_file_{size}"] = save_to_file
+            def export_datalog(log=log):
+                state.results["data_log"] = log
+                state.results.measurement_thread_publish()
+                summary = state.results.export_datalog("jsonl")
+                state.results.save_dir.joinpath(summary["filename"]).unlink()
+            benchmarks[f"datalog_export_jsonl_{size}"] = export_datalog
+    if args.mqtt:
+        mqtt = PicalorMqtt(None, state.conf["mqtt"])
+        try:
+            mqtt.launch_client_thread()
+        except (OSError, ConnectionError) as e:
+            print(f"MQTT benchmark skipped, no broker connection: {e}")
+        else:
+            state.results["data_log"] = make_datalog(info, 1_000)
+            state.results.measurement_thread_publish()
+            payload = state.results.as_json()
+            benchmarks["mqtt_publish_results_1k"] = (
+                lambda: mqtt.push_data_json("benchmark", payload))
+    return benchmarks
+
+
+# Best time per call of repeated timing runs, in seconds
+def run_benchmark(func, repeat, min_time_s):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time_s / 0.2))
+    return min(timer.repeat(repeat, number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Picalor measurement pipeline benchmarks")
+    parser.add_argument("-b", "--baseline", default=str(DEFAULT_BASELINE),
+                        help="baseline JSON file")
+    parser.add_argument("-s", "--save-baseline", action="store_true",
+                        help="save results as new baseline")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.25,
+                        help="relative slow-down reported as regression")
+    parser.add_argument("-k", "--filter", default="",
+                        help="run only benchmarks with names containing this")
+    parser.add_argument("-q", "--quick", action="store_true",
+                        help="skip the largest data log size")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="minimum time of each timing run in seconds")
+    parser.add_argument("--mqtt", action="store_true",
+                        help="benchmark publishing to the configured MQTT broker")
+    args = parser.parse_args()
+    # Logging is configured by the picalor package
+    logging.getLogger().setLevel(logging.ERROR)
+    baseline_file = Path(args.baseline)
+    baseline = {}
+    if baseline_file.exists():
+        baseline = json.loads(baseline_file.read_text())
+        if baseline.get("machine") != platform.machine():
+            print(f"Warning: Baseline was recorded on: {baseline.get('machine')}")
+    elif not args.save_baseline:
+        print(f"No baseline found: {baseline_file}, record one with --save-baseline")
+    base_results = baseline.get("results", {})
+    results = {}
+    regressions = []
+    print(f"{'benchmark':32} {'time/call':>12} {'baseline':>12} {'ratio':>7}")
+    for name, func in make_benchmarks(args).items():
+        if args.filter not in name:
+            continue
+        t = run_benchmark(func, args.repeat, args.min_time)
+        results[name] = t
+        line = f"{name:32} {t*1e6:10.1f}µs"
+        if name in base_results:
+            ratio = t / base_results[name]
+            line += f" {base_results[name]*1e6:10.1f}µs {ratio:7.2f}"
+            if ratio > 1.0 + args.tolerance:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    if args.save_baseline:
+        baseline = {
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "results": {**base_results, **results},
+        }
+        baseline_file.write_text(json.dumps(baseline, indent=4))
+        print(f"Baseline saved to: {baseline_file}")
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
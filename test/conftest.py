@@ -0,0 +1,58 @@
+import sys
+import pytest
+from pathlib import Path
+
+# Tests run against the source tree without installing the package
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath("picalor_core")))
+
+from picalor.picalor_state import PicalorState
+from picalor.picalor_measurement_daemon import PicalorMeasurementDaemon
+from picalor.util_lib.simulated_hardware import SimulatedPi
+
+
+class NullApi():
+    def push_error_str(self, message):
+        pass
+
+    def send_response(self, cmd_name, response_json="true", success=True):
+        pass
+
+    def push_live_data(self):
+        pass
+
+    def push_calibration_status(self, jobs_json):
+        pass
+
+
+# Default configuration and an empty savedata folder, simulated hardware
+# with zero ADC conversion time
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    state = PicalorState()
+    sim_conf = state.conf["simulation"]
+    sim_conf["conversion_time_s"] = 0.0
+    sim_conf["flow_pulse_hz"] = 0.0
+    # Direct changes of the document are only seen after refreshing
+    state.conf.refresh_snapshot()
+    yield state
+    state.conf.close()
+
+
+# Returns a function setting up a measurement daemon for the current
+# configuration of state, without starting the measurement thread
+@pytest.fixture
+def make_daemon(state):
+    daemons = []
+    def make():
+        state.conf.refresh_snapshot()
+        pi = SimulatedPi(state.conf.snapshot()["simulation"])
+        daemon = PicalorMeasurementDaemon(pi, state, NullApi())
+        daemon._configure_and_start_sensors()
+        daemon._configure_measurements_enable_acquisition()
+        daemons.append(daemon)
+        return daemon
+    yield make
+    for daemon in daemons:
+        daemon.calibrator.stop()
+        daemon._stop_sensors_stop_acquisition()
@@ -0,0 +1,59 @@
+import time
+import threading
+import numpy as np
+
+
+# Records the name of the thread of each ADC read call
+def trace_reads(adc_obj):
+    calls = []
+    for name in ("read_sequence", "read_continue"):
+        method = getattr(adc_obj, name)
+        def traced(*args, method=method, **kwargs):
+            calls.append(threading.current_thread().name)
+            return method(*args, **kwargs)
+        setattr(adc_obj, name, traced)
+    return calls
+
+
+def wait_for(condition, timeout=10.0):
+    t_stop = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < t_stop, "Timeout"
+        time.sleep(0.001)
+
+
+# Acquisition set up new during a calibration job must not access the ADC
+# until the job has released it.
+def test_calibration_during_rebuild_in_continuous_mode(state, make_daemon):
+    state.conf["simulation"]["conversion_time_s"] = 0.0005
+    state.conf["measurements"]["acquisition_mode"] = "continuous"
+    state.conf["measurements"]["calibration_samples"] = 200
+    daemon = make_daemon()
+    calls = trace_reads(daemon.adc_objs["adc_1"])
+    wait_for(lambda: "adc_1 Sampler" in calls)
+    job_id = daemon.calibrator.start_job({"adc_key": "adc_1", "temp_ch_idx": 0,
+                                          "value_key": "cal_r_a",
+                                          "cal_resistance": 1000.0})["job_id"]
+    job = daemon.calibrator._jobs[job_id]
+    wait_for(lambda: job.n_acquired > 0)
+    # Same as a rebuild from the measurement thread, e.g. for a new r_s value
+    daemon._stop_acquisition()
+    daemon._configure_measurements_enable_acquisition()
+    daemon._acquire_measurement_data(log_data=False)
+    chs = state.results["measurements"]["chs"]
+    adc_keys = [m.adc_key for m in daemon.measurements]
+    assert not job.finished.is_set()
+    for ch, adc_key in zip(chs, adc_keys):
+        assert np.isnan(ch["t_upstream"]) == (adc_key == "adc_1")
+    assert job.finished.wait(10)
+    assert job.status == "done"
+    # No other ADC access between the first and last calibration read
+    cal_idxs = [i for i, name in enumerate(calls) if name == "Calibration Thread"]
+    assert len(cal_idxs) >= 200
+    assert cal_idxs[-1] - cal_idxs[0] == len(cal_idxs) - 1
+    # Sampling continues after the calibration
+    n_calls = len(calls)
+    wait_for(lambda: "adc_1 Sampler" in calls[n_calls:])
+    wait_for(lambda: not daemon.acquisition_scheduler.plans["adc_1"].sampler.blocked)
+    daemon._acquire_measurement_data(log_data=False)
+    assert not any(np.isnan(ch["t_upstream"]) for ch in chs)
@@ -0,0 +1,141 @@
+import json
+import math
+from picalor.picalor_config_diff import (ConfigChanges, config_patch, patch_path_parts,
+                                         plain_config)
+
+
+def test_equal_configs_have_empty_patch():
+    conf = {"a": 1, "b": {"c": [1.0, math.nan, "x"]}}
+    assert config_patch(conf, json.loads(json.dumps(conf))) == []
+
+
+def test_patch_operations():
+    old = {"a": 1, "b": {"c": 2, "d": 3}, "l": [1, 2], "m": [1, 2]}
+    new = {"a": 1, "b": {"c": 5, "e": 4}, "l": [1, 7], "m": [1, 2, 3]}
+    patch = config_patch(old, new)
+    assert sorted(patch, key=lambda op: op["path"]) == [
+        {"op": "replace", "path": "/b/c", "value": 5},
+        {"op": "remove", "path": "/b/d"},
+        {"op": "add", "path": "/b/e", "value": 4},
+        {"op": "replace", "path": "/l/1", "value": 7},
+        # Lists of different length are replaced as a whole
+        {"op": "replace", "path": "/m", "value": [1, 2, 3]},
+    ]
+
+
+def test_booleans_are_not_numbers():
+    assert config_patch({"a": 1}, {"a": True}) == [
+        {"op": "replace", "path": "/a", "value": True}]
+
+
+def test_path_escaping_round_trip():
+    patch = config_patch({}, {"a/b~c": 1})
+    assert patch[0]["path"] == "/a~1b~0c"
+    assert patch_path_parts(patch[0]["path"]) == ["a/b~c"]
+
+
+def test_plain_config_copy():
+    conf = {"a": [1, {"b": 2}]}
+    copy = plain_config(conf)
+    assert copy == conf and copy["a"] is not conf["a"]
+
+
+def changes(old, new):
+    return ConfigChanges(config_patch(old, new))
+
+
+def base_config():
+    return {
+        "adcs": {
+            "adc_1": {"ads1256_config": {"drate": "DRATE_10"},
+                      "temp_chs": [{"r_s": 10000.0}, {"r_s": 10000.0}]},
+            "adc_2": {"ads1256_config": {"drate": "DRATE_10"},
+                      "temp_chs": [{"r_s": 10000.0}]},
+        },
+        "flow_sensors": [{"type": "fixed"}, {"type": "pulse"}],
+        "fluids": {"water": {}},
+        "measurements": {
+            "scan_interval_s": 10,
+            "datalog_enabled": False,
+            "datalog_capacity": 100,
+            "chs": [{"info": "M1", "r_0_up": 1000.0}],
+        },
+        "mqtt": {"BROKER_HOST": "localhost"},
+    }
+
+
+def test_adc_hardware_change_restarts_only_that_adc():
+    new = base_config()
+    new["adcs"]["adc_2"]["ads1256_config"]["drate"] = "DRATE_100"
+    c = changes(base_config(), new)
+    assert c.restart_adcs == {"adc_2"}
+    assert c.changed_adcs == {"adc_2"}
+    assert c.rebuild_measurements
+    assert not (c.reinit_results or c.clear_datalog or c.restart_all_sensors)
+
+
+def test_calibration_value_change_only_rebuilds():
+    new = base_config()
+    new["adcs"]["adc_1"]["temp_chs"][1]["r_s"] = 9990.0
+    c = changes(base_config(), new)
+    assert c.rebuild_measurements
+    assert c.changed_adcs == {"adc_1"}
+    assert not (c.restart_adcs or c.reinit_results or c.clear_datalog)
+
+
+def test_number_of_temp_channels_reinitializes_results():
+    new = base_config()
+    new["adcs"]["adc_2"]["temp_chs"].append({"r_s": 10000.0})
+    assert changes(base_config(), new).reinit_results
+
+
+def test_flow_sensor_changes():
+    new = base_config()
+    new["flow_sensors"][1]["type"] = "fixed"
+    c = changes(base_config(), new)
+    assert c.restart_flow_sensors == {1}
+    assert not c.restart_all_flow_sensors
+    new["flow_sensors"].append({"type": "fixed"})
+    c = changes(base_config(), new)
+    assert c.restart_all_flow_sensors and c.reinit_results
+
+
+def test_measurement_settings():
+    new = base_config()
+    new["measurements"]["datalog_enabled"] = True
+    c = changes(base_config(), new)
+    assert c.patch and not (c.rebuild_measurements or c.clear_datalog)
+    new = base_config()
+    new["measurements"]["datalog_capacity"] = 200
+    c = changes(base_config(), new)
+    assert c.clear_datalog and not c.rebuild_measurements
+    new = base_config()
+    new["measurements"]["scan_interval_s"] = 5
+    c = changes(base_config(), new)
+    assert c.update_scan_interval and c.clear_datalog
+    new = base_config()
+    new["measurements"]["chs"][0]["r_0_up"] = 1000.5
+    c = changes(base_config(), new)
+    assert c.rebuild_measurements and not c.reinit_results
+    new["measurements"]["chs"][0]["info"] = "renamed"
+    assert changes(base_config(), new).reinit_results
+
+
+def test_unused_sections_need_no_action():
+    new = base_config()
+    new["mqtt"]["BROKER_HOST"] = "example"
+    assert changes(base_config(), new).summary() == {
+        "n_changes": 1,
+        "restart_adcs": [],
+        "restart_flow_sensors": [],
+        "restart_all_sensors": False,
+        "restart_all_flow_sensors": False,
+        "reinit_results": False,
+        "rebuild_measurements": False,
+        "clear_datalog": False,
+    }
+
+
+def test_patch_json_has_no_nan():
+    c = ConfigChanges(config_patch({"a": 1.0}, {"a": math.nan}))
+    assert json.loads(c.patch_json()) == [{"op": "replace", "path": "/a", "value": None}]
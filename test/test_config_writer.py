@@ -0,0 +1,62 @@
+import pytest
+from picalor.picalor_config_writer import ConfigFileWriter
+
+
+class Renderer():
+    def __init__(self):
+        self.n_calls = 0
+        self.text = "a = 1\n"
+
+    def __call__(self):
+        self.n_calls += 1
+        return self.text
+
+
+@pytest.fixture
+def writer(tmp_path):
+    render = Renderer()
+    writer = ConfigFileWriter(tmp_path.joinpath("config.toml"), render,
+                              n_backups=2, delay_s=0.05)
+    yield writer
+    writer.stop()
+
+
+def test_save_writes_file_atomically(writer):
+    assert writer.wait(writer.save(), timeout=5)
+    assert writer.file_obj.read_text() == "a = 1\n"
+    assert writer.last_error is None
+    assert [f.name for f in writer.file_obj.parent.iterdir()] == ["config.toml"]
+
+
+def test_requests_are_coalesced(writer):
+    for _ in range(5):
+        n_request = writer.save()
+    assert writer.wait(n_request, timeout=5)
+    assert writer.render.n_calls == 1
+
+
+def test_backups_are_rotated(writer):
+    for i in range(4):
+        writer.render.text = f"a = {i}\n"
+        assert writer.wait(writer.save(), timeout=5)
+    assert writer.file_obj.read_text() == "a = 3\n"
+    assert [f.read_text() for f in writer.backup_files()] == ["a = 2\n", "a = 1\n"]
+    assert not writer.file_obj.with_name("config.toml.3").exists()
+
+
+def test_stop_writes_pending_request(tmp_path):
+    render = Renderer()
+    writer = ConfigFileWriter(tmp_path.joinpath("config.toml"), render, delay_s=10.0)
+    writer.save()
+    writer.stop()
+    assert writer.file_obj.read_text() == "a = 1\n"
+
+
+def test_render_error_keeps_previous_file(writer):
+    assert writer.wait(writer.save(), timeout=5)
+    def fail():
+        raise ValueError("render failed")
+    writer.render = fail
+    assert writer.wait(writer.save(), timeout=5)
+    assert writer.last_error == "render failed"
+    assert writer.file_obj.read_text() == "a = 1\n"
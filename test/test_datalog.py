@@ -0,0 +1,143 @@
+import numpy as np
+import pytest
+from picalor.picalor_datalog import PicalorDataLog, QUANTITIES
+
+
+def make_log(n_rows, capacity, overflow="ring", spill_dir=None, **kwargs):
+    log = PicalorDataLog(["M1", "M2"], 1.0, capacity, overflow, spill_dir, **kwargs)
+    for i in range(n_rows):
+        append_row(log, i)
+    return log
+
+
+def append_row(log, i):
+    log.append(float(i), {key: [i + 0.25*k, -i] for k, key in enumerate(QUANTITIES)})
+
+
+def test_snapshot_of_full_ring_keeps_all_rows():
+    log = make_log(25, 10)
+    snap = log.ref().snapshot()
+    assert snap.row_offset == 15
+    assert snap.time_s.tolist() == [float(i) for i in range(15, 25)]
+    assert snap.columns["power_w"][1].tolist() == [-float(i) for i in range(15, 25)]
+
+
+def test_snapshot_range_and_quantities():
+    log = make_log(25, 10)
+    snap = log.ref().snapshot(18, 21, quantities=("t_upstream",))
+    assert snap.row_offset == 18
+    assert snap.time_s.tolist() == [18.0, 19.0, 20.0]
+    assert list(snap.columns) == ["t_upstream"]
+
+
+def test_snapshot_discards_rows_overwritten_after_ref():
+    log = make_log(25, 10)
+    ref = log.ref()
+    for i in range(25, 28):
+        append_row(log, i)
+    snap = ref.snapshot()
+    # Rows appended after creation of the reference are not included
+    assert snap.row_offset == 18
+    assert snap.time_s.tolist() == [float(i) for i in range(18, 25)]
+
+
+def test_snapshot_discards_row_of_append_in_progress():
+    log = make_log(25, 10)
+    ref = log.ref()
+    # Append started, but n_total not yet incremented
+    log._n_started = log.n_total + 1
+    assert ref.snapshot().row_offset == 16
+
+
+def test_snapshot_after_spill_is_empty(tmp_path):
+    log = make_log(10, 10, "spill", tmp_path)
+    ref = log.ref()
+    append_row(log, 10)
+    assert len(ref.snapshot()) == 0
+    assert len(list(tmp_path.glob("*.npz"))) == 1
+
+
+def test_time_range():
+    log = make_log(25, 10)
+    ref = log.ref()
+    assert ref.time_range() == (15, 25)
+    assert ref.time_range(17.5, 20.0) == (18, 20)
+    assert ref.time_range(30.0) == (25, 25)
+
+
+def test_from_dict_round_trip():
+    log = make_log(25, 10)
+    restored = PicalorDataLog.from_dict(log.as_dict())
+    assert restored.as_dict() == log.as_dict()
+    assert restored.first_row == 15
+
+
+# Row with absolute index i has time stamp i, see append_row()
+def assert_points_match_rows(decimated):
+    for p, (t_first, t_last) in enumerate(zip(decimated["time_s"], decimated["time_last_s"])):
+        rows = np.arange(int(t_first), int(t_last) + 1)
+        for k, key in enumerate(QUANTITIES):
+            for ch, values in enumerate([rows + 0.25*k, -rows]):
+                assert decimated[key]["min"][ch][p] == pytest.approx(values.min())
+                assert decimated[key]["max"][ch][p] == pytest.approx(values.max())
+                assert decimated[key]["mean"][ch][p] == pytest.approx(values.mean())
+
+
+def test_decimate_few_rows_returns_rows():
+    log = make_log(50, 100, pyramid_factor=4)
+    decimated = log.ref().decimate(10.0, 20.0, n_points=100)
+    assert decimated["rows_per_point"] == 1
+    assert decimated["time_s"] == [float(i) for i in range(10, 20)]
+    assert decimated["power_w"]["min"] == decimated["power_w"]["max"]
+
+
+def test_decimate_uses_pyramid_buckets():
+    log = make_log(1000, 1000, pyramid_factor=4, pyramid_levels=3)
+    decimated = log.ref().decimate(n_points=100)
+    assert len(decimated["time_s"]) <= 100
+    assert decimated["time_s"][0] == 0.0
+    assert decimated["time_last_s"][-1] == 999.0
+    # Points are contiguous
+    assert all(t_next == t_last + 1 for t_last, t_next
+               in zip(decimated["time_last_s"], decimated["time_s"][1:]))
+    assert_points_match_rows(decimated)
+
+
+def test_decimate_incomplete_bucket_from_rows():
+    log = make_log(1003, 1000, pyramid_factor=4, pyramid_levels=3)
+    decimated = log.ref().decimate(n_points=100)
+    assert decimated["time_last_s"][-1] == 1002.0
+    assert_points_match_rows(decimated)
+
+
+def test_decimate_keeps_history_beyond_capacity():
+    log = make_log(5000, 100, pyramid_factor=4, pyramid_levels=3)
+    decimated = log.ref().decimate(n_points=1000)
+    assert decimated["time_s"][0] < 4900.0
+    assert decimated["time_last_s"][-1] == 4999.0
+    assert_points_match_rows(decimated)
+
+
+def test_decimate_without_pyramid():
+    log = make_log(300, 1000, pyramid_levels=0)
+    decimated = log.ref().decimate(n_points=100)
+    assert len(decimated["time_s"]) == 100
+    assert decimated["rows_per_point"] == 3
+    assert_points_match_rows(decimated)
+
+
+def test_decimate_empty_range():
+    log = make_log(300, 1000, pyramid_factor=4)
+    decimated = log.ref().decimate(1000.0, 2000.0)
+    assert decimated["time_s"] == []
+    assert decimated["power_w"]["mean"] == [[], []]
+
+
+def test_pyramid_level_keeps_all_buckets_when_full():
+    log = make_log(5000, 100, pyramid_factor=4, pyramid_levels=1)
+    level = log.pyramid.levels[0]
+    t_first, _, offset, n_total = level.times()
+    assert n_total - offset == level.n_buckets
+    # Bucket append in progress overwrites the oldest bucket
+    level._n_started = level.n_total + 1
+    assert level.times()[2] == offset + 1
@@ -0,0 +1,66 @@
+import json
+import struct
+import numpy as np
+import pytest
+from picalor.picalor_datalog import PicalorDataLog, QUANTITIES
+from picalor.picalor_encoding import (JsonEncoder, MsgpackEncoder, StructEncoder,
+                                      STRUCT_HEADER_FORMAT, STRUCT_MAGIC, results_values)
+
+
+def make_results(n_rows=3):
+    log = PicalorDataLog(["M1", "M2"], 1.0, capacity=10)
+    for i in range(n_rows):
+        log.append(float(i), {key: [i, np.nan] for key in QUANTITIES})
+    chs = [{"info": info, **{key: 1.5 for key in QUANTITIES}} for info in log.info]
+    chs[1]["power_w"] = None
+    return {
+        "title": "Picalor Measurement Results",
+        "measurements": {"idx": 0, "chs": chs},
+        "adcs": {"adc_1": {"r_ref": {"adc_unscaled": 100.0},
+                           "temp_chs": [{"adc_unscaled": 1.0, "resistance": 2.0,
+                                         "temperature": 3.0}]}},
+        "flow_sensors": [{"info": "F1", "liter_sec": 0.01}],
+        "data_log": log.ref(),
+    }
+
+
+def test_results_values_names():
+    names = [name for name, _ in results_values(make_results())]
+    assert names[:4] == [f"chs/0/{key}" for key in QUANTITIES]
+    assert "adcs/adc_1/temp_chs/0/temperature" in names
+    assert names[-1] == "flow_sensors/0/liter_sec"
+
+
+def test_json_encoder_copies_datalog_ref():
+    payload, schema = JsonEncoder().encode("results", make_results())
+    data = json.loads(payload)
+    assert schema is None
+    assert data["data_log"]["time_s"] == [0.0, 1.0, 2.0]
+    assert data["data_log"]["power_w"][1] == [None, None, None]
+
+
+def test_msgpack_encoder_matches_json():
+    msgpack = pytest.importorskip("msgpack")
+    payload, _ = MsgpackEncoder().encode("results", make_results())
+    data = msgpack.unpackb(payload)
+    assert data["data_log"]["time_s"] == [0.0, 1.0, 2.0]
+    assert data["data_log"]["t_upstream"][0] == [0.0, 1.0, 2.0]
+
+
+def test_struct_encoder_layout_and_schema():
+    encoder = StructEncoder("<f4")
+    payload, schema_json = encoder.encode("results", make_results())
+    schema = json.loads(schema_json)
+    header_size = struct.calcsize(STRUCT_HEADER_FORMAT)
+    magic, schema_id, n_values, row_offset, n_rows, row_width = struct.unpack(
+        STRUCT_HEADER_FORMAT, payload[:header_size])
+    assert magic == STRUCT_MAGIC and schema_id == schema["schema_id"]
+    assert (row_offset, n_rows, row_width) == (0, 3, 1 + 2*len(QUANTITIES))
+    values = np.frombuffer(payload, "<f4", n_values, header_size)
+    assert len(schema["values"]) == n_values
+    assert np.isnan(values[schema["values"].index("chs/1/power_w")])
+    rows = np.frombuffer(payload, "<f4", offset=header_size + 4*n_values)
+    assert rows.reshape(n_rows, row_width)[:, 0].tolist() == [0.0, 1.0, 2.0]
+    # Schema is only returned when it has changed
+    assert encoder.encode("results", make_results(5))[1] is None
+    assert encoder.encode("results", {**make_results(), "data_log": None})[1] is not None
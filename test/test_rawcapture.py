@@ -0,0 +1,95 @@
+import sys
+import json
+import time
+import numpy as np
+import tomlkit
+from picalor.picalor_datalog import QUANTITIES
+from picalor.picalor_rawcapture import (RawCapture, RawCaptureFile, RawAdcRecorder,
+                                        read_capture_dir, read_capture_file,
+                                        METADATA_FILENAME, RAW_SAMPLE_DTYPE)
+from picalor.scripts.picalor_reprocess import reprocess, main
+
+
+def test_capture_from_picalor_config(state, tmp_path):
+    capture = RawCapture(tmp_path.joinpath("raw"), state.conf)
+    capture.close()
+    metadata, conf, flows = read_capture_dir(capture.capture_dir)
+    assert conf == tomlkit.loads(state.conf.as_toml())
+    scan_interval_s = state.conf.snapshot()["measurements"]["scan_interval_s"]
+    assert metadata["scan_interval_s"] == float(scan_interval_s)
+    assert len(flows) == 0
+
+
+def test_daemon_acquires_with_raw_capture_enabled(state, make_daemon):
+    state.conf["measurements"]["raw_capture_enabled"] = True
+    daemon = make_daemon()
+    assert daemon._acquisition_enabled.is_set()
+    capture_dir = daemon.raw_capture.capture_dir
+    for _ in range(3):
+        daemon._acquire_measurement_data(log_data=False)
+    daemon._stop_acquisition()
+    metadata = json.loads(capture_dir.joinpath(METADATA_FILENAME).read_text())
+    filter_size = state.conf.snapshot()["measurements"]["FILTER_SIZE"]
+    for adc in metadata["adcs"].values():
+        records = read_capture_file(capture_dir.joinpath(adc["file"]))
+        assert len(records) == 3 * filter_size * len(adc["mux_seq"])
+
+
+def test_capture_file_padding_is_removed(tmp_path):
+    capture_file = RawCaptureFile(tmp_path.joinpath("test.raw"), RAW_SAMPLE_DTYPE,
+                                  chunk_rows=8)
+    capture_file.append(3, time_s=[1.0, 2.0, 3.0], mux=7, value=[10, 20, 30])
+    # Unclean shutdown, the file is not truncated
+    capture_file.flush()
+    assert capture_file.file_obj.stat().st_size == 8 * RAW_SAMPLE_DTYPE.itemsize
+    records = read_capture_file(capture_file.file_obj)
+    assert records["value"].tolist() == [10, 20, 30]
+    assert records["mux"].tolist() == [7, 7, 7]
+    capture_file.close()
+    assert capture_file.file_obj.stat().st_size == 3 * RAW_SAMPLE_DTYPE.itemsize
+
+
+def test_recorder_interpolates_sample_times(tmp_path):
+    capture_file = RawCaptureFile(tmp_path.joinpath("test.raw"), RAW_SAMPLE_DTYPE)
+    recorder = RawAdcRecorder(capture_file, [0x01, 0x23])
+    recorder.record([10.0, 12.0, 13.0], [[1, 2], [3, 4]])
+    capture_file.close()
+    records = read_capture_file(capture_file.file_obj)
+    assert records["time_s"].tolist() == [11.0, 12.0, 12.5, 13.0]
+    assert records["mux"].tolist() == [0x01, 0x23, 0x01, 0x23]
+    assert records["value"].tolist() == [1, 2, 3, 4]
+
+
+# Live scans are captured and reprocessed with one scan per averaging interval.
+# reprocess() starts the first interval at the first sample, so the following
+# scans are started in the middle of their intervals.
+def test_reprocess_matches_live_results(state, make_daemon, monkeypatch):
+    interval_s = 0.05
+    n_scans = 4
+    state.conf["measurements"]["raw_capture_enabled"] = True
+    for sensor_conf in state.conf["flow_sensors"]:
+        sensor_conf["type"] = "fixed"
+        sensor_conf["FLOW_LITER_SEC"] = 0.02
+    daemon = make_daemon()
+    capture_dir = daemon.raw_capture.capture_dir
+    chs = state.results["measurements"]["chs"]
+    live = []
+    t_start = time.monotonic()
+    for k in range(n_scans):
+        if k > 0:
+            time.sleep(max(t_start + (k + 0.5)*interval_s - time.monotonic(), 0.0))
+        daemon._acquire_measurement_data(log_data=False)
+        live.append({key: [ch[key] for ch in chs] for key in QUANTITIES})
+    daemon._stop_acquisition()
+    log = reprocess(capture_dir, interval_s=interval_s)
+    assert log["time_s"] == [round(k * interval_s, 6) for k in range(n_scans)]
+    assert log["info"] == [ch["info"] for ch in chs]
+    for key in QUANTITIES:
+        expected = np.array([row[key] for row in live], dtype=float)
+        assert not np.isnan(expected).any()
+        assert np.allclose(np.array(log[key]).T, expected, rtol=1e-9, atol=1e-12), key
+    # Command line entry point writes the same data log
+    monkeypatch.setattr(sys, "argv", ["picalor_reprocess", str(capture_dir),
+                                      "--interval", str(interval_s)])
+    main()
+    assert json.loads(capture_dir.joinpath("picalor_reprocessed.json").read_text()) == log
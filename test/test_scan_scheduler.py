@@ -0,0 +1,68 @@
+import pytest
+from picalor.util_lib import scan_scheduler
+from picalor.util_lib.scan_scheduler import ScanScheduler
+
+
+class FakeTime():
+    def __init__(self):
+        self.t = 100.0
+
+    def monotonic(self):
+        return self.t
+
+    def sleep(self, delay_s):
+        self.t += delay_s
+
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(scan_scheduler, "time", fake)
+    return fake
+
+
+def run_ticks(scheduler, fake_time, processing_s):
+    ticks = []
+    for duration in processing_s:
+        scheduler.wait_next()
+        ticks.append(round(scheduler.t_tick - 100.0, 6))
+        fake_time.t += duration
+    return ticks
+
+
+def test_ticks_on_time_grid(fake_time):
+    scheduler = ScanScheduler(0.1)
+    assert run_ticks(scheduler, fake_time, [0.01] * 4) == [0.1, 0.2, 0.3, 0.4]
+    assert scheduler.n_overruns == 0
+    assert scheduler.n_missed == 0
+
+
+def test_overrun_shorter_than_interval_skips_no_tick(fake_time):
+    scheduler = ScanScheduler(0.1)
+    ticks = run_ticks(scheduler, fake_time, [0.0, 0.0, 0.105, 0.0, 0.0, 0.0])
+    assert ticks == [0.1, 0.2, 0.3, 0.405, 0.5, 0.6]
+    assert scheduler.n_overruns == 1
+    assert scheduler.n_missed == 0
+
+
+def test_overrun_skips_ticks_in_the_past(fake_time):
+    scheduler = ScanScheduler(0.1)
+    ticks = run_ticks(scheduler, fake_time, [0.25, 0.0, 0.0])
+    assert ticks == [0.1, 0.35, 0.4]
+    assert scheduler.n_overruns == 1
+    assert scheduler.n_missed == 1
+
+
+def test_stop_event_returns_false(fake_time):
+    class SetEvent():
+        def wait(self, timeout):
+            return True
+    scheduler = ScanScheduler(0.1)
+    assert scheduler.wait_next(SetEvent()) is False
+
+
+def test_set_interval_continues_from_last_tick(fake_time):
+    scheduler = ScanScheduler(0.1)
+    run_ticks(scheduler, fake_time, [0.0, 0.0])
+    scheduler.set_interval(0.5)
+    assert run_ticks(scheduler, fake_time, [0.0, 0.0]) == [0.7, 1.2]